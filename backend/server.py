@@ -1,13 +1,37 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, UpdateOne, DeleteOne, ReturnDocument
+from pymongo.errors import OperationFailure, BulkWriteError
 import os
+import sys
 import logging
+import asyncio
+import time
+import re
+import math
+import bisect
+import heapq
+import json
+import csv
+import io
+import base64
+import hashlib
+import hmac
+import sqlite3
+import threading
+import functools
+from urllib.parse import urlencode
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, ConfigDict, EmailStr, ValidationError, model_validator
+from typing import List, Optional, Dict, Any, Union, AsyncIterator, get_args, get_origin
+from collections import OrderedDict, Counter
+from types import MappingProxyType
 import uuid
 from datetime import datetime, timezone, timedelta
 import jwt
@@ -20,14 +44,106 @@ load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# tz_aware so stored datetimes come back as UTC-aware values
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
+# Datetime Migration Config
+# Keep matching legacy ISO-string timestamps until `python server.py migrate-datetimes` has run
+DATETIME_DUAL_READ = os.environ.get('DATETIME_DUAL_READ', 'true').lower() == 'true'
+DATETIME_MIGRATION_BATCH_SIZE = int(os.environ.get('DATETIME_MIGRATION_BATCH_SIZE', '500'))
+
 # JWT Config
 JWT_SECRET = os.environ.get('JWT_SECRET', 'techgalaxy_secret')
 JWT_ALGORITHM = os.environ.get('JWT_ALGORITHM', 'HS256')
 JWT_EXPIRATION_HOURS = int(os.environ.get('JWT_EXPIRATION_HOURS', 24))
 
+# Password hashing Config
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+PASSWORD_HASH_EXECUTOR = os.environ.get('PASSWORD_HASH_EXECUTOR', 'thread')  # thread or process
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 4))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 64))
+
+# Serialization Config
+# "trusted" renders documents read from our own collections without a second Pydantic pass;
+# opt in only once stored documents match the models, since validators and defaults are skipped
+SERIALIZATION_MODE = os.environ.get('SERIALIZATION_MODE', 'validated').lower()  # validated | trusted
+TRUSTED_SERIALIZATION = SERIALIZATION_MODE == 'trusted'
+
+# Index bootstrap Config
+ENSURE_INDEXES_ON_STARTUP = os.environ.get('ENSURE_INDEXES_ON_STARTUP', 'true').lower() == 'true'
+# Legacy variations have no variation_id; reads would render them without one (trusted) or with a new one each time
+MIGRATE_VARIATIONS_ON_STARTUP = os.environ.get('MIGRATE_VARIATIONS_ON_STARTUP', 'true').lower() == 'true'
+
+# Product search Config
+# A search lists, counts and pages over at most its best SEARCH_MAX_RESULTS matches
+SEARCH_MAX_RESULTS = int(os.environ.get('SEARCH_MAX_RESULTS', 1000))
+SEARCH_INDEX_REFRESH_SECONDS = int(os.environ.get('SEARCH_INDEX_REFRESH_SECONDS', 300))  # 0 disables periodic resync
+
+# Catalog facet Config
+PRICE_FACET_BOUNDARIES = [0, 100, 250, 500, 1000, 2000]  # USD; last bucket is open-ended
+
+# Exchange rate Config
+EXCHANGE_RATES_FILE = os.environ.get('EXCHANGE_RATES_FILE', '')  # JSON {"KES": 129.5, ...}; empty uses the built-in rates
+EXCHANGE_RATES_REFRESH_SECONDS = int(os.environ.get('EXCHANGE_RATES_REFRESH_SECONDS', 3600))  # 0 disables periodic refresh
+
+# Image derivative Config
+IMAGE_STORAGE_DIR = os.environ.get('IMAGE_STORAGE_DIR', str(ROOT_DIR / 'media'))
+IMAGE_PUBLIC_BASE_URL = os.environ.get('IMAGE_PUBLIC_BASE_URL', '/api/media')
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+IMAGE_FETCH_TIMEOUT = float(os.environ.get('IMAGE_FETCH_TIMEOUT', 15))
+IMAGE_MAX_SOURCE_BYTES = int(os.environ.get('IMAGE_MAX_SOURCE_BYTES', 20 * 1024 * 1024))
+IMAGE_MAX_REDIRECTS = int(os.environ.get('IMAGE_MAX_REDIRECTS', 3))
+# Hosts a source image may redirect to besides its own; anything else is refused
+IMAGE_REDIRECT_HOSTS = {h.strip().lower() for h in os.environ.get('IMAGE_REDIRECT_HOSTS', '').split(',') if h.strip()}
+
+# Product import/export Config
+PRODUCT_IMPORT_BATCH_SIZE = int(os.environ.get('PRODUCT_IMPORT_BATCH_SIZE', 1000))
+PRODUCT_IMPORT_MAX_ERRORS = int(os.environ.get('PRODUCT_IMPORT_MAX_ERRORS', 1000))  # rows reported back, all are counted
+PRODUCT_EXPORT_BATCH_SIZE = int(os.environ.get('PRODUCT_EXPORT_BATCH_SIZE', 1000))
+
+# Response cache Config
+RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND', 'memory')  # memory, sqlite (shared by local workers) or none
+RESPONSE_CACHE_TTL_SECONDS = int(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', 60))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 5000))
+RESPONSE_CACHE_SQLITE_PATH = os.environ.get('RESPONSE_CACHE_SQLITE_PATH', '/tmp/techgalaxy_response_cache.sqlite3')
+
+# Cart Config
+CART_STOCK_SNAPSHOT_TTL_SECONDS = float(os.environ.get('CART_STOCK_SNAPSHOT_TTL_SECONDS', 5))
+CART_STOCK_SNAPSHOT_MAX_ENTRIES = int(os.environ.get('CART_STOCK_SNAPSHOT_MAX_ENTRIES', 10000))
+CART_STORE_BACKEND = os.environ.get('CART_STORE_BACKEND', 'mongo')  # mongo, memory (single worker/tests) or sqlite (shared by local workers)
+CART_STORE_SQLITE_PATH = os.environ.get('CART_STORE_SQLITE_PATH', '/tmp/techgalaxy_carts.sqlite3')
+CART_TTL_SECONDS = int(os.environ.get('CART_TTL_SECONDS', 30 * 24 * 3600))
+CART_WRITE_BEHIND_SECONDS = float(os.environ.get('CART_WRITE_BEHIND_SECONDS', 30))  # 0 keeps carts only in the key-value store
+
+# Order Config
+ORDER_STOCK_TRANSACTIONS = os.environ.get('ORDER_STOCK_TRANSACTIONS', 'auto')  # auto, on (replica set required) or off (compensating rollback)
+# Stock held by a checkout that died before compensating goes back after ORDER_RESERVATION_STALE_SECONDS
+ORDER_RESERVATION_SWEEP_SECONDS = int(os.environ.get('ORDER_RESERVATION_SWEEP_SECONDS', 300))  # 0 disables; see release-reservations
+ORDER_RESERVATION_STALE_SECONDS = int(os.environ.get('ORDER_RESERVATION_STALE_SECONDS', 300))
+
+# Guest cart Config
+# Without its own setting the key is derived from JWT_SECRET, never the JWT signing key itself
+GUEST_CART_SECRET = os.environ.get('GUEST_CART_SECRET') or hmac.new(JWT_SECRET.encode("utf-8"), b"guest-cart", hashlib.sha256).hexdigest()
+GUEST_CART_MAX_LINES = int(os.environ.get('GUEST_CART_MAX_LINES', 20))
+GUEST_CART_MAX_COOKIE_BYTES = int(os.environ.get('GUEST_CART_MAX_COOKIE_BYTES', 3500))  # browsers cap a cookie at ~4KB
+GUEST_CART_MAX_AGE_SECONDS = int(os.environ.get('GUEST_CART_MAX_AGE_SECONDS', 7 * 24 * 3600))
+
+# Token revocation Config
+TOKEN_REVOCATION_REFRESH_SECONDS = int(os.environ.get('TOKEN_REVOCATION_REFRESH_SECONDS', 10))
+
+# Auth cache Config
+AUTH_CACHE_MAX_ENTRIES = int(os.environ.get('AUTH_CACHE_MAX_ENTRIES', 10000))
+AUTH_CACHE_TTL_SECONDS = int(os.environ.get('AUTH_CACHE_TTL_SECONDS', 60))
+
+# OAuth session-data Config
+# Defaults to the upstream auth service get_session_data always called; override only to point load tests at a stub
+OAUTH_SESSION_BASE_URL = os.environ.get('OAUTH_SESSION_BASE_URL', 'https://demobackend.emergentagent.com')
+OAUTH_HTTP_CONNECT_TIMEOUT = float(os.environ.get('OAUTH_HTTP_CONNECT_TIMEOUT', 5))
+OAUTH_HTTP_READ_TIMEOUT = float(os.environ.get('OAUTH_HTTP_READ_TIMEOUT', 10))
+OAUTH_HTTP_MAX_CONNECTIONS = int(os.environ.get('OAUTH_HTTP_MAX_CONNECTIONS', 20))
+OAUTH_HTTP_MAX_KEEPALIVE = int(os.environ.get('OAUTH_HTTP_MAX_KEEPALIVE', 10))
+
 # Stripe Config
 STRIPE_API_KEY = os.environ.get('STRIPE_API_KEY', 'sk_test_emergent')
 
@@ -91,13 +207,26 @@ class ProductCondition(str, Enum):
     REFURBISHED = "refurbished"
     USED = "used"
 
+class ProductSortField(str, Enum):
+    # Every key except relevance is backed by the listing indexes in INDEX_SPECS
+    CREATED_AT = "created_at"
+    PRICE = "price_usd"
+    RATING = "rating"
+    SOLD_COUNT = "sold_count"
+    NAME = "name"
+    RELEVANCE = "relevance"
+
+class SortOrder(str, Enum):
+    ASC = "asc"
+    DESC = "desc"
+
 class Currency(str, Enum):
     KES = "KES"
     USD = "USD"
     EUR = "EUR"
 
-# Exchange rates (base: USD)
-EXCHANGE_RATES = {
+# Fallback exchange rates (base: USD), used until a provider refresh succeeds
+DEFAULT_EXCHANGE_RATES = {
     "USD": 1.0,
     "KES": 129.50,
     "EUR": 0.92
@@ -135,6 +264,25 @@ class TokenResponse(BaseModel):
     token: str
     user: UserResponse
 
+class ProductVariation(BaseModel):
+    """One purchasable SKU of a product, with its own price and stock"""
+    variation_id: str = Field(default_factory=lambda: f"var_{uuid.uuid4().hex[:12]}")
+    sku: Optional[str] = None
+    attributes: Dict[str, Any] = {}  # {ram: "8GB", storage: "256GB", color: "Black"}
+    price_usd: Optional[float] = None  # None means the product price
+    stock: int = 0
+
+    @model_validator(mode="before")
+    @classmethod
+    def fold_legacy_attributes(cls, data: Any) -> Any:
+        # Older variations stored option values as top-level keys
+        if isinstance(data, dict):
+            extra = {k: v for k, v in data.items() if k not in cls.model_fields}
+            if extra:
+                data = {k: v for k, v in data.items() if k in cls.model_fields}
+                data["attributes"] = {**extra, **data.get("attributes", {})}
+        return data
+
 class ProductBase(BaseModel):
     name: str
     description: str
@@ -149,8 +297,8 @@ class ProductBase(BaseModel):
     warranty_months: int = 12
     featured: bool = False
     tags: List[str] = []
-    # Product variations
-    variations: List[Dict[str, Any]] = []  # [{ram: "8GB", storage: "256GB", color: "Black", price_usd: 1199, stock: 10}]
+    # Product variations; when present, stock is their sum
+    variations: List[ProductVariation] = []
     has_variations: bool = False
 
 class ProductCreate(ProductBase):
@@ -163,8 +311,25 @@ class ProductResponse(ProductBase):
     review_count: int = 0
     sold_count: int = 0
     created_at: datetime
-    variations: List[Dict[str, Any]] = []
-    has_variations: bool = False
+    # Per entry of images: {size: {format: url}}, filled in by the image pipeline
+    image_variants: List[Dict[str, Dict[str, str]]] = []
+
+class ProductCardResponse(BaseModel):
+    """Compact view model for product grids (Landing, Products, Wishlist, related items)"""
+    model_config = ConfigDict(extra="ignore")
+    product_id: str
+    name: str
+    brand: str
+    category: ProductCategory
+    condition: ProductCondition = ProductCondition.NEW
+    price_usd: float
+    original_price_usd: Optional[float] = None
+    stock: int = 0
+    images: List[str] = []  # first image only
+    image_variants: List[Dict[str, Dict[str, str]]] = []  # first image only
+    featured: bool = False
+    rating: float = 0.0
+    review_count: int = 0
 
 # Wishlist Models
 class WishlistItem(BaseModel):
@@ -212,15 +377,18 @@ class TicketResponse(BaseModel):
     messages: List[Dict[str, Any]] = []
     
 class ProductListResponse(BaseModel):
-    products: List[ProductResponse]
-    total: int
+    products: List[Union[ProductResponse, Dict[str, Any]]]
+    total: Optional[int] = None
     page: int
     limit: int
-    total_pages: int
+    total_pages: Optional[int] = None
+    next_cursor: Optional[str] = None
+    facets: Optional[Dict[str, Any]] = None
+    truncated: bool = False  # the search had more than SEARCH_MAX_RESULTS matches
 
 class CartItem(BaseModel):
     product_id: str
-    quantity: int = 1
+    quantity: int = Field(1, ge=0)  # 0 removes the line in /cart/update
     variation_id: Optional[str] = None  # For products with variations
 
 class CartResponse(BaseModel):
@@ -231,6 +399,7 @@ class CartResponse(BaseModel):
 
 class OrderItem(BaseModel):
     product_id: str
+    variation_id: Optional[str] = None
     product_name: str
     quantity: int
     price_usd: float
@@ -356,18 +525,134 @@ class PromoCodeResponse(BaseModel):
     active: bool
 
 # ============== HELPERS ==============
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+def as_datetime(value: Any) -> Optional[datetime]:
+    """Read a timestamp stored either as a BSON datetime or a legacy ISO string, always UTC-aware"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
 
-def verify_password(password: str, hashed: str) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+def since_filter(field: str, moment: datetime) -> Dict:
+    """Range filter for field >= moment that also matches not-yet-migrated ISO strings"""
+    if not DATETIME_DUAL_READ:
+        return {field: {"$gte": moment}}
+    # BSON never compares a string with a date, so each format needs its own branch
+    return {"$or": [
+        {field: {"$gte": moment}},
+        {field: {"$gte": moment.isoformat(), "$type": "string"}}
+    ]}
+
+def _bcrypt_hash(password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=rounds))
+
+def _bcrypt_check(password: bytes, hashed: bytes) -> bool:
+    try:
+        return bcrypt.checkpw(password, hashed)
+    except ValueError:
+        # Malformed or missing hash (e.g. OAuth-only accounts)
+        return False
+
+class PasswordHasher:
+    """Runs bcrypt on a bounded worker pool so it never blocks the event loop"""
+
+    def __init__(self, executor: str, workers: int, max_pending: int, rounds: int):
+        self.executor_kind = executor
+        self.workers = workers
+        self.max_pending = max_pending
+        self.rounds = rounds
+        self._executor = None
+        self._slots = asyncio.Semaphore(workers)
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait_ms = 0.0
+        self.total_run_ms = 0.0
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.executor_kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def _run(self, fn, *args):
+        if self.queued + self.running >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="Server busy, please retry")
+        
+        self.queued += 1
+        enqueued_at = time.perf_counter()
+        try:
+            await self._slots.acquire()
+        finally:
+            self.queued -= 1
+        
+        started_at = time.perf_counter()
+        self.running += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self.running -= 1
+            self._slots.release()
+            self.completed += 1
+            self.total_wait_ms += (started_at - enqueued_at) * 1000
+            self.total_run_ms += (time.perf_counter() - started_at) * 1000
+
+    async def hash(self, password: str) -> str:
+        hashed = await self._run(_bcrypt_hash, password.encode('utf-8'), self.rounds)
+        return hashed.decode('utf-8')
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        if not hashed:
+            return False
+        return await self._run(_bcrypt_check, password.encode('utf-8'), hashed.encode('utf-8'))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "executor": self.executor_kind,
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "rounds": self.rounds,
+            "queue_depth": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait_ms / self.completed, 2) if self.completed else 0.0,
+            "avg_run_ms": round(self.total_run_ms / self.completed, 2) if self.completed else 0.0
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+password_hasher = PasswordHasher(
+    executor=PASSWORD_HASH_EXECUTOR,
+    workers=PASSWORD_HASH_WORKERS,
+    max_pending=PASSWORD_HASH_MAX_PENDING,
+    rounds=BCRYPT_ROUNDS
+)
+
+async def hash_password(password: str) -> str:
+    return await password_hasher.hash(password)
+
+async def verify_password(password: str, hashed: str) -> bool:
+    return await password_hasher.verify(password, hashed)
 
 def create_token(user_id: str, email: str, role: str) -> str:
+    now = datetime.now(timezone.utc)
     payload = {
         "user_id": user_id,
         "email": email,
         "role": role,
-        "exp": datetime.now(timezone.utc) + timedelta(hours=JWT_EXPIRATION_HOURS)
+        "iat": now,
+        "exp": now + timedelta(hours=JWT_EXPIRATION_HOURS)
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
@@ -379,11 +664,197 @@ def decode_token(token: str) -> Dict:
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+_oauth_http_client: Optional[httpx.AsyncClient] = None
+
+def get_oauth_http_client() -> httpx.AsyncClient:
+    """Application-lifetime pooled client for the OAuth session-data service"""
+    global _oauth_http_client
+    if _oauth_http_client is None:
+        _oauth_http_client = httpx.AsyncClient(
+            base_url=OAUTH_SESSION_BASE_URL,
+            timeout=httpx.Timeout(
+                connect=OAUTH_HTTP_CONNECT_TIMEOUT,
+                read=OAUTH_HTTP_READ_TIMEOUT,
+                write=OAUTH_HTTP_READ_TIMEOUT,
+                # Bounded concurrency: callers wait this long for a free pooled connection
+                pool=OAUTH_HTTP_READ_TIMEOUT
+            ),
+            limits=httpx.Limits(
+                max_connections=OAUTH_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=OAUTH_HTTP_MAX_KEEPALIVE
+            )
+        )
+    return _oauth_http_client
+
+async def close_oauth_http_client():
+    global _oauth_http_client
+    if _oauth_http_client is not None:
+        await _oauth_http_client.aclose()
+        _oauth_http_client = None
+
+class StaticRateProvider:
+    """Fixed rates, used when no rates file is configured"""
+
+    def __init__(self, rates: Dict[str, float]):
+        self.rates = dict(rates)
+
+    async def fetch(self) -> Dict[str, float]:
+        return dict(self.rates)
+
+class FileRateProvider:
+    """Rates from a JSON file ({"KES": 129.5, ...}, optionally under "rates"), re-read on every refresh"""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+
+    def _read(self) -> Dict[str, float]:
+        data = json.loads(self.path.read_text())
+        return data.get("rates", data)
+
+    async def fetch(self) -> Dict[str, float]:
+        return await asyncio.to_thread(self._read)
+
+class ExchangeRateService:
+    """Holds the current rates as an immutable snapshot that a refresh swaps in one assignment"""
+
+    def __init__(self, provider, refresh_seconds: int):
+        self.provider = provider
+        self.refresh_seconds = refresh_seconds
+        self._snapshot = MappingProxyType(dict(DEFAULT_EXCHANGE_RATES))
+        self.updated_at: Optional[datetime] = None
+        self.failures = 0
+
+    @property
+    def rates(self) -> MappingProxyType:
+        return self._snapshot
+
+    def rate(self, currency: Currency) -> float:
+        return self._snapshot.get(currency.value, 1.0)
+
+    @staticmethod
+    def _validate(raw: Dict[str, Any]) -> Dict[str, float]:
+        try:
+            rates = {c.value: float(raw[c.value]) for c in Currency}
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Rates must give a number for every currency: {e}")
+        if any(rate <= 0 for rate in rates.values()) or rates[Currency.USD.value] != 1.0:
+            raise ValueError("Rates must be positive and quoted against USD")
+        return rates
+
+    async def refresh(self) -> bool:
+        """Load fresh rates; returns True when they differ from the current snapshot"""
+        rates = self._validate(await self.provider.fetch())
+        changed = rates != dict(self._snapshot)
+        self._snapshot = MappingProxyType(rates)
+        self.updated_at = datetime.now(timezone.utc)
+        return changed
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "provider": type(self.provider).__name__,
+            "rates": dict(self._snapshot),
+            "updated_at": self.updated_at,
+            "failures": self.failures
+        }
+
+exchange_rates = ExchangeRateService(
+    FileRateProvider(EXCHANGE_RATES_FILE) if EXCHANGE_RATES_FILE else StaticRateProvider(DEFAULT_EXCHANGE_RATES),
+    EXCHANGE_RATES_REFRESH_SECONDS
+)
+
 def convert_currency(amount_usd: float, target_currency: Currency) -> float:
-    rate = EXCHANGE_RATES.get(target_currency.value, 1.0)
-    return round(amount_usd * rate, 2)
+    return round(amount_usd * exchange_rates.rate(target_currency), 2)
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), request: Request = None) -> Dict:
+def to_usd(amount: float, currency: Currency) -> float:
+    """Inverse of convert_currency, unrounded so it can bound a price_usd range"""
+    return amount / exchange_rates.rate(currency)
+
+class TTLCache:
+    """Bounded LRU cache with per-entry expiry and hit/miss counters"""
+
+    def __init__(self, max_entries: int, ttl_seconds: float, on_evict=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.on_evict = on_evict  # called with (key, value) when an entry expires or is evicted
+        self._entries: "OrderedDict[Any, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, deadline = entry
+        if deadline <= time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            if self.on_evict:
+                self.on_evict(key, value)
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl_seconds: Optional[float] = None):
+        ttl = self.ttl_seconds if ttl_seconds is None else min(ttl_seconds, self.ttl_seconds)
+        if ttl <= 0:
+            return
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            evicted_key, (evicted_value, _) = self._entries.popitem(last=False)
+            self.evictions += 1
+            if self.on_evict:
+                self.on_evict(evicted_key, evicted_value)
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        return entry[0] if entry else None
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+def _forget_cached_token(token: str, user: Dict):
+    tokens = auth_cache_tokens_by_user.get(user["user_id"])
+    if tokens is not None:
+        tokens.discard(token)
+        if not tokens:
+            del auth_cache_tokens_by_user[user["user_id"]]
+
+# token -> user document; expiry never outlives the session/JWT it was resolved from
+auth_cache = TTLCache(AUTH_CACHE_MAX_ENTRIES, AUTH_CACHE_TTL_SECONDS, on_evict=_forget_cached_token)
+auth_cache_tokens_by_user: Dict[str, set] = {}
+
+def cache_authenticated_user(token: str, user: Dict, expires_at: datetime):
+    ttl = (expires_at - datetime.now(timezone.utc)).total_seconds()
+    if ttl <= 0:
+        return
+    auth_cache.set(token, user, ttl_seconds=ttl)
+    auth_cache_tokens_by_user.setdefault(user["user_id"], set()).add(token)
+
+def invalidate_user_cache(user_id: str):
+    """Drop every cached token for a user after their profile, role or points change"""
+    for token in auth_cache_tokens_by_user.pop(user_id, set()):
+        auth_cache.pop(token)
+
+def get_request_token(credentials: Optional[HTTPAuthorizationCredentials], request: Optional[Request]) -> str:
     # Try cookie first
     token = None
     if request:
@@ -395,38 +866,113 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
+    return token
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), request: Request = None) -> Dict:
+    token = get_request_token(credentials, request)
+    
+    cached = auth_cache.get(token)
+    if cached is not None:
+        # Handlers mutate the user dict (e.g. created_at parsing), hand out a copy
+        return dict(cached)
     
     # Check if it's a session token (for Google OAuth)
     session = await db.user_sessions.find_one({"session_token": token}, {"_id": 0})
     if session:
-        expires_at = session.get("expires_at")
-        if isinstance(expires_at, str):
-            expires_at = datetime.fromisoformat(expires_at)
-        if expires_at.tzinfo is None:
-            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        expires_at = as_datetime(session.get("expires_at"))
         if expires_at < datetime.now(timezone.utc):
             raise HTTPException(status_code=401, detail="Session expired")
         user = await db.users.find_one({"user_id": session["user_id"]}, {"_id": 0})
         if user:
-            return user
+            cache_authenticated_user(token, user, expires_at)
+            return dict(user)
     
     # Try JWT token
     payload = decode_token(token)
     user = await db.users.find_one({"user_id": payload["user_id"]}, {"_id": 0})
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
-    return user
+    cache_authenticated_user(token, user, datetime.fromtimestamp(payload["exp"], tz=timezone.utc))
+    return dict(user)
+
+async def get_optional_user(credentials: HTTPAuthorizationCredentials = Depends(security), request: Request = None) -> Optional[Dict]:
+    """get_current_user for routes that also serve anonymous visitors, who get None"""
+    if not credentials and not (request and request.cookies.get("session_token")):
+        return None
+    return await get_current_user(credentials, request)
+
+class TokenRevocationList:
+    """In-process mirror of db.token_revocations, refreshed at most every few seconds.
+
+    A revocation invalidates every JWT issued to the user at or before `revoked_at`,
+    so claims-only auth stops trusting a stale role without a per-request lookup.
+    """
+
+    def __init__(self, refresh_seconds: int):
+        self.refresh_seconds = refresh_seconds
+        self._revoked_at: Dict[str, float] = {}
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def refresh(self, force: bool = False):
+        if not force and time.monotonic() - self._loaded_at < self.refresh_seconds:
+            return
+        async with self._lock:
+            if not force and time.monotonic() - self._loaded_at < self.refresh_seconds:
+                return
+            # Revocations older than the JWT lifetime can no longer match a live token
+            horizon = datetime.now(timezone.utc) - timedelta(hours=JWT_EXPIRATION_HOURS)
+            docs = await db.token_revocations.find(since_filter("revoked_at", horizon), {"_id": 0}).to_list(None)
+            self._revoked_at = {d["user_id"]: as_datetime(d["revoked_at"]).timestamp() for d in docs}
+            self._loaded_at = time.monotonic()
+
+    def is_revoked(self, payload: Dict) -> bool:
+        revoked_at = self._revoked_at.get(payload.get("user_id"))
+        # iat has whole-second precision, so a token from the revocation's second is rejected too
+        return revoked_at is not None and payload.get("iat", 0) <= revoked_at
+
+    async def revoke(self, user_id: str):
+        now = datetime.now(timezone.utc)
+        await db.token_revocations.update_one(
+            {"user_id": user_id},
+            {"$set": {"user_id": user_id, "revoked_at": now}},
+            upsert=True
+        )
+        self._revoked_at[user_id] = now.timestamp()
+
+token_revocations = TokenRevocationList(TOKEN_REVOCATION_REFRESH_SECONDS)
 
-async def require_role(allowed_roles: List[UserRole]):
-    async def role_checker(user: Dict = Depends(get_current_user)):
-        if user.get("role") not in [r.value for r in allowed_roles]:
+async def get_token_claims(credentials: HTTPAuthorizationCredentials = Depends(security), request: Request = None) -> Dict:
+    """Authorize from verified JWT claims alone; OAuth session tokens fall back to get_current_user"""
+    token = get_request_token(credentials, request)
+    
+    try:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except jwt.InvalidTokenError:
+        user = await get_current_user(credentials, request)
+        return {"user_id": user["user_id"], "email": user["email"], "role": user.get("role")}
+    
+    await token_revocations.refresh()
+    if token_revocations.is_revoked(payload):
+        raise HTTPException(status_code=401, detail="Token revoked")
+    
+    return {"user_id": payload["user_id"], "email": payload["email"], "role": payload["role"]}
+
+def require_role(allowed_roles: List[UserRole]):
+    """Role guard dependency that needs no database read for JWT-authenticated staff"""
+    allowed = {r.value for r in allowed_roles}
+    
+    async def role_checker(claims: Dict = Depends(get_token_claims)) -> Dict:
+        if claims.get("role") not in allowed:
             raise HTTPException(status_code=403, detail="Insufficient permissions")
-        return user
+        return claims
     return role_checker
 
 # ============== AUTH ROUTES ==============
 @api_router.post("/auth/register", response_model=TokenResponse)
-async def register(user_data: UserCreate):
+async def register(user_data: UserCreate, request: Request, response: Response):
     # Check if user exists
     existing = await db.users.find_one({"email": user_data.email})
     if existing:
@@ -436,31 +982,32 @@ async def register(user_data: UserCreate):
     user_doc = {
         "user_id": user_id,
         "email": user_data.email,
-        "password": hash_password(user_data.password),
+        "password": await hash_password(user_data.password),
         "name": user_data.name,
         "phone": user_data.phone,
         "role": UserRole.CUSTOMER.value,
         "picture": None,
         "loyalty_points": 0,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
     
     await db.users.insert_one(user_doc)
     
     token = create_token(user_id, user_data.email, UserRole.CUSTOMER.value)
     user_doc.pop("password")
-    user_doc["created_at"] = datetime.fromisoformat(user_doc["created_at"])
+    await merge_guest_cart(request, response, user_id)
     
     return TokenResponse(token=token, user=UserResponse(**user_doc))
 
 @api_router.post("/auth/login", response_model=TokenResponse)
-async def login(credentials: UserLogin):
+async def login(credentials: UserLogin, request: Request, response: Response):
     user = await db.users.find_one({"email": credentials.email}, {"_id": 0})
-    if not user or not verify_password(credentials.password, user.get("password", "")):
+    if not user or not await verify_password(credentials.password, user.get("password", "")):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     token = create_token(user["user_id"], user["email"], user["role"])
     user.pop("password", None)
+    await merge_guest_cart(request, response, user["user_id"])
     if isinstance(user["created_at"], str):
         user["created_at"] = datetime.fromisoformat(user["created_at"])
     
@@ -468,20 +1015,23 @@ async def login(credentials: UserLogin):
 
 # REMINDER: DO NOT HARDCODE THE URL, OR ADD ANY FALLBACKS OR REDIRECT URLS, THIS BREAKS THE AUTH
 @api_router.get("/auth/session")
-async def get_session_data(request: Request):
+async def get_session_data(request: Request, response: Response):
     session_id = request.headers.get("X-Session-ID")
     if not session_id:
         raise HTTPException(status_code=400, detail="Session ID required")
     
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
+    try:
+        upstream = await get_oauth_http_client().get(
+            "/auth/v1/env/oauth/session-data",
             headers={"X-Session-ID": session_id}
         )
-        if response.status_code != 200:
-            raise HTTPException(status_code=401, detail="Invalid session")
-        
-        data = response.json()
+    except httpx.HTTPError as e:
+        logger.error(f"OAuth session-data request failed: {e}")
+        raise HTTPException(status_code=503, detail="Authentication service unavailable")
+    if upstream.status_code != 200:
+        raise HTTPException(status_code=401, detail="Invalid session")
+    
+    data = upstream.json()
     
     # Check if user exists
     user = await db.users.find_one({"email": data["email"]}, {"_id": 0})
@@ -497,7 +1047,7 @@ async def get_session_data(request: Request):
             "role": UserRole.CUSTOMER.value,
             "phone": None,
             "loyalty_points": 0,
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": datetime.now(timezone.utc)
         }
         await db.users.insert_one(user)
     else:
@@ -507,6 +1057,7 @@ async def get_session_data(request: Request):
             {"user_id": user_id},
             {"$set": {"name": data["name"], "picture": data.get("picture")}}
         )
+        invalidate_user_cache(user_id)
     
     # Store session
     session_token = data["session_token"]
@@ -515,12 +1066,15 @@ async def get_session_data(request: Request):
         {"$set": {
             "user_id": user_id,
             "session_token": session_token,
-            "expires_at": (datetime.now(timezone.utc) + timedelta(days=7)).isoformat(),
-            "created_at": datetime.now(timezone.utc).isoformat()
+            # Native datetime so the sessions TTL index can expire it
+            "expires_at": datetime.now(timezone.utc) + timedelta(days=7),
+            "created_at": datetime.now(timezone.utc)
         }},
         upsert=True
     )
     
+    await merge_guest_cart(request, response, user_id)
+    
     user = await db.users.find_one({"user_id": user_id}, {"_id": 0})
     if isinstance(user["created_at"], str):
         user["created_at"] = datetime.fromisoformat(user["created_at"])
@@ -536,12 +1090,978 @@ async def get_me(user: Dict = Depends(get_current_user)):
 @api_router.post("/auth/logout")
 async def logout(response: Response, user: Dict = Depends(get_current_user)):
     await db.user_sessions.delete_one({"user_id": user["user_id"]})
+    invalidate_user_cache(user["user_id"])
     response.delete_cookie("session_token", path="/", secure=True, samesite="none")
     return {"message": "Logged out successfully"}
 
+# ============== PRODUCT SEARCH ==============
+SEARCH_FIELD_BOOSTS = {"name": 4.0, "brand": 3.0, "tags": 2.0, "description": 1.0}
+SEARCH_PREFIX_MIN_LENGTH = 2
+SEARCH_TYPO_MIN_LENGTH = 4
+SEARCH_MAX_PREFIX_EXPANSIONS = 50
+_SEARCH_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+def tokenize(text: str) -> List[str]:
+    return _SEARCH_TOKEN_RE.findall(text.lower())
+
+def _edit_distance(a: str, b: str, max_distance: int) -> int:
+    """Optimal string alignment distance, bailing out once it exceeds max_distance"""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous_row = None
+    row = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(row[j] + 1, current[j - 1] + 1, row[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_row[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous_row, row = row, current
+    return row[-1]
+
+class ProductSearchIndex:
+    """Tokenised inverted index over the catalog with field boosts, prefix and typo matching.
+
+    Postings hold a boosted, saturated term frequency per product, so a query only touches
+    the posting lists of its own terms instead of scanning the collection.
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Dict[str, float]] = {}  # term -> {product_id: weight}
+        self._doc_terms: Dict[str, set] = {}  # product_id -> terms, for removal
+        self._sorted_terms: List[str] = []  # vocabulary for prefix lookups
+        self._deletes: Dict[str, set] = {}  # single-deletion variant -> terms, for typo lookups
+        self._pending_ops: Optional[List[tuple]] = None  # writes seen during a rebuild
+        self._bulk_loading = False  # append unsorted, sort once in _finish_bulk_load
+        self._rebuild_lock = asyncio.Lock()  # overlapping rebuilds would share _pending_ops
+        self.ready = False
+
+    @staticmethod
+    def _variants(term: str) -> set:
+        return {term[:i] + term[i + 1:] for i in range(len(term))} | {term}
+
+    @staticmethod
+    def _weighted_terms(product: Dict) -> Dict[str, float]:
+        weights = {}
+        for field, boost in SEARCH_FIELD_BOOSTS.items():
+            value = product.get(field) or ""
+            if isinstance(value, list):
+                value = " ".join(str(v) for v in value)
+            for term, tf in Counter(tokenize(str(value))).items():
+                # Saturate so a long description cannot outweigh a name match
+                weights[term] = weights.get(term, 0.0) + boost * min(tf, 3)
+        return weights
+
+    def _add_term(self, term: str):
+        if self._bulk_loading:
+            self._sorted_terms.append(term)
+        else:
+            bisect.insort(self._sorted_terms, term)
+        if len(term) >= SEARCH_TYPO_MIN_LENGTH:
+            for variant in self._variants(term):
+                self._deletes.setdefault(variant, set()).add(term)
+
+    def _remove_term(self, term: str):
+        index = bisect.bisect_left(self._sorted_terms, term)
+        if index < len(self._sorted_terms) and self._sorted_terms[index] == term:
+            del self._sorted_terms[index]
+        if len(term) >= SEARCH_TYPO_MIN_LENGTH:
+            for variant in self._variants(term):
+                terms = self._deletes.get(variant)
+                if terms is not None:
+                    terms.discard(term)
+                    if not terms:
+                        del self._deletes[variant]
+
+    def _finish_bulk_load(self):
+        # One sort instead of an insort per term; every product in a rebuild is new, so
+        # nothing reads the list before this point
+        self._bulk_loading = False
+        self._sorted_terms.sort()
+
+    def upsert(self, product: Dict):
+        if self._pending_ops is not None:
+            self._pending_ops.append(("upsert", product))
+        self._upsert(product)
+
+    def remove(self, product_id: str):
+        if self._pending_ops is not None:
+            self._pending_ops.append(("remove", product_id))
+        self._remove(product_id)
+
+    def _upsert(self, product: Dict):
+        product_id = product["product_id"]
+        self._remove(product_id)
+        weights = self._weighted_terms(product)
+        for term, weight in weights.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                self._add_term(term)
+            postings[product_id] = weight
+        self._doc_terms[product_id] = set(weights)
+
+    def _remove(self, product_id: str):
+        for term in self._doc_terms.pop(product_id, ()):
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            postings.pop(product_id, None)
+            if not postings:
+                del self._postings[term]
+                self._remove_term(term)
+
+    def _expand(self, token: str, is_last: bool) -> Dict[str, float]:
+        """Map a query token to indexed terms with a match-quality factor"""
+        matches = {}
+        if token in self._postings:
+            matches[token] = 1.0
+        # The last token is usually still being typed
+        if is_last and len(token) >= SEARCH_PREFIX_MIN_LENGTH:
+            start = bisect.bisect_left(self._sorted_terms, token)
+            for term in islice(self._sorted_terms, start, start + SEARCH_MAX_PREFIX_EXPANSIONS):
+                if not term.startswith(token):
+                    break
+                matches.setdefault(term, 0.8)
+        if not matches and len(token) >= SEARCH_TYPO_MIN_LENGTH:
+            candidates = set()
+            for variant in self._variants(token):
+                candidates |= self._deletes.get(variant, set())
+            for term in candidates:
+                if _edit_distance(token, term, 1) <= 1:
+                    matches.setdefault(term, 0.6)
+        return matches
+
+    def search(self, text: str, limit: int = SEARCH_MAX_RESULTS) -> List[tuple]:
+        """Return [(product_id, score)] best first; every query token must match"""
+        tokens = list(dict.fromkeys(tokenize(text)))
+        if not tokens:
+            return []
+        
+        doc_count = max(len(self._doc_terms), 1)
+        scores: Dict[str, float] = {}
+        matched: Dict[str, int] = {}
+        for i, token in enumerate(tokens):
+            token_scores: Dict[str, float] = {}
+            for term, factor in self._expand(token, i == len(tokens) - 1).items():
+                postings = self._postings[term]
+                idf = math.log(1 + doc_count / len(postings))
+                for product_id, weight in postings.items():
+                    score = factor * idf * weight
+                    if score > token_scores.get(product_id, 0.0):
+                        token_scores[product_id] = score
+            if not token_scores:
+                return []
+            for product_id, score in token_scores.items():
+                scores[product_id] = scores.get(product_id, 0.0) + score
+                matched[product_id] = matched.get(product_id, 0) + 1
+        
+        results = [(pid, score) for pid, score in scores.items() if matched[pid] == len(tokens)]
+        return heapq.nlargest(limit, results, key=lambda r: r[1])
+
+    async def rebuild(self):
+        """Rebuild from Mongo off to the side, replay writes made meanwhile, then swap in"""
+        async with self._rebuild_lock:
+            await self._rebuild()
+
+    async def _rebuild(self):
+        self._pending_ops = []
+        try:
+            fresh = ProductSearchIndex()
+            fresh._bulk_loading = True
+            projection = {"_id": 0, "product_id": 1, **{field: 1 for field in SEARCH_FIELD_BOOSTS}}
+            count = 0
+            async for product in db.products.find({}, projection):
+                fresh._upsert(product)
+                count += 1
+                if count % 500 == 0:
+                    await asyncio.sleep(0)
+            fresh._finish_bulk_load()
+            for op, arg in self._pending_ops:
+                if op == "upsert":
+                    fresh._upsert(arg)
+                else:
+                    fresh._remove(arg)
+            self._postings, self._doc_terms, self._sorted_terms, self._deletes = (
+                fresh._postings, fresh._doc_terms, fresh._sorted_terms, fresh._deletes
+            )
+            self.ready = True
+            logger.info(f"Product search index built: {count} products, {len(self._postings)} terms")
+        finally:
+            self._pending_ops = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"ready": self.ready, "products": len(self._doc_terms), "terms": len(self._postings)}
+
+product_search = ProductSearchIndex()
+
+# ============== PRODUCT SUGGESTIONS ==============
+SUGGEST_MIN_PREFIX_LENGTH = 1
+SUGGEST_MAX_SCAN = 5000  # bounds the work for very short, very common prefixes
+
+def _suggest_score(product: Dict) -> tuple:
+    return (product.get("sold_count") or 0, product.get("rating") or 0.0)
+
+class ProductSuggestIndex:
+    """Sorted-array prefix index over product names, brands and tags.
+
+    Every word suffix of a name is a key ("iphone 15 pro", "15 pro", "pro") so a prefix
+    can match mid-name; a lookup is a bisect plus a bounded scan of the matching range.
+    """
+
+    def __init__(self):
+        self._name_keys: List[tuple] = []  # sorted (key, product_id)
+        self._products: Dict[str, Dict] = {}  # product_id -> {name, brand, tags, score, keys}
+        self._labels: Dict[str, Dict[str, Dict]] = {"brand": {}, "tag": {}}  # kind -> key -> {label, product_ids}
+        self._label_keys: Dict[str, List[str]] = {"brand": [], "tag": []}
+        self._pending_ops: Optional[List[tuple]] = None
+        self._bulk_loading = False  # append unsorted, sort once in _finish_bulk_load
+        self._rebuild_lock = asyncio.Lock()  # overlapping rebuilds would share _pending_ops
+        self.ready = False
+
+    @staticmethod
+    def _name_suffixes(name: str) -> set:
+        words = tokenize(name)
+        return {" ".join(words[i:]) for i in range(len(words))}
+
+    def _add_label(self, kind: str, label: str, product_id: str):
+        key = " ".join(tokenize(label))
+        if not key:
+            return
+        entry = self._labels[kind].get(key)
+        if entry is None:
+            entry = self._labels[kind][key] = {"label": label, "product_ids": set()}
+            if self._bulk_loading:
+                self._label_keys[kind].append(key)
+            else:
+                bisect.insort(self._label_keys[kind], key)
+        entry["product_ids"].add(product_id)
+
+    def _remove_label(self, kind: str, label: str, product_id: str):
+        key = " ".join(tokenize(label))
+        entry = self._labels[kind].get(key)
+        if entry is None:
+            return
+        entry["product_ids"].discard(product_id)
+        if not entry["product_ids"]:
+            del self._labels[kind][key]
+            keys = self._label_keys[kind]
+            index = bisect.bisect_left(keys, key)
+            if index < len(keys) and keys[index] == key:
+                del keys[index]
+
+    def _finish_bulk_load(self):
+        self._bulk_loading = False
+        self._name_keys.sort()
+        for keys in self._label_keys.values():
+            keys.sort()
+
+    def upsert(self, product: Dict):
+        if self._pending_ops is not None:
+            self._pending_ops.append(("upsert", product))
+        self._upsert(product)
+
+    def remove(self, product_id: str):
+        if self._pending_ops is not None:
+            self._pending_ops.append(("remove", product_id))
+        self._remove(product_id)
+
+    def _upsert(self, product: Dict):
+        product_id = product["product_id"]
+        self._remove(product_id)
+        keys = self._name_suffixes(product.get("name") or "")
+        for key in keys:
+            if self._bulk_loading:
+                self._name_keys.append((key, product_id))
+            else:
+                bisect.insort(self._name_keys, (key, product_id))
+        tags = [str(t) for t in product.get("tags") or []]
+        if product.get("brand"):
+            self._add_label("brand", product["brand"], product_id)
+        for tag in tags:
+            self._add_label("tag", tag, product_id)
+        self._products[product_id] = {
+            "name": product.get("name"),
+            "brand": product.get("brand"),
+            "tags": tags,
+            "score": _suggest_score(product),
+            "keys": keys
+        }
+
+    def _remove(self, product_id: str):
+        info = self._products.pop(product_id, None)
+        if info is None:
+            return
+        for key in info["keys"]:
+            index = bisect.bisect_left(self._name_keys, (key, product_id))
+            if index < len(self._name_keys) and self._name_keys[index] == (key, product_id):
+                del self._name_keys[index]
+        if info["brand"]:
+            self._remove_label("brand", info["brand"], product_id)
+        for tag in info["tags"]:
+            self._remove_label("tag", tag, product_id)
+
+    def _label_score(self, entry: Dict) -> tuple:
+        return max((self._products[pid]["score"] for pid in entry["product_ids"]), default=(0, 0.0))
+
+    def suggest(self, prefix: str, limit: int) -> Dict[str, List[Dict]]:
+        key = " ".join(tokenize(prefix))
+        if prefix[-1:].isspace():
+            key += " "
+        if len(key.strip()) < SUGGEST_MIN_PREFIX_LENGTH:
+            return {"products": [], "brands": [], "tags": []}
+        
+        start = bisect.bisect_left(self._name_keys, (key,))
+        product_ids = set()
+        for name_key, product_id in islice(self._name_keys, start, start + SUGGEST_MAX_SCAN):
+            if not name_key.startswith(key):
+                break
+            product_ids.add(product_id)
+        top_products = heapq.nlargest(limit, product_ids, key=lambda pid: self._products[pid]["score"])
+        
+        labels = {}
+        for kind in ("brand", "tag"):
+            keys = self._label_keys[kind]
+            start = bisect.bisect_left(keys, key)
+            entries = []
+            for label_key in islice(keys, start, start + SUGGEST_MAX_SCAN):
+                if not label_key.startswith(key):
+                    break
+                entries.append(self._labels[kind][label_key])
+            labels[kind] = heapq.nlargest(limit, entries, key=self._label_score)
+        
+        return {
+            "products": [{"product_id": pid, "name": self._products[pid]["name"]} for pid in top_products],
+            "brands": [{"brand": e["label"], "count": len(e["product_ids"])} for e in labels["brand"]],
+            "tags": [{"tag": e["label"], "count": len(e["product_ids"])} for e in labels["tag"]]
+        }
+
+    async def rebuild(self):
+        async with self._rebuild_lock:
+            await self._rebuild()
+
+    async def _rebuild(self):
+        self._pending_ops = []
+        try:
+            fresh = ProductSuggestIndex()
+            fresh._bulk_loading = True
+            projection = {"_id": 0, "product_id": 1, "name": 1, "brand": 1, "tags": 1, "sold_count": 1, "rating": 1}
+            count = 0
+            async for product in db.products.find({}, projection):
+                fresh._upsert(product)
+                count += 1
+                if count % 500 == 0:
+                    await asyncio.sleep(0)
+            fresh._finish_bulk_load()
+            for op, arg in self._pending_ops:
+                if op == "upsert":
+                    fresh._upsert(arg)
+                else:
+                    fresh._remove(arg)
+            self._name_keys, self._products, self._labels, self._label_keys = (
+                fresh._name_keys, fresh._products, fresh._labels, fresh._label_keys
+            )
+            self.ready = True
+        finally:
+            self._pending_ops = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"ready": self.ready, "products": len(self._products), "keys": len(self._name_keys)}
+
+product_suggest = ProductSuggestIndex()
+
+def index_product(product: Dict):
+    product_search.upsert(product)
+    product_suggest.upsert(product)
+
+def unindex_product(product_id: str):
+    product_search.remove(product_id)
+    product_suggest.remove(product_id)
+
+async def rebuild_catalog_indexes():
+    await product_search.rebuild()
+    await product_suggest.rebuild()
+
+async def _refresh_catalog_indexes_periodically():
+    # Also picks up writes made by other workers and sold_count/rating changes
+    while True:
+        await asyncio.sleep(SEARCH_INDEX_REFRESH_SECONDS)
+        try:
+            await rebuild_catalog_indexes()
+        except Exception as e:
+            logger.error(f"Catalog index refresh failed: {e}")
+
+# ============== SERIALIZATION ==============
+try:
+    import orjson
+except ImportError:  # optional; the stdlib encoder is used without it
+    orjson = None
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        # Same rendering Pydantic uses for UTC datetimes
+        return value.isoformat().replace("+00:00", "Z")
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def render_json(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=_json_default, option=orjson.OPT_UTC_Z)
+    return json.dumps(content, default=_json_default, separators=(",", ":")).encode("utf-8")
+
+class TrustedJSONResponse(Response):
+    """JSON body rendered directly from stored documents; FastAPI skips response_model validation"""
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return render_json(content)
+
+@functools.lru_cache(maxsize=None)
+def _trusted_plan(model_cls) -> tuple:
+    plan = []
+    for name, field in model_cls.model_fields.items():
+        annotation, many = field.annotation, False
+        if get_origin(annotation) is list:
+            annotation, many = get_args(annotation)[0], True
+        nested = annotation if isinstance(annotation, type) and issubclass(annotation, BaseModel) else None
+        # Factory defaults (e.g. generated ids) are per instance, so they are not shared here
+        default = None if field.is_required() or field.default_factory is not None else field.get_default()
+        plan.append((name, default, nested, many))
+    return tuple(plan)
+
+def dump_trusted(model_cls, doc: Dict) -> Dict[str, Any]:
+    """Shape a stored document like model_cls(**doc).model_dump(), without validating it"""
+    out = {}
+    for name, default, nested, many in _trusted_plan(model_cls):
+        value = doc.get(name, default)
+        if nested is not None and value is not None:
+            value = [dump_trusted(nested, v) for v in value] if many else dump_trusted(nested, value)
+        out[name] = value
+    return out
+
+def model_response(model_cls, **content):
+    """Build a response model, or render it straight to JSON in trusted mode"""
+    if TRUSTED_SERIALIZATION:
+        return TrustedJSONResponse(dump_trusted(model_cls, content))
+    return model_cls(**content)
+
+# ============== RESPONSE CACHE ==============
+class MemoryCacheBackend:
+    """Per-process LRU; other workers only see invalidations once entries expire"""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self._entries = TTLCache(max_entries, ttl_seconds)
+        self._versions: Dict[str, int] = {}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self._entries.get(key)
+
+    async def set(self, key: str, value: bytes):
+        self._entries.set(key, value)
+
+    async def get_versions(self, tags: List[str]) -> List[int]:
+        return [self._versions.get(tag, 0) for tag in tags]
+
+    async def bump(self, tags: List[str]):
+        for tag in tags:
+            self._versions[tag] = self._versions.get(tag, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "memory", **self._entries.stats()}
+
+class SQLiteCacheBackend:
+    """Local key-value store shared by every worker on the host, standing in for Redis/memcached"""
+
+    PURGE_EVERY = 1000
+
+    def __init__(self, path: str, ttl_seconds: float):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._conn = None
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, expires_at REAL)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS versions (tag TEXT PRIMARY KEY, version INTEGER)")
+        return self._conn
+
+    def _get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._connection().execute("SELECT value, expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return row[0]
+
+    def _set(self, key: str, value: bytes):
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, time.time() + self.ttl_seconds)
+            )
+            self._writes += 1
+            if self._writes % self.PURGE_EVERY == 0:
+                conn.execute("DELETE FROM entries WHERE expires_at <= ?", (time.time(),))
+
+    def _get_versions(self, tags: List[str]) -> List[int]:
+        with self._lock:
+            rows = self._connection().execute(
+                f"SELECT tag, version FROM versions WHERE tag IN ({','.join('?' * len(tags))})", tags
+            ).fetchall()
+        versions = dict(rows)
+        return [versions.get(tag, 0) for tag in tags]
+
+    def _bump(self, tags: List[str]):
+        with self._lock:
+            self._connection().executemany(
+                "INSERT INTO versions (tag, version) VALUES (?, 1) ON CONFLICT(tag) DO UPDATE SET version = version + 1",
+                [(tag,) for tag in tags]
+            )
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: bytes):
+        await asyncio.to_thread(self._set, key, value)
+
+    async def get_versions(self, tags: List[str]) -> List[int]:
+        return await asyncio.to_thread(self._get_versions, tags)
+
+    async def bump(self, tags: List[str]):
+        await asyncio.to_thread(self._bump, tags)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "sqlite", "path": self.path, "ttl_seconds": self.ttl_seconds}
+
+class ResponseCache:
+    """Read-through cache of rendered JSON bodies with strong ETags.
+
+    Keys combine the path, the normalised query string and the current version of
+    each tag the response depends on; invalidating a tag bumps its version, so stale
+    entries are never read again and simply age out.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    async def versioned_key(self, base: str, tags: List[str]) -> str:
+        versions = await self.backend.get_versions(tags)
+        tag_part = ",".join(f"{tag}@{version}" for tag, version in zip(tags, versions))
+        return f"{base}#{tag_part}"
+
+    async def key_for(self, request: Request, tags: List[str]) -> str:
+        params = sorted((k, v) for k, v in request.query_params.multi_items() if v != "")
+        return await self.versioned_key(f"{request.url.path}?{urlencode(params)}", tags)
+
+    async def fetch(self, key: str, render) -> bytes:
+        """Cached bytes for a versioned key, awaiting render() to fill a miss"""
+        entry = await self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+            entry = await render()
+            await self.backend.set(key, entry)
+        else:
+            self.hits += 1
+        return entry
+
+    async def invalidate(self, *tags: str):
+        await self.backend.bump(list(tags))
+
+    def stats(self) -> Dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses, "not_modified": self.not_modified, **self.backend.stats()}
+
+def _create_response_cache() -> Optional[ResponseCache]:
+    if RESPONSE_CACHE_BACKEND == "sqlite":
+        return ResponseCache(SQLiteCacheBackend(RESPONSE_CACHE_SQLITE_PATH, RESPONSE_CACHE_TTL_SECONDS))
+    if RESPONSE_CACHE_BACKEND == "memory":
+        return ResponseCache(MemoryCacheBackend(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL_SECONDS))
+    return None
+
+response_cache = _create_response_cache()
+
+def cached_endpoint(tags):
+    """Serve a public GET handler through response_cache; `tags(kwargs)` names what it depends on.
+
+    The handler must declare a `request: Request` parameter.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(**kwargs):
+            if response_cache is None:
+                return await handler(**kwargs)
+            
+            async def render() -> bytes:
+                result = await handler(**kwargs)
+                body = result.body if isinstance(result, Response) else render_json(jsonable_encoder(result))
+                etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'.encode("ascii")
+                return etag + b"\n" + body
+            
+            request = kwargs["request"]
+            entry = await response_cache.fetch(await response_cache.key_for(request, tags(kwargs)), render)
+            etag, body = entry.split(b"\n", 1)
+            headers = {"ETag": etag.decode("ascii"), "Cache-Control": "no-cache"}
+            if_none_match = request.headers.get("if-none-match", "")
+            if etag.decode("ascii") in [tag.strip() for tag in if_none_match.split(",")]:
+                response_cache.not_modified += 1
+                return Response(status_code=304, headers=headers)
+            return Response(content=body, media_type="application/json", headers=headers)
+        return wrapper
+    return decorator
+
+async def invalidate_catalog_cache(*product_ids: str):
+    """Drop cached catalog reads after a product, stock or rating change"""
+    for pid in product_ids:
+        stock_snapshots.pop(pid)
+    if response_cache is not None:
+        await response_cache.invalidate("catalog", *(f"product:{pid}" for pid in product_ids))
+
+# ============== PRODUCT PROJECTIONS ==============
+PRODUCT_CARD_FIELDS = list(ProductCardResponse.model_fields)
+
+def select_product_fields(fields: Optional[str], view: Optional[str]) -> Optional[List[str]]:
+    """Resolve ?fields= / ?view= into the product fields to return; None means the full document"""
+    if fields:
+        requested = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = [f for f in requested if f not in ProductResponse.model_fields]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+        return list(dict.fromkeys(["product_id", *requested]))
+    if view == "card":
+        return PRODUCT_CARD_FIELDS
+    if view not in (None, "full"):
+        raise HTTPException(status_code=400, detail="view must be 'card' or 'full'")
+    return None
+
+def product_projection(selected: Optional[List[str]], *extra: str) -> Dict[str, Any]:
+    """Push the field selection down to Mongo so unused BSON is never decoded"""
+    if selected is None:
+        return {"_id": 0}
+    projection = {"_id": 0, **{field: 1 for field in (*selected, *extra)}}
+    if selected == PRODUCT_CARD_FIELDS:
+        projection["images"] = {"$slice": 1}
+        projection["image_variants"] = {"$slice": 1}
+    return projection
+
+def render_product(product: Dict, selected: Optional[List[str]]) -> Union[ProductResponse, Dict[str, Any]]:
+    if isinstance(product.get("created_at"), str):
+        product["created_at"] = datetime.fromisoformat(product["created_at"])
+    if selected is None:
+        return dump_trusted(ProductResponse, product) if TRUSTED_SERIALIZATION else ProductResponse(**product)
+    if selected == PRODUCT_CARD_FIELDS:
+        return dump_trusted(ProductCardResponse, product) if TRUSTED_SERIALIZATION else ProductCardResponse(**product).model_dump()
+    return {field: product[field] for field in selected if field in product}
+
+# ============== PAGINATION ==============
+def encode_cursor(data: Dict[str, Any]) -> str:
+    def default(value):
+        if isinstance(value, datetime):
+            return {"$dt": value.isoformat()}
+        raise TypeError(f"Unsupported cursor value: {value!r}")
+    raw = json.dumps(data, separators=(",", ":"), default=default).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> Dict[str, Any]:
+    def object_hook(obj):
+        if set(obj) == {"$dt"}:
+            return datetime.fromisoformat(obj["$dt"])
+        return obj
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw, object_hook=object_hook)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return data
+
+def keyset_filter(sort_by: str, sort_direction: int, last_value: Any, last_id: str) -> Dict:
+    """Documents strictly after (last_value, last_id) in (sort_by, product_id) order"""
+    op = "$lt" if sort_direction == -1 else "$gt"
+    clauses = [
+        {sort_by: {op: last_value}},
+        {sort_by: last_value, "product_id": {op: last_id}}
+    ]
+    if DATETIME_DUAL_READ and sort_by == "created_at":
+        # BSON sorts strings before dates, so a half-migrated field continues in the other type
+        if isinstance(last_value, datetime) and sort_direction == -1:
+            clauses.append({sort_by: {"$type": "string"}})
+        elif isinstance(last_value, str) and sort_direction == 1:
+            clauses.append({sort_by: {"$type": "date"}})
+    return {"$or": clauses}
+
+# ============== CATALOG FACETS ==============
+def merge_filters(clauses) -> Dict:
+    # Clauses never share a top-level key, so a flat merge is an AND
+    query = {}
+    for clause in clauses:
+        query.update(clause)
+    return query
+
+def _price_range_label(lower: float) -> Dict[str, Any]:
+    index = PRICE_FACET_BOUNDARIES.index(lower)
+    upper = PRICE_FACET_BOUNDARIES[index + 1] if index + 1 < len(PRICE_FACET_BOUNDARIES) else None
+    return {"min": lower, "max": upper}
+
+async def get_faceted_products(filters: Dict[str, Dict], ranked: Optional[List[str]], sort_by: str,
+                               sort_direction: int, page: int, limit: int,
+                               selected: Optional[List[str]] = None, truncated: bool = False) -> ProductListResponse:
+    """Page, total and filter-aware facet counts from one $facet aggregation.
+
+    Each facet applies every active filter except its own, so picking a brand still
+    shows how many products the other brands would give.
+    """
+    shared = ("search", "featured")
+    
+    def others(*excluded):
+        return {"$match": merge_filters(v for k, v in filters.items() if k not in shared + excluded)}
+    
+    if sort_by == "relevance":
+        sort_stages = [
+            {"$addFields": {"_rank": {"$indexOfArray": [ranked, "$product_id"]}}},
+            {"$sort": {"_rank": 1}},
+            {"$project": {"_rank": 0}}
+        ]
+    else:
+        sort_stages = [{"$sort": {sort_by: sort_direction, "product_id": sort_direction}}]
+    
+    pipeline = [
+        # Filters every branch shares are applied once, before fanning out
+        {"$match": merge_filters(v for k, v in filters.items() if k in shared)},
+        {"$facet": {
+            "products": [others(), *sort_stages, {"$skip": (page - 1) * limit}, {"$limit": limit}, {"$project": product_projection(selected)}],
+            "total": [others(), {"$count": "count"}],
+            "categories": [others("category"), {"$group": {"_id": "$category", "count": {"$sum": 1}}}, {"$sort": {"count": -1}}],
+            "brands": [others("brand"), {"$group": {"_id": "$brand", "count": {"$sum": 1}}}, {"$sort": {"_id": 1}}],
+            "conditions": [others("condition"), {"$group": {"_id": "$condition", "count": {"$sum": 1}}}, {"$sort": {"count": -1}}],
+            "price_ranges": [others("price"), {"$bucket": {
+                "groupBy": "$price_usd",
+                "boundaries": PRICE_FACET_BOUNDARIES + [float("inf")],
+                "default": "other",
+                "output": {"count": {"$sum": 1}}
+            }}]
+        }}
+    ]
+    result = (await db.products.aggregate(pipeline).to_list(1))[0]
+    
+    total = result["total"][0]["count"] if result["total"] else 0
+    
+    return model_response(
+        ProductListResponse,
+        products=[render_product(p, selected) for p in result["products"]],
+        total=total,
+        page=page,
+        limit=limit,
+        total_pages=(total + limit - 1) // limit,
+        truncated=truncated,
+        facets={
+            "categories": [{"category": c["_id"], "count": c["count"]} for c in result["categories"]],
+            "brands": [{"brand": b["_id"], "count": b["count"]} for b in result["brands"]],
+            "conditions": [{"condition": c["_id"], "count": c["count"]} for c in result["conditions"]],
+            "price_ranges": [
+                {**_price_range_label(b["_id"]), "count": b["count"]}
+                for b in result["price_ranges"] if b["_id"] != "other"
+            ]
+        }
+    )
+
+# ============== IMAGE DERIVATIVES ==============
+# Size name -> maximum width in pixels; bumping IMAGE_PIPELINE_VERSION gives every derivative a new URL
+IMAGE_SIZES = {"thumbnail": 160, "card": 480, "detail": 1200}
+IMAGE_PIPELINE_VERSION = 1
+IMAGE_MEDIA_TYPES = {"webp": "image/webp", "avif": "image/avif"}
+
+def _render_image_derivatives(source: bytes, out_dir: str, formats: tuple) -> Dict[str, Dict[str, str]]:
+    """Runs in a worker process: resize one source image and encode every size/format pair"""
+    from PIL import Image, ImageOps
+    
+    rendered = {}
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    with Image.open(io.BytesIO(source)) as image:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        for size, width in IMAGE_SIZES.items():
+            resized = image.copy()
+            resized.thumbnail((width, width * 4))  # keeps the aspect ratio and never upscales
+            for fmt in formats:
+                name = f"{size}.{fmt}"
+                tmp_path = Path(out_dir) / f"{name}.tmp"
+                resized.save(tmp_path, format=fmt.upper(), quality=80)
+                os.replace(tmp_path, Path(out_dir) / name)
+                rendered.setdefault(size, {})[fmt] = name
+    return rendered
+
+@functools.lru_cache(maxsize=1)
+def image_formats() -> tuple:
+    from PIL import features
+    return ("avif", "webp") if features.check("avif") else ("webp",)
+
+class LocalImageStore:
+    """Derivatives on local disk; an object store only needs the same four methods"""
+
+    def __init__(self, root: str, base_url: str):
+        self.root = Path(root)
+        self.base_url = base_url.rstrip("/")
+
+    def key_for(self, source_url: str) -> str:
+        # Source URLs are treated as immutable, so the key (and every derivative URL) is too
+        return hashlib.sha256(f"{IMAGE_PIPELINE_VERSION}:{source_url}".encode("utf-8")).hexdigest()[:32]
+
+    def directory(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def url_for(self, key: str, name: str) -> str:
+        return f"{self.base_url}/{key[:2]}/{key}/{name}"
+
+    def read_manifest(self, key: str) -> Optional[Dict[str, Dict[str, str]]]:
+        try:
+            return json.loads((self.directory(key) / "manifest.json").read_text())
+        except (OSError, ValueError):
+            return None
+
+    def write_manifest(self, key: str, manifest: Dict[str, Dict[str, str]]):
+        path = self.directory(key) / "manifest.json"
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(manifest))
+        os.replace(tmp_path, path)
+
+class ImagePipeline:
+    """Builds responsive WebP/AVIF derivatives of product images on a process pool"""
+
+    def __init__(self, store: LocalImageStore, workers: int):
+        self.store = store
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._http: Optional[httpx.AsyncClient] = None
+        self._tasks: set = set()
+        self.rendered = 0
+        self.reused = 0
+        self.failed = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def _get_http(self) -> httpx.AsyncClient:
+        if self._http is None:
+            # Redirects are followed by hand in _download so every hop can be checked
+            self._http = httpx.AsyncClient(timeout=IMAGE_FETCH_TIMEOUT, follow_redirects=False)
+        return self._http
+
+    async def _download(self, url: str) -> bytes:
+        origin = httpx.URL(url)
+        target = origin
+        for _ in range(IMAGE_MAX_REDIRECTS + 1):
+            async with self._get_http().stream("GET", target) as response:
+                if response.is_redirect:
+                    target = response.url.join(response.headers["location"])
+                    if target.scheme not in ("http", "https") or (target.host != origin.host and target.host not in IMAGE_REDIRECT_HOSTS):
+                        raise ValueError(f"Refusing image redirect to {target.host}")
+                    continue
+                response.raise_for_status()
+                chunks, size = [], 0
+                async for chunk in response.aiter_bytes():
+                    size += len(chunk)
+                    if size > IMAGE_MAX_SOURCE_BYTES:
+                        raise ValueError(f"Image larger than {IMAGE_MAX_SOURCE_BYTES} bytes")
+                    chunks.append(chunk)
+                return b"".join(chunks)
+        raise ValueError(f"More than {IMAGE_MAX_REDIRECTS} redirects fetching {url}")
+
+    async def derivatives_for(self, url: str) -> Dict[str, Dict[str, str]]:
+        """{size: {format: url}} for one source image, rendering it on first use"""
+        key = self.store.key_for(url)
+        manifest = await asyncio.to_thread(self.store.read_manifest, key)
+        if manifest is None:
+            source = await self._download(url)
+            loop = asyncio.get_running_loop()
+            manifest = await loop.run_in_executor(
+                self._get_executor(), _render_image_derivatives, source, str(self.store.directory(key)), image_formats()
+            )
+            await asyncio.to_thread(self.store.write_manifest, key, manifest)
+            self.rendered += 1
+        else:
+            self.reused += 1
+        return {size: {fmt: self.store.url_for(key, name) for fmt, name in names.items()} for size, names in manifest.items()}
+
+    async def process_product(self, product_id: str, images: List[str]):
+        variants = []
+        for url in images:
+            if not url.startswith(("http://", "https://")):
+                variants.append({})
+                continue
+            try:
+                variants.append(await self.derivatives_for(url))
+            except (httpx.HTTPError, OSError, ValueError) as e:
+                # PIL's UnidentifiedImageError is an OSError; the grid falls back to the source URL
+                self.failed += 1
+                logger.warning(f"Image derivatives failed for {product_id} {url}: {e}")
+                variants.append({})
+        # Matching on images skips the write if the product was edited meanwhile
+        result = await db.products.update_one(
+            {"product_id": product_id, "images": images},
+            {"$set": {"image_variants": variants}, "$inc": {"version": 1}}
+        )
+        if result.modified_count:
+            await invalidate_catalog_cache(product_id)
+
+    def schedule(self, product: Dict):
+        """Process a product's images in the background, off the request path"""
+        task = asyncio.create_task(self.process_product(product["product_id"], list(product.get("images") or [])))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"rendered": self.rendered, "reused": self.reused, "failed": self.failed, "in_flight": len(self._tasks)}
+
+    async def shutdown(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+image_pipeline = ImagePipeline(LocalImageStore(IMAGE_STORAGE_DIR, IMAGE_PUBLIC_BASE_URL), IMAGE_WORKERS)
+
+def preferred_image(product: Dict, size: str) -> Optional[str]:
+    """First image at the given derivative size, or the original until derivatives exist"""
+    variants = product.get("image_variants") or []
+    if variants and variants[0].get(size):
+        return variants[0][size].get("webp")
+    return product["images"][0] if product.get("images") else None
+
+@api_router.get("/media/{shard}/{key}/{name}")
+async def get_media(shard: str, key: str, name: str):
+    from fastapi.responses import FileResponse
+    
+    size, _, fmt = name.partition(".")
+    if not re.fullmatch(r"[0-9a-f]{32}", key) or shard != key[:2] or size not in IMAGE_SIZES or fmt not in IMAGE_MEDIA_TYPES:
+        raise HTTPException(status_code=404, detail="Not found")
+    path = image_pipeline.store.directory(key) / name
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="Not found")
+    # Content behind a derivative URL never changes
+    return FileResponse(path, media_type=IMAGE_MEDIA_TYPES[fmt], headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
 # ============== PRODUCT ROUTES ==============
 @api_router.get("/products", response_model=ProductListResponse)
+@cached_endpoint(lambda params: ["catalog"])
 async def get_products(
+    request: Request,
     page: int = Query(1, ge=1),
     limit: int = Query(12, ge=1, le=50),
     category: Optional[ProductCategory] = None,
@@ -549,62 +2069,131 @@ async def get_products(
     condition: Optional[ProductCondition] = None,
     min_price: Optional[float] = None,
     max_price: Optional[float] = None,
+    currency: Currency = Currency.USD,
     search: Optional[str] = None,
-    sort_by: str = "created_at",
-    sort_order: str = "desc",
-    featured: Optional[bool] = None
+    sort_by: ProductSortField = ProductSortField.CREATED_AT,
+    sort_order: SortOrder = SortOrder.DESC,
+    featured: Optional[bool] = None,
+    cursor: Optional[str] = None,
+    include_total: bool = True,
+    facets: bool = False,
+    fields: Optional[str] = None,
+    view: Optional[str] = None
 ):
-    query = {}
+    selected = select_product_fields(fields, view)
+
+    # Named filter clauses, so facet counts can each drop their own dimension
+    filters = {}
     
     if category:
-        query["category"] = category.value
+        filters["category"] = {"category": category.value}
     if brand:
-        query["brand"] = {"$regex": brand, "$options": "i"}
+        # Exact match (values come from the brand facet) so the brand-prefixed indexes apply
+        filters["brand"] = {"brand": brand}
     if condition:
-        query["condition"] = condition.value
+        filters["condition"] = {"condition": condition.value}
+    # Local prices are price_usd times one rate, so local bounds map onto the price_usd indexes
+    price_range = {}
     if min_price is not None:
-        query["price_usd"] = {"$gte": min_price}
+        price_range["$gte"] = to_usd(min_price, currency)
     if max_price is not None:
-        query.setdefault("price_usd", {})["$lte"] = max_price
+        price_range["$lte"] = to_usd(max_price, currency)
+    if price_range:
+        filters["price"] = {"price_usd": price_range}
+    ranked = None
+    truncated = False
     if search:
-        query["$or"] = [
-            {"name": {"$regex": search, "$options": "i"}},
-            {"description": {"$regex": search, "$options": "i"}},
-            {"brand": {"$regex": search, "$options": "i"}},
-            {"tags": {"$regex": search, "$options": "i"}}
-        ]
+        if product_search.ready:
+            # Bounded, so the $in and the relevance sort stay small however broad the query;
+            # one extra hit tells whether anything was cut off
+            ranked = [pid for pid, _ in product_search.search(search, SEARCH_MAX_RESULTS + 1)]
+            truncated = len(ranked) > SEARCH_MAX_RESULTS
+            ranked = ranked[:SEARCH_MAX_RESULTS]
+            filters["search"] = {"product_id": {"$in": ranked}}
+        else:
+            # Index still building after startup
+            filters["search"] = {"$or": [
+                {"name": {"$regex": re.escape(search), "$options": "i"}},
+                {"description": {"$regex": re.escape(search), "$options": "i"}},
+                {"brand": {"$regex": re.escape(search), "$options": "i"}},
+                {"tags": {"$regex": re.escape(search), "$options": "i"}}
+            ]}
     if featured is not None:
-        query["featured"] = featured
-    
-    sort_direction = -1 if sort_order == "desc" else 1
-    
-    total = await db.products.count_documents(query)
-    skip = (page - 1) * limit
+        filters["featured"] = {"featured": featured}
     
-    products = await db.products.find(query, {"_id": 0}).sort(sort_by, sort_direction).skip(skip).limit(limit).to_list(limit)
+    query = merge_filters(filters.values())
     
-    for p in products:
-        if isinstance(p.get("created_at"), str):
-            p["created_at"] = datetime.fromisoformat(p["created_at"])
+    sort_by, sort_order = sort_by.value, sort_order.value
+    sort_direction = -1 if sort_order == "desc" else 1
+    if sort_by == "relevance" and ranked is None:
+        sort_by = "created_at"
+    
+    if facets:
+        return await get_faceted_products(filters, ranked, sort_by, sort_direction, page, limit, selected, truncated)
+    
+    after = decode_cursor(cursor) if cursor else None
+    if after is not None and (after.get("sort_by") != sort_by or after.get("sort_order") != sort_order):
+        raise HTTPException(status_code=400, detail="Cursor does not match sort order")
+    
+    total = None
+    next_cursor = None
+    if sort_by == "relevance":
+        # Order the filtered matches by search rank, then load only the requested page
+        rank = {pid: i for i, pid in enumerate(ranked)}
+        matches = await db.products.find(query, {"_id": 0, "product_id": 1}).to_list(None)
+        ordered = sorted((m["product_id"] for m in matches), key=rank.__getitem__)
+        total = len(ordered)
+        skip = after.get("offset", 0) if after is not None else (page - 1) * limit
+        page_ids = ordered[skip:skip + limit]
+        products = await db.products.find({"product_id": {"$in": page_ids}}, product_projection(selected)).to_list(limit)
+        products.sort(key=lambda p: rank[p["product_id"]])
+        if skip + limit < total:
+            next_cursor = encode_cursor({"sort_by": sort_by, "sort_order": sort_order, "offset": skip + limit})
+    else:
+        if include_total:
+            total = await db.products.count_documents(query)
+        
+        # The sort key is always fetched so the next cursor can be built
+        projection = product_projection(selected, sort_by)
+        if after is not None:
+            # Keyset: seek past the last row of the previous page instead of skipping
+            seek = keyset_filter(sort_by, sort_direction, after.get("value"), after.get("product_id"))
+            find_cursor = db.products.find({"$and": [query, seek]}, projection)
+        else:
+            find_cursor = db.products.find(query, projection).skip((page - 1) * limit)
+        products = await find_cursor.sort([(sort_by, sort_direction), ("product_id", sort_direction)]).limit(limit).to_list(limit)
+        
+        if len(products) == limit:
+            last = products[-1]
+            next_cursor = encode_cursor({
+                "sort_by": sort_by,
+                "sort_order": sort_order,
+                "value": last.get(sort_by),
+                "product_id": last["product_id"]
+            })
     
-    return ProductListResponse(
-        products=[ProductResponse(**p) for p in products],
+    return model_response(
+        ProductListResponse,
+        products=[render_product(p, selected) for p in products],
         total=total,
         page=page,
         limit=limit,
-        total_pages=(total + limit - 1) // limit
+        total_pages=(total + limit - 1) // limit if total is not None else None,
+        next_cursor=next_cursor,
+        truncated=truncated
     )
 
-@api_router.get("/products/featured", response_model=List[ProductResponse])
-async def get_featured_products(limit: int = 8):
-    products = await db.products.find({"featured": True}, {"_id": 0}).limit(limit).to_list(limit)
-    for p in products:
-        if isinstance(p.get("created_at"), str):
-            p["created_at"] = datetime.fromisoformat(p["created_at"])
-    return [ProductResponse(**p) for p in products]
+@api_router.get("/products/featured", response_model=List[Union[ProductResponse, Dict[str, Any]]])
+@cached_endpoint(lambda params: ["catalog"])
+async def get_featured_products(request: Request, limit: int = 8, fields: Optional[str] = None, view: Optional[str] = None):
+    selected = select_product_fields(fields, view)
+    products = await db.products.find({"featured": True}, product_projection(selected)).limit(limit).to_list(limit)
+    rendered = [render_product(p, selected) for p in products]
+    return TrustedJSONResponse(rendered) if TRUSTED_SERIALIZATION else rendered
 
 @api_router.get("/products/categories")
-async def get_categories():
+@cached_endpoint(lambda params: ["catalog"])
+async def get_categories(request: Request):
     pipeline = [
         {"$group": {"_id": "$category", "count": {"$sum": 1}}},
         {"$sort": {"count": -1}}
@@ -613,7 +2202,8 @@ async def get_categories():
     return [{"category": c["_id"], "count": c["count"]} for c in categories]
 
 @api_router.get("/products/brands")
-async def get_brands():
+@cached_endpoint(lambda params: ["catalog"])
+async def get_brands(request: Request):
     pipeline = [
         {"$group": {"_id": "$brand", "count": {"$sum": 1}}},
         {"$sort": {"_id": 1}}
@@ -621,8 +2211,13 @@ async def get_brands():
     brands = await db.products.aggregate(pipeline).to_list(100)
     return [{"brand": b["_id"], "count": b["count"]} for b in brands]
 
+@api_router.get("/products/suggest")
+async def suggest_products(q: str = Query(..., min_length=1, max_length=100), limit: int = Query(8, ge=1, le=20)):
+    return product_suggest.suggest(q, limit)
+
 @api_router.get("/products/{product_id}", response_model=ProductResponse)
-async def get_product(product_id: str):
+@cached_endpoint(lambda params: [f"product:{params['product_id']}"])
+async def get_product(request: Request, product_id: str):
     product = await db.products.find_one({"product_id": product_id}, {"_id": 0})
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
@@ -631,76 +2226,885 @@ async def get_product(product_id: str):
     return ProductResponse(**product)
 
 @api_router.post("/products", response_model=ProductResponse)
-async def create_product(product: ProductCreate, user: Dict = Depends(get_current_user)):
-    if user.get("role") not in [UserRole.ADMIN.value, UserRole.MANAGER.value]:
-        raise HTTPException(status_code=403, detail="Insufficient permissions")
-    
+async def create_product(product: ProductCreate, user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.MANAGER]))):
     product_id = f"prod_{uuid.uuid4().hex[:12]}"
     product_doc = {
         "product_id": product_id,
-        **product.model_dump(),
+        **apply_variation_totals(product.model_dump()),
         "rating": 0.0,
         "review_count": 0,
         "sold_count": 0,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "version": 1,
+        "created_at": datetime.now(timezone.utc)
     }
     
     await db.products.insert_one(product_doc)
-    product_doc["created_at"] = datetime.fromisoformat(product_doc["created_at"])
+    index_product(product_doc)
+    image_pipeline.schedule(product_doc)
+    await invalidate_catalog_cache(product_id)
     return ProductResponse(**product_doc)
 
 @api_router.put("/products/{product_id}", response_model=ProductResponse)
-async def update_product(product_id: str, product: ProductCreate, user: Dict = Depends(get_current_user)):
-    if user.get("role") not in [UserRole.ADMIN.value, UserRole.MANAGER.value]:
-        raise HTTPException(status_code=403, detail="Insufficient permissions")
-    
+async def update_product(product_id: str, product: ProductCreate, user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.MANAGER]))):
     existing = await db.products.find_one({"product_id": product_id})
     if not existing:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    await db.products.update_one(
-        {"product_id": product_id},
-        {"$set": product.model_dump()}
-    )
+    update = {"$set": apply_variation_totals(product.model_dump()), "$inc": {"version": 1}}
+    if product.images != existing.get("images"):
+        # Derivatives of the old images must not outlive them: readers fall back to the source
+        # URLs, and if the job below is lost to a restart, process-images picks the product up
+        update["$unset"] = {"image_variants": ""}
+    await db.products.update_one({"product_id": product_id}, update)
     
     updated = await db.products.find_one({"product_id": product_id}, {"_id": 0})
+    index_product(updated)
+    if updated.get("images") != existing.get("images") or not updated.get("image_variants"):
+        image_pipeline.schedule(updated)
+    await invalidate_catalog_cache(product_id)
     if isinstance(updated.get("created_at"), str):
         updated["created_at"] = datetime.fromisoformat(updated["created_at"])
     return ProductResponse(**updated)
 
 @api_router.delete("/products/{product_id}")
-async def delete_product(product_id: str, user: Dict = Depends(get_current_user)):
-    if user.get("role") not in [UserRole.ADMIN.value, UserRole.MANAGER.value]:
-        raise HTTPException(status_code=403, detail="Insufficient permissions")
-    
+async def delete_product(product_id: str, user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.MANAGER]))):
     result = await db.products.delete_one({"product_id": product_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    unindex_product(product_id)
+    await invalidate_catalog_cache(product_id)
     return {"message": "Product deleted"}
 
+# ============== PRODUCT IMPORT / EXPORT ==============
+# CSV cells hold lists as "a|b|c" and nested structures as JSON
+CSV_LIST_FIELDS = {"images", "tags"}
+CSV_JSON_FIELDS = {"specifications", "variations"}
+PRODUCT_EXPORT_FIELDS = ["product_id", *ProductCreate.model_fields, "rating", "review_count", "sold_count", "created_at"]
+
+async def _iter_lines(stream: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    buffer = b""
+    async for chunk in stream:
+        buffer += chunk
+        lines = buffer.split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            yield line.decode("utf-8-sig").rstrip("\r")
+    if buffer:
+        yield buffer.decode("utf-8-sig").rstrip("\r")
+
+async def _iter_ndjson_rows(lines: AsyncIterator[str]) -> AsyncIterator[tuple]:
+    """Yield (row_number, row_dict, error) per non-blank line"""
+    row_number = 0
+    async for line in lines:
+        if not line.strip():
+            continue
+        row_number += 1
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield row_number, None, f"invalid JSON: {e}"
+            continue
+        if not isinstance(row, dict):
+            yield row_number, None, "expected a JSON object"
+            continue
+        yield row_number, row, None
+
+async def _iter_csv_rows(lines: AsyncIterator[str]) -> AsyncIterator[tuple]:
+    """Yield (row_number, row_dict, error) per CSV record; the first record is the header"""
+    header = None
+    row_number = 0
+    pending = ""
+    async for line in lines:
+        pending = f"{pending}\n{line}" if pending else line
+        if pending.count('"') % 2:
+            continue  # a quoted cell spans lines (quotes inside cells are doubled, so parity holds)
+        record, pending = next(csv.reader([pending]), []), ""
+        if not any(cell.strip() for cell in record):
+            continue
+        if header is None:
+            header = [cell.strip() for cell in record]
+            continue
+        row_number += 1
+        row = {}
+        try:
+            for column, cell in zip(header, record):
+                if cell == "":
+                    continue
+                if column in CSV_LIST_FIELDS:
+                    row[column] = [item for item in cell.split("|") if item]
+                elif column in CSV_JSON_FIELDS:
+                    row[column] = json.loads(cell)
+                else:
+                    row[column] = cell
+        except ValueError as e:
+            yield row_number, None, f"invalid JSON cell: {e}"
+            continue
+        yield row_number, row, None
+
+async def _write_import_batch(batch: List[tuple], report: Dict[str, Any]):
+    """Upsert a batch of (row_number, product_id, ProductCreate) in one unordered bulk_write"""
+    now = datetime.now(timezone.utc)
+    operations = [
+        UpdateOne(
+            {"product_id": product_id},
+            {
+                "$set": apply_variation_totals(product.model_dump()),
+                "$inc": {"version": 1},
+                "$setOnInsert": {"product_id": product_id, "rating": 0.0, "review_count": 0, "sold_count": 0, "created_at": now}
+            },
+            upsert=True
+        )
+        for _, product_id, product in batch
+    ]
+    try:
+        result = await db.products.bulk_write(operations, ordered=False)
+        details = result.bulk_api_result
+    except BulkWriteError as e:
+        details = e.details
+        for error in details.get("writeErrors", []):
+            _record_import_error(report, batch[error["index"]][0], [error.get("errmsg", "write failed")])
+    report["inserted"] += details.get("nUpserted", 0)
+    report["updated"] += details.get("nMatched", 0)
+    await invalidate_catalog_cache(*(product_id for _, product_id, _ in batch))
+
+def _record_import_error(report: Dict[str, Any], row_number: int, errors: List[str]):
+    report["failed"] += 1
+    if len(report["errors"]) < PRODUCT_IMPORT_MAX_ERRORS:
+        report["errors"].append({"row": row_number, "errors": errors})
+    else:
+        report["errors_truncated"] = True
+
+@api_router.post("/admin/products/import")
+async def import_products(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(ndjson|csv)$"),
+    dry_run: bool = False,
+    user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.MANAGER]))
+):
+    """Stream an NDJSON or CSV body into products, upserting on product_id when a row carries one"""
+    if format is None:
+        format = "csv" if "csv" in request.headers.get("content-type", "") else "ndjson"
+    lines = _iter_lines(request.stream())
+    rows = _iter_csv_rows(lines) if format == "csv" else _iter_ndjson_rows(lines)
+    
+    report = {"format": format, "dry_run": dry_run, "rows": 0, "inserted": 0, "updated": 0,
+              "failed": 0, "errors": [], "errors_truncated": False}
+    batch = []
+    async for row_number, row, error in rows:
+        report["rows"] = row_number
+        if error:
+            _record_import_error(report, row_number, [error])
+            continue
+        try:
+            product = ProductCreate.model_validate(row)
+        except ValidationError as e:
+            _record_import_error(report, row_number, [
+                f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in e.errors()
+            ])
+            continue
+        if dry_run:
+            continue
+        product_id = str(row.get("product_id") or f"prod_{uuid.uuid4().hex[:12]}")
+        batch.append((row_number, product_id, product))
+        if len(batch) >= PRODUCT_IMPORT_BATCH_SIZE:
+            await _write_import_batch(batch, report)
+            batch = []
+    
+    if batch:
+        await _write_import_batch(batch, report)
+    if report["inserted"] or report["updated"]:
+        await rebuild_catalog_indexes()
+    return report
+
+def _export_csv_row(product: Dict) -> str:
+    cells = []
+    for field in PRODUCT_EXPORT_FIELDS:
+        value = product.get(field)
+        if value is None:
+            value = ""
+        elif field in CSV_LIST_FIELDS:
+            value = "|".join(value)
+        elif field in CSV_JSON_FIELDS:
+            value = json.dumps(value, separators=(",", ":"))
+        elif isinstance(value, datetime):
+            value = value.isoformat()
+        cells.append(value)
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerow(cells)
+    return buffer.getvalue()
+
+@api_router.get("/admin/products/export")
+async def export_products(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.MANAGER]))
+):
+    """Stream the catalog in product_id order; the output re-imports through /admin/products/import"""
+    from fastapi.responses import StreamingResponse
+    
+    async def rows():
+        if format == "csv":
+            header = io.StringIO()
+            csv.writer(header, lineterminator="\n").writerow(PRODUCT_EXPORT_FIELDS)
+            yield header.getvalue()
+        cursor = db.products.find({}, {"_id": 0}).sort("product_id", ASCENDING).batch_size(PRODUCT_EXPORT_BATCH_SIZE)
+        async for product in cursor:
+            if format == "csv":
+                yield _export_csv_row(product)
+            else:
+                yield render_json({field: product.get(field) for field in PRODUCT_EXPORT_FIELDS}) + b"\n"
+    
+    return StreamingResponse(
+        rows(),
+        media_type="text/csv" if format == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f"attachment; filename=products.{format}"}
+    )
+
+# ============== EXCHANGE RATE ROUTES ==============
+@api_router.get("/exchange-rates")
+async def get_exchange_rates():
+    return {"base": Currency.USD.value, "rates": dict(exchange_rates.rates), "updated_at": exchange_rates.updated_at}
+
+# ============== PRODUCT LOADER ==============
+class ProductLoader:
+    """Request-scoped batching loader: loads issued in the same event-loop tick are
+    coalesced into one $in query, and every product is fetched at most once per request"""
+    totals = Counter()
+
+    def __init__(self, projection: Optional[Dict] = None, batch_fn=None):
+        self.projection = projection or {"_id": 0}
+        self.batch_fn = batch_fn or self._find
+        self._memo: Dict[str, asyncio.Future] = {}
+        self._pending: List[str] = []
+        self._dispatch_task: Optional[asyncio.Task] = None
+
+    async def _find(self, product_ids: List[str]) -> List[Dict]:
+        return await db.products.find({"product_id": {"$in": product_ids}}, self.projection).to_list(None)
+
+    def load(self, product_id: str) -> "asyncio.Future[Optional[Dict]]":
+        future = self._memo.get(product_id)
+        if future is not None:
+            ProductLoader.totals["memo_hits"] += 1
+            return future
+        future = asyncio.get_running_loop().create_future()
+        self._memo[product_id] = future
+        self._pending.append(product_id)
+        if self._dispatch_task is None:
+            self._dispatch_task = asyncio.ensure_future(self._dispatch())
+        return future
+
+    async def load_many(self, product_ids: List[str]) -> List[Optional[Dict]]:
+        return list(await asyncio.gather(*(self.load(pid) for pid in product_ids)))
+
+    async def _dispatch(self):
+        # Runs on the next tick, after every load() queued by the current one
+        batch, self._pending, self._dispatch_task = self._pending, [], None
+        ProductLoader.totals["batches"] += 1
+        ProductLoader.totals["keys"] += len(batch)
+        try:
+            found = {p["product_id"]: p for p in await self.batch_fn(batch)}
+        except Exception as e:
+            for pid in batch:
+                self._memo.pop(pid).set_exception(e)
+            return
+        for pid in batch:
+            self._memo[pid].set_result(found.get(pid))
+
+    @classmethod
+    def stats(cls) -> Dict[str, Any]:
+        batches = cls.totals["batches"]
+        return {**cls.totals, "keys_per_batch": round(cls.totals["keys"] / batches, 2) if batches else 0.0}
+
+# ============== PRODUCT VARIATIONS ==============
+# Fields a cart line or order item needs; variations are narrowed to the one being bought
+PURCHASE_FIELDS = ["product_id", "name", "price_usd", "stock", "images", "image_variants", "has_variations", "version"]
+
+def apply_variation_totals(product_doc: Dict) -> Dict:
+    """Keep has_variations and the product-level stock in step with the variations"""
+    variations = product_doc.get("variations") or []
+    product_doc["has_variations"] = bool(variations)
+    if variations:
+        product_doc["stock"] = sum(v.get("stock", 0) for v in variations)
+    return product_doc
+
+def variation_label(variation: Dict) -> str:
+    return " / ".join(str(value) for value in variation.get("attributes", {}).values()) or variation.get("sku") or variation["variation_id"]
+
+def purchasable_from(product: Dict, variation_id: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Name, price and stock of what a cart line buys: the product itself or one of its variations"""
+    line = {
+        "product_id": product["product_id"],
+        "variation_id": None,
+        "name": product["name"],
+        "price_usd": product["price_usd"],
+        "stock": product.get("stock", 0),
+        "image": preferred_image(product, "thumbnail")
+    }
+    if variation_id is None:
+        return line
+    variation = next((v for v in product.get("variations", []) if v.get("variation_id") == variation_id), None)
+    if variation is None:
+        return None
+    return {
+        **line,
+        "variation_id": variation_id,
+        "name": f"{product['name']} ({variation_label(variation)})",
+        "price_usd": variation["price_usd"] if variation.get("price_usd") is not None else product["price_usd"],
+        "stock": variation.get("stock", 0)
+    }
+
+async def _load_for_purchase(product_id: str, variation_id: Optional[str]) -> Optional[Dict]:
+    query = {"product_id": product_id}
+    projection = {"_id": 0, **{field: 1 for field in PURCHASE_FIELDS}, "images": {"$slice": 1}, "image_variants": {"$slice": 1}}
+    if variation_id is not None:
+        # Matched through the variations.variation_id index; the positional projection
+        # returns only that element, never the whole array
+        query["variations.variation_id"] = variation_id
+        projection["variations.$"] = 1
+    return await db.products.find_one(query, projection)
+
+def purchase_loader(variation_ids: List[Optional[str]]) -> ProductLoader:
+    """ProductLoader for a set of cart/order lines; each product comes back with only the
+    variations those lines reference, filtered server-side in the same round trip"""
+    variation_ids = sorted(set(variation_ids) - {None})
+    project = {
+        "_id": 0, **{field: 1 for field in PURCHASE_FIELDS},
+        "images": {"$slice": ["$images", 1]},
+        "image_variants": {"$slice": ["$image_variants", 1]},
+        "variations": {"$filter": {
+            "input": {"$ifNull": ["$variations", []]},
+            "cond": {"$in": ["$$this.variation_id", variation_ids]}
+        }}
+    }
+    
+    async def fetch(product_ids: List[str]) -> List[Dict]:
+        pipeline = [{"$match": {"product_id": {"$in": product_ids}}}, {"$project": project}]
+        return await db.products.aggregate(pipeline).to_list(None)
+    
+    return ProductLoader(batch_fn=fetch)
+
+def resolve_purchasable(product: Optional[Dict], variation_id: Optional[str]) -> Dict[str, Any]:
+    """purchasable_from for a loaded product, rejecting unknown lines and products bought without a variation"""
+    line = purchasable_from(product, variation_id) if product else None
+    if line is None:
+        raise HTTPException(status_code=404, detail="Product not found" if variation_id is None else "Variation not found")
+    if variation_id is None and product.get("has_variations"):
+        raise HTTPException(status_code=400, detail=f"Select a variation of {product['name']}")
+    return line
+
+async def require_purchasable(product_id: str, variation_id: Optional[str]) -> Dict[str, Any]:
+    return resolve_purchasable(await _load_for_purchase(product_id, variation_id), variation_id)
+
+def cart_line_filter(product_id: str, variation_id: Optional[str]) -> Dict:
+    # variation_id None also matches lines stored before variations were tracked
+    return {"product_id": product_id, "variation_id": variation_id}
+
+# ============== CART MUTATIONS ==============
+# product_id -> {variation_id: purchasable line}. Per process and short-lived: the cart
+# only needs an advisory stock check, create_order re-checks against the database
+stock_snapshots = TTLCache(CART_STOCK_SNAPSHOT_MAX_ENTRIES, CART_STOCK_SNAPSHOT_TTL_SECONDS)
+
+async def snapshot_purchasable(product_id: str, variation_id: Optional[str]) -> Dict[str, Any]:
+    """require_purchasable served from the stock snapshot when it is fresh"""
+    lines = stock_snapshots.get(product_id) or {}
+    if variation_id not in lines:
+        lines = {**lines, variation_id: await require_purchasable(product_id, variation_id)}
+        stock_snapshots.set(product_id, lines)
+    return lines[variation_id]
+
+def _cart_line_stage(product_id: str, variation_id: Optional[str], quantity: int, stock: int, clamp: bool) -> Dict:
+    """$set stage adding quantity to one cart line, creating the line (or the cart, when
+    upserting) if needed. Past stock the cart is left untouched, or with clamp the line is capped at stock"""
+    is_line = {"$and": [
+        {"$eq": ["$$line.product_id", {"$literal": product_id}]},
+        {"$eq": [{"$ifNull": ["$$line.variation_id", None]}, {"$literal": variation_id}]}
+    ]}
+    in_cart = {"$sum": {"$map": {
+        "input": {"$filter": {"input": "$$items", "as": "line", "cond": is_line}},
+        "as": "line", "in": "$$line.quantity"
+    }}}
+    new_quantity = {"$add": ["$$line.quantity", quantity]}
+    added = {"$cond": [
+        {"$anyElementTrue": [{"$map": {"input": "$$items", "as": "line", "in": is_line}}]},
+        {"$map": {"input": "$$items", "as": "line", "in": {"$cond": [
+            is_line, {"$mergeObjects": ["$$line", {"quantity": {"$min": [new_quantity, stock]} if clamp else new_quantity}]}, "$$line"
+        ]}}},
+        {"$concatArrays": ["$$items", [{"$literal": {
+            "product_id": product_id, "variation_id": variation_id, "quantity": min(quantity, stock) if clamp else quantity
+        }}]]}
+    ]}
+    return {"$set": {"items": {"$let": {
+        "vars": {"items": {"$ifNull": ["$items", []]}},
+        "in": added if clamp else {"$cond": [{"$gt": [{"$add": [in_cart, quantity]}, stock]}, "$$items", added]}
+    }}}}
+
+def cart_add_pipeline(product_id: str, variation_id: Optional[str], quantity: int, stock: int) -> List[Dict]:
+    return [_cart_line_stage(product_id, variation_id, quantity, stock, clamp=False)]
+
+def cart_merge_pipeline(lines: List[Dict]) -> List[Dict]:
+    """One stage per incoming line, each capped at the stock it was priced with"""
+    return [_cart_line_stage(l["product_id"], l["variation_id"], l["quantity"], l["stock"], clamp=True) for l in lines]
+
+def _find_line(items: List[Dict], product_id: str, variation_id: Optional[str]) -> Optional[Dict]:
+    return next((i for i in items if i["product_id"] == product_id and i.get("variation_id") == variation_id), None)
+
+# The same mutations on an in-memory item list, for key-value carts and guest cookies
+def add_cart_line(items: List[Dict], product_id: str, variation_id: Optional[str], quantity: int, stock: int) -> Optional[int]:
+    line = _find_line(items, product_id, variation_id)
+    new_qty = (line["quantity"] if line else 0) + quantity
+    if new_qty > stock:
+        return None
+    if line:
+        line["quantity"] = new_qty
+    else:
+        items.append({"product_id": product_id, "variation_id": variation_id, "quantity": quantity})
+    return new_qty
+
+def set_cart_line_quantity(items: List[Dict], product_id: str, variation_id: Optional[str], quantity: int):
+    line = _find_line(items, product_id, variation_id)
+    if line:
+        line["quantity"] = quantity
+
+def remove_cart_line(items: List[Dict], product_id: str, variation_id: Optional[str]):
+    items[:] = [i for i in items if not (i["product_id"] == product_id and i.get("variation_id") == variation_id)]
+
+def set_cart_line_snapshots(items: List[Dict], snapshots: Dict[tuple, Dict]):
+    for item in items:
+        snapshot = snapshots.get((item["product_id"], item.get("variation_id")))
+        if snapshot is not None:
+            item["snapshot"] = snapshot
+
+def merge_cart_lines(items: List[Dict], lines: List[Dict]):
+    for incoming in lines:
+        line = _find_line(items, incoming["product_id"], incoming["variation_id"])
+        if line:
+            line["quantity"] = min(line["quantity"] + incoming["quantity"], incoming["stock"])
+        else:
+            items.append({"product_id": incoming["product_id"], "variation_id": incoming["variation_id"],
+                          "quantity": min(incoming["quantity"], incoming["stock"])})
+
+# ============== CART STORE ==============
+class MongoCartStore:
+    """Carts as documents in the carts collection; every mutation is one atomic update"""
+
+    async def get_items(self, user_id: str) -> List[Dict]:
+        cart = await db.carts.find_one({"user_id": user_id}, {"_id": 0, "items": 1})
+        return cart.get("items", []) if cart else []
+
+    async def add(self, user_id: str, product_id: str, variation_id: Optional[str], quantity: int, stock: int) -> Optional[int]:
+        """Add to a line and return its new quantity, or None when that would exceed stock"""
+        if quantity > stock:
+            # Over stock whatever the cart holds; skip the write so the upsert creates no empty cart
+            return None
+        # The pre-image tells us whether the pipeline's stock guard let the add through
+        before = await db.carts.find_one_and_update(
+            {"user_id": user_id},
+            cart_add_pipeline(product_id, variation_id, quantity, stock),
+            projection={"_id": 0, "items": {"$elemMatch": cart_line_filter(product_id, variation_id)}},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+        in_cart = before["items"][0]["quantity"] if before and before.get("items") else 0
+        return in_cart + quantity if in_cart + quantity <= stock else None
+
+    async def set_quantity(self, user_id: str, product_id: str, variation_id: Optional[str], quantity: int):
+        await db.carts.update_one(
+            {"user_id": user_id},
+            {"$set": {"items.$[line].quantity": quantity}},
+            array_filters=[{f"line.{field}": value for field, value in cart_line_filter(product_id, variation_id).items()}]
+        )
+
+    async def remove(self, user_id: str, product_id: str, variation_id: Optional[str]):
+        await db.carts.update_one({"user_id": user_id}, {"$pull": {"items": cart_line_filter(product_id, variation_id)}})
+
+    async def merge(self, user_id: str, lines: List[Dict]):
+        await db.carts.update_one({"user_id": user_id}, cart_merge_pipeline(lines), upsert=True)
+
+    async def save_snapshots(self, user_id: str, snapshots: Dict[tuple, Dict]):
+        """Store refreshed product snapshots on their lines in one update"""
+        update, array_filters = {}, []
+        for n, ((product_id, variation_id), snapshot) in enumerate(snapshots.items()):
+            update[f"items.$[l{n}].snapshot"] = snapshot
+            array_filters.append({f"l{n}.{field}": value for field, value in cart_line_filter(product_id, variation_id).items()})
+        await db.carts.update_one({"user_id": user_id}, {"$set": update}, array_filters=array_filters)
+
+    async def clear(self, user_id: str):
+        await db.carts.delete_one({"user_id": user_id})
+
+    async def shutdown(self):
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "mongo"}
+
+class MemoryCartKV:
+    """Per-process carts with expiry; a stand-in for a shared key-value store in tests and single-worker deployments"""
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._carts: Dict[str, tuple] = {}
+
+    async def read(self, user_id: str) -> Optional[List[Dict]]:
+        entry = self._carts.get(user_id)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    async def put_if_absent(self, user_id: str, items: List[Dict]):
+        if await self.read(user_id) is None:
+            self._carts[user_id] = (items, time.monotonic() + self.ttl_seconds)
+
+    async def modify(self, user_id: str, change):
+        """Apply change(items) to a copy of the cart and store it; no await in between keeps it atomic"""
+        items = [dict(i) for i in (await self.read(user_id) or [])]
+        result = change(items)
+        self._carts[user_id] = (items, time.monotonic() + self.ttl_seconds)
+        return result
+
+    async def delete(self, user_id: str):
+        self._carts.pop(user_id, None)
+
+    async def purge(self):
+        now = time.monotonic()
+        for user_id in [uid for uid, (_, deadline) in self._carts.items() if deadline <= now]:
+            del self._carts[user_id]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "memory", "carts": len(self._carts)}
+
+class SQLiteCartKV:
+    """Local key-value store shared by every worker on the host, standing in for Redis"""
+
+    def __init__(self, path: str, ttl_seconds: float):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS carts (user_id TEXT PRIMARY KEY, items TEXT, expires_at REAL)")
+        return self._conn
+
+    def _read(self, user_id: str) -> Optional[List[Dict]]:
+        with self._lock:
+            row = self._connection().execute("SELECT items, expires_at FROM carts WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return json.loads(row[0])
+
+    def _put_if_absent(self, user_id: str, items: List[Dict]):
+        with self._lock:
+            self._connection().execute(
+                "INSERT INTO carts (user_id, items, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET items = excluded.items, expires_at = excluded.expires_at "
+                "WHERE carts.expires_at <= ?",
+                (user_id, json.dumps(items), time.time() + self.ttl_seconds, time.time())
+            )
+
+    def _modify(self, user_id: str, change):
+        with self._lock:
+            conn = self._connection()
+            # IMMEDIATE takes the write lock up front, so workers on other processes queue behind us
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT items, expires_at FROM carts WHERE user_id = ?", (user_id,)).fetchone()
+                items = json.loads(row[0]) if row and row[1] > time.time() else []
+                result = change(items)
+                conn.execute(
+                    "INSERT OR REPLACE INTO carts (user_id, items, expires_at) VALUES (?, ?, ?)",
+                    (user_id, json.dumps(items), time.time() + self.ttl_seconds)
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def _delete(self, user_id: str):
+        with self._lock:
+            self._connection().execute("DELETE FROM carts WHERE user_id = ?", (user_id,))
+
+    def _purge(self):
+        with self._lock:
+            self._connection().execute("DELETE FROM carts WHERE expires_at <= ?", (time.time(),))
+
+    async def read(self, user_id: str) -> Optional[List[Dict]]:
+        return await asyncio.to_thread(self._read, user_id)
+
+    async def put_if_absent(self, user_id: str, items: List[Dict]):
+        await asyncio.to_thread(self._put_if_absent, user_id, items)
+
+    async def modify(self, user_id: str, change):
+        return await asyncio.to_thread(self._modify, user_id, change)
+
+    async def delete(self, user_id: str):
+        await asyncio.to_thread(self._delete, user_id)
+
+    async def purge(self):
+        await asyncio.to_thread(self._purge)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "sqlite", "path": self.path}
+
+class KeyValueCartStore:
+    """Carts kept in a key-value store with sliding expiry.
+
+    With write-behind enabled, carts changed since the last flush are snapshotted to the
+    carts collection in one bulk write, and a cart missing from the store (restart,
+    eviction) is hydrated from its snapshot on first use.
+    """
+
+    def __init__(self, kv, ttl_seconds: float, write_behind: bool):
+        self.kv = kv
+        self.ttl_seconds = ttl_seconds
+        self.write_behind = write_behind
+        self._dirty: set = set()
+        self.flushes = 0
+        self.flushed_carts = 0
+        self.hydrations = 0
+
+    async def _load(self, user_id: str) -> List[Dict]:
+        items = await self.kv.read(user_id)
+        # Only a truly missing key hydrates; a cleared cart is an empty list until it expires
+        if items is None and self.write_behind:
+            snapshot = await db.carts.find_one(
+                {"user_id": user_id, "$or": [{"expires_at": {"$gt": datetime.now(timezone.utc)}}, {"expires_at": {"$exists": False}}]},
+                {"_id": 0, "items": 1}
+            )
+            if snapshot and snapshot.get("items"):
+                self.hydrations += 1
+                await self.kv.put_if_absent(user_id, snapshot["items"])
+                items = await self.kv.read(user_id)
+        return items or []
+
+    async def _modify(self, user_id: str, change):
+        await self._load(user_id)
+        result = await self.kv.modify(user_id, change)
+        if self.write_behind:
+            self._dirty.add(user_id)
+        return result
+
+    async def get_items(self, user_id: str) -> List[Dict]:
+        return await self._load(user_id)
+
+    async def add(self, user_id: str, product_id: str, variation_id: Optional[str], quantity: int, stock: int) -> Optional[int]:
+        return await self._modify(user_id, lambda items: add_cart_line(items, product_id, variation_id, quantity, stock))
+
+    async def set_quantity(self, user_id: str, product_id: str, variation_id: Optional[str], quantity: int):
+        await self._modify(user_id, lambda items: set_cart_line_quantity(items, product_id, variation_id, quantity))
+
+    async def remove(self, user_id: str, product_id: str, variation_id: Optional[str]):
+        await self._modify(user_id, lambda items: remove_cart_line(items, product_id, variation_id))
+
+    async def merge(self, user_id: str, lines: List[Dict]):
+        await self._modify(user_id, lambda items: merge_cart_lines(items, lines))
+
+    async def save_snapshots(self, user_id: str, snapshots: Dict[tuple, Dict]):
+        await self._modify(user_id, lambda items: set_cart_line_snapshots(items, snapshots))
+
+    async def clear(self, user_id: str):
+        if not self.write_behind:
+            await self.kv.delete(user_id)
+            return
+        # Keep an empty cart as a tombstone so the stale Mongo snapshot is not rehydrated
+        # before the next flush deletes it
+        await self.kv.modify(user_id, lambda items: items.clear())
+        self._dirty.add(user_id)
+
+    async def flush(self) -> int:
+        """Snapshot every cart changed since the last flush to Mongo in one bulk write"""
+        dirty, self._dirty = self._dirty, set()
+        if not dirty:
+            return 0
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.ttl_seconds)
+        ops = []
+        for user_id in dirty:
+            items = await self.kv.read(user_id)
+            if items:
+                ops.append(UpdateOne({"user_id": user_id}, {"$set": {"items": items, "expires_at": expires_at}}, upsert=True))
+            else:
+                ops.append(DeleteOne({"user_id": user_id}))
+        try:
+            await db.carts.bulk_write(ops, ordered=False)
+        except Exception:
+            self._dirty |= dirty  # retried on the next flush
+            raise
+        self.flushes += 1
+        self.flushed_carts += len(ops)
+        return len(ops)
+
+    async def maintain(self):
+        await self.kv.purge()
+        if self.write_behind:
+            await self.flush()
+
+    async def shutdown(self):
+        if self.write_behind:
+            await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.kv.stats(),
+            "ttl_seconds": self.ttl_seconds,
+            "write_behind": self.write_behind,
+            "dirty": len(self._dirty),
+            "flushes": self.flushes,
+            "flushed_carts": self.flushed_carts,
+            "hydrations": self.hydrations
+        }
+
+def _create_cart_store():
+    write_behind = CART_WRITE_BEHIND_SECONDS > 0
+    if CART_STORE_BACKEND == "memory":
+        return KeyValueCartStore(MemoryCartKV(CART_TTL_SECONDS), CART_TTL_SECONDS, write_behind)
+    if CART_STORE_BACKEND == "sqlite":
+        return KeyValueCartStore(SQLiteCartKV(CART_STORE_SQLITE_PATH, CART_TTL_SECONDS), CART_TTL_SECONDS, write_behind)
+    return MongoCartStore()
+
+cart_store = _create_cart_store()
+
+# ============== GUEST CARTS ==============
+# Anonymous carts live entirely in a signed cookie, so browsing never writes to the carts collection
+GUEST_CART_COOKIE = "guest_cart"
+
+def _b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _guest_cart_signature(payload: str) -> str:
+    return _b64url(hmac.new(GUEST_CART_SECRET.encode("utf-8"), payload.encode("ascii"), hashlib.sha256).digest()[:16])
+
+def encode_guest_cart(items: List[Dict]) -> str:
+    lines = [[i["product_id"], i.get("variation_id"), i["quantity"]] for i in items]
+    payload = _b64url(json.dumps([int(time.time()) + GUEST_CART_MAX_AGE_SECONDS, lines], separators=(",", ":")).encode("utf-8"))
+    return f"{payload}.{_guest_cart_signature(payload)}"
+
+def decode_guest_cart(cookie: Optional[str]) -> List[Dict]:
+    """Lines of a guest cart cookie; anything tampered with, malformed or expired reads as an empty cart"""
+    if not cookie or "." not in cookie:
+        return []
+    payload, signature = cookie.rsplit(".", 1)
+    if not hmac.compare_digest(signature, _guest_cart_signature(payload)):
+        return []
+    try:
+        expires_at, lines = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        if expires_at < time.time():
+            return []
+        return [{"product_id": str(pid), "variation_id": vid, "quantity": int(qty)} for pid, vid, qty in lines[:GUEST_CART_MAX_LINES]]
+    except (ValueError, TypeError):
+        return []
+
+def guest_cart_items(request: Request) -> List[Dict]:
+    return decode_guest_cart(request.cookies.get(GUEST_CART_COOKIE))
+
+def write_guest_cart(response: Response, items: List[Dict]):
+    if not items:
+        response.delete_cookie(GUEST_CART_COOKIE, path="/", secure=True, samesite="none")
+        return
+    value = encode_guest_cart(items)
+    if len(items) > GUEST_CART_MAX_LINES or len(value) > GUEST_CART_MAX_COOKIE_BYTES:
+        raise HTTPException(status_code=400, detail="Guest cart is full, sign in to add more items")
+    response.set_cookie(
+        GUEST_CART_COOKIE, value, max_age=GUEST_CART_MAX_AGE_SECONDS,
+        path="/", httponly=True, secure=True, samesite="none"
+    )
+
+async def merge_guest_cart(request: Request, response: Response, user_id: str):
+    """Fold the guest cart cookie into the user's cart with one store operation, then drop the cookie"""
+    guest_items = guest_cart_items(request)
+    if not guest_items:
+        return
+    loader = purchase_loader([item["variation_id"] for item in guest_items])
+    products = await loader.load_many([item["product_id"] for item in guest_items])
+    lines = []
+    for item, product in zip(guest_items, products):
+        line = purchasable_from(product, item["variation_id"]) if product else None
+        if line and line["stock"] > 0:
+            lines.append({**item, "stock": line["stock"]})
+    if lines:
+        await cart_store.merge(user_id, lines)
+    write_guest_cart(response, [])
+
+# ============== CART SNAPSHOTS ==============
+# Every write that can change what a cart line shows (name, price, images, stock) bumps
+# the product's version, so a line's snapshot is current while the versions match
+PRODUCT_VERSION_INDEX = [("product_id", ASCENDING), ("version", ASCENDING)]
+CART_SNAPSHOT_FIELDS = ["name", "price_usd", "image", "stock"]
+
+async def product_versions(product_ids: List[str]) -> Dict[str, int]:
+    """Current version of each product, answered from the (product_id, version) index alone"""
+    query = {"product_id": {"$in": product_ids}}
+    projection = {"_id": 0, "product_id": 1, "version": 1}
+    try:
+        docs = await db.products.find(query, projection).hint(PRODUCT_VERSION_INDEX).to_list(None)
+    except OperationFailure:
+        # Index not built yet; same answer, read from the documents
+        docs = await db.products.find(query, projection).to_list(None)
+    return {d["product_id"]: d.get("version", 0) for d in docs}
+
+async def snapshot_cart_lines(user_id: str, cart_items: List[Dict]) -> List[Dict]:
+    """Priced cart lines from their stored snapshots, re-reading only products whose
+    version moved on; lines whose product or variation is gone are left out"""
+    versions = await product_versions(sorted({item["product_id"] for item in cart_items}))
+    stale = [
+        item for item in cart_items
+        if item["product_id"] in versions and (item.get("snapshot") or {}).get("version") != versions[item["product_id"]]
+    ]
+    refreshed = {}
+    if stale:
+        loader = purchase_loader([item.get("variation_id") for item in stale])
+        products = await loader.load_many([item["product_id"] for item in stale])
+        for item, product in zip(stale, products):
+            line = purchasable_from(product, item.get("variation_id")) if product else None
+            if line:
+                refreshed[(item["product_id"], item.get("variation_id"))] = {
+                    **{field: line[field] for field in CART_SNAPSHOT_FIELDS}, "version": product.get("version", 0)
+                }
+        if refreshed:
+            await cart_store.save_snapshots(user_id, refreshed)
+    
+    stale_keys = {(item["product_id"], item.get("variation_id")) for item in stale}
+    lines = []
+    for item in cart_items:
+        key = (item["product_id"], item.get("variation_id"))
+        if item["product_id"] not in versions:
+            continue
+        snapshot = refreshed.get(key) if key in stale_keys else item["snapshot"]
+        if snapshot:
+            lines.append({
+                "product_id": item["product_id"],
+                "variation_id": item.get("variation_id"),
+                **{field: snapshot[field] for field in CART_SNAPSHOT_FIELDS},
+                "quantity": item["quantity"]
+            })
+    return lines
+
 # ============== CART ROUTES ==============
 @api_router.get("/cart", response_model=CartResponse)
-async def get_cart(user: Dict = Depends(get_current_user), currency: Currency = Currency.KES):
-    cart = await db.carts.find_one({"user_id": user["user_id"]}, {"_id": 0})
-    if not cart or not cart.get("items"):
+async def get_cart(request: Request, user: Optional[Dict] = Depends(get_optional_user), currency: Currency = Currency.KES):
+    cart_items = guest_cart_items(request) if user is None else await cart_store.get_items(user["user_id"])
+    if not cart_items:
         return CartResponse(items=[], subtotal_usd=0, currency=currency, subtotal_local=0)
     
     items_with_details = []
     subtotal = 0
     
-    for item in cart["items"]:
-        product = await db.products.find_one({"product_id": item["product_id"]}, {"_id": 0})
-        if product:
-            item_total = product["price_usd"] * item["quantity"]
-            subtotal += item_total
-            items_with_details.append({
-                "product_id": product["product_id"],
-                "name": product["name"],
-                "price_usd": product["price_usd"],
-                "quantity": item["quantity"],
-                "image": product["images"][0] if product.get("images") else None,
-                "stock": product["stock"]
-            })
+    if user is None:
+        # Guest carts carry no snapshots; the cookie is small, so price them in one batch
+        loader = purchase_loader([item.get("variation_id") for item in cart_items])
+        products = await loader.load_many([item["product_id"] for item in cart_items])
+        lines = []
+        for item, product in zip(cart_items, products):
+            line = purchasable_from(product, item.get("variation_id")) if product else None
+            if line:
+                lines.append({**line, "quantity": item["quantity"]})
+    else:
+        lines = await snapshot_cart_lines(user["user_id"], cart_items)
+    
+    for line in lines:
+        subtotal += line["price_usd"] * line["quantity"]
+        items_with_details.append(line)
     
     return CartResponse(
         items=items_with_details,
@@ -710,85 +3114,184 @@ async def get_cart(user: Dict = Depends(get_current_user), currency: Currency =
     )
 
 @api_router.post("/cart/add")
-async def add_to_cart(item: CartItem, user: Dict = Depends(get_current_user)):
-    product = await db.products.find_one({"product_id": item.product_id})
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    if product["stock"] < item.quantity:
+async def add_to_cart(item: CartItem, request: Request, response: Response, user: Optional[Dict] = Depends(get_optional_user)):
+    if item.quantity < 1:
+        raise HTTPException(status_code=400, detail="Quantity must be at least 1")
+    line = await snapshot_purchasable(item.product_id, item.variation_id)
+    if line["stock"] < item.quantity:
         raise HTTPException(status_code=400, detail="Insufficient stock")
     
-    cart = await db.carts.find_one({"user_id": user["user_id"]})
-    
-    if not cart:
-        await db.carts.insert_one({
-            "user_id": user["user_id"],
-            "items": [{"product_id": item.product_id, "quantity": item.quantity}]
-        })
-    else:
-        existing_item = next((i for i in cart["items"] if i["product_id"] == item.product_id), None)
-        if existing_item:
-            new_qty = existing_item["quantity"] + item.quantity
-            if new_qty > product["stock"]:
-                raise HTTPException(status_code=400, detail="Insufficient stock")
-            await db.carts.update_one(
-                {"user_id": user["user_id"], "items.product_id": item.product_id},
-                {"$set": {"items.$.quantity": new_qty}}
-            )
-        else:
-            await db.carts.update_one(
-                {"user_id": user["user_id"]},
-                {"$push": {"items": {"product_id": item.product_id, "quantity": item.quantity}}}
-            )
+    if user is None:
+        items = guest_cart_items(request)
+        if add_cart_line(items, item.product_id, item.variation_id, item.quantity, line["stock"]) is None:
+            raise HTTPException(status_code=400, detail="Insufficient stock")
+        write_guest_cart(response, items)
+    elif await cart_store.add(user["user_id"], item.product_id, item.variation_id, item.quantity, line["stock"]) is None:
+        raise HTTPException(status_code=400, detail="Insufficient stock")
     
     return {"message": "Added to cart"}
 
 @api_router.put("/cart/update")
-async def update_cart_item(item: CartItem, user: Dict = Depends(get_current_user)):
-    product = await db.products.find_one({"product_id": item.product_id})
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    
+async def update_cart_item(item: CartItem, request: Request, response: Response, user: Optional[Dict] = Depends(get_optional_user)):
+    guest_items = guest_cart_items(request) if user is None else None
     if item.quantity == 0:
-        await db.carts.update_one(
-            {"user_id": user["user_id"]},
-            {"$pull": {"items": {"product_id": item.product_id}}}
-        )
+        # Removing needs no product lookup, so lines for deleted products can be dropped too
+        if user is None:
+            remove_cart_line(guest_items, item.product_id, item.variation_id)
+        else:
+            await cart_store.remove(user["user_id"], item.product_id, item.variation_id)
     else:
-        if item.quantity > product["stock"]:
+        line = await snapshot_purchasable(item.product_id, item.variation_id)
+        if item.quantity > line["stock"]:
             raise HTTPException(status_code=400, detail="Insufficient stock")
-        await db.carts.update_one(
-            {"user_id": user["user_id"], "items.product_id": item.product_id},
-            {"$set": {"items.$.quantity": item.quantity}}
-        )
+        if user is None:
+            set_cart_line_quantity(guest_items, item.product_id, item.variation_id, item.quantity)
+        else:
+            await cart_store.set_quantity(user["user_id"], item.product_id, item.variation_id, item.quantity)
     
+    if user is None:
+        write_guest_cart(response, guest_items)
     return {"message": "Cart updated"}
 
 @api_router.delete("/cart/clear")
-async def clear_cart(user: Dict = Depends(get_current_user)):
-    await db.carts.delete_one({"user_id": user["user_id"]})
+async def clear_cart(response: Response, user: Optional[Dict] = Depends(get_optional_user)):
+    if user is None:
+        write_guest_cart(response, [])
+    else:
+        await cart_store.clear(user["user_id"])
     return {"message": "Cart cleared"}
 
+# ============== STOCK RESERVATION ==============
+class InsufficientStock(Exception):
+    pass
+
+_stock_transactions: Dict[str, bool] = {}
+
+async def stock_transactions_enabled() -> bool:
+    """Multi-document transactions need a replica set or sharded cluster; 'auto' asks the server once"""
+    if ORDER_STOCK_TRANSACTIONS != "auto":
+        return ORDER_STOCK_TRANSACTIONS == "on"
+    if "enabled" not in _stock_transactions:
+        hello = await client.admin.command("hello")
+        _stock_transactions["enabled"] = "setName" in hello or hello.get("msg") == "isdbgrid"
+    return _stock_transactions["enabled"]
+
+def stock_decrement(product_id: str, variation_id: Optional[str], quantity: int, order_id: Optional[str] = None) -> UpdateOne:
+    """Decrement that only matches while at least quantity is left. With order_id it also
+    leaves a reservation marker, so a compensating rollback releases exactly what it took"""
+    if variation_id is None:
+        query = {"product_id": product_id, "stock": {"$gte": quantity}}
+        update = {"$inc": {"stock": -quantity, "version": 1}}
+    else:
+        query = {"product_id": product_id, "variations": {"$elemMatch": {"variation_id": variation_id, "stock": {"$gte": quantity}}}}
+        update = {"$inc": {"variations.$.stock": -quantity, "stock": -quantity, "version": 1}}
+    if order_id is not None:
+        update["$push"] = {"stock_reservations": {
+            "order_id": order_id, "variation_id": variation_id, "quantity": quantity, "reserved_at": datetime.now(timezone.utc)
+        }}
+    return UpdateOne(query, update)
+
+def stock_release(product_id: str, variation_id: Optional[str], quantity: int, order_id: str) -> UpdateOne:
+    """Undo a stock_decrement; matches nothing unless that decrement's marker is still there"""
+    marker = {"order_id": order_id, "variation_id": variation_id}
+    update = {"$inc": {"stock": quantity, "version": 1}, "$pull": {"stock_reservations": marker}}
+    array_filters = None
+    if variation_id is not None:
+        update["$inc"]["variations.$[v].stock"] = quantity
+        array_filters = [{"v.variation_id": variation_id}]
+    return UpdateOne({"product_id": product_id, "stock_reservations": {"$elemMatch": marker}}, update, array_filters=array_filters)
+
+async def place_order(order_doc: Dict, quantities: Dict[tuple, int]):
+    """Take stock for every (product_id, variation_id) and insert the order, all or nothing.
+
+    The conditional decrements go out as one bulk_write. Inside a transaction a shortfall
+    aborts everything; without one, the decrements that did apply are released again.
+    """
+    if await stock_transactions_enabled():
+        decrements = [stock_decrement(pid, vid, qty) for (pid, vid), qty in quantities.items()]
+        
+        async def reserve_and_insert(session):
+            result = await db.products.bulk_write(decrements, ordered=False, session=session)
+            if result.modified_count < len(decrements):
+                raise InsufficientStock()
+            await db.orders.insert_one(order_doc, session=session)
+        
+        # with_transaction retries write conflicts between concurrent checkouts
+        async with await client.start_session() as session:
+            await session.with_transaction(reserve_and_insert)
+        return
+    
+    order_id = order_doc["order_id"]
+    try:
+        # Inside the try: a bulk write that errors part way has still applied some decrements,
+        # and stock_release only matches the ones whose marker was written
+        result = await db.products.bulk_write(
+            [stock_decrement(pid, vid, qty, order_id) for (pid, vid), qty in quantities.items()], ordered=False
+        )
+        if result.modified_count < len(quantities):
+            raise InsufficientStock()
+        await db.orders.insert_one(order_doc)
+    except BaseException:
+        await db.products.bulk_write(
+            [stock_release(pid, vid, qty, order_id) for (pid, vid), qty in quantities.items()], ordered=False
+        )
+        raise
+    await db.products.bulk_write(
+        [UpdateOne({"product_id": pid}, {"$pull": {"stock_reservations": {"order_id": order_id}}}) for pid in {pid for pid, _ in quantities}],
+        ordered=False
+    )
+
+async def release_stale_reservations(older_than_seconds: int) -> Dict[str, int]:
+    """Settle reservation markers left by a worker that died mid-checkout: stock goes back
+    when the order was never inserted, otherwise only the marker is dropped"""
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=older_than_seconds)
+    report = {"released": 0, "settled": 0}
+    cursor = db.products.find({"stock_reservations.reserved_at": {"$lt": cutoff}}, {"_id": 0, "product_id": 1, "stock_reservations": 1})
+    async for product in cursor:
+        for marker in product["stock_reservations"]:
+            if marker["reserved_at"] >= cutoff:
+                continue
+            if await db.orders.find_one({"order_id": marker["order_id"]}, {"_id": 1}):
+                await db.products.update_one(
+                    {"product_id": product["product_id"]},
+                    {"$pull": {"stock_reservations": {"order_id": marker["order_id"], "variation_id": marker["variation_id"]}}}
+                )
+                report["settled"] += 1
+            else:
+                await db.products.bulk_write([stock_release(product["product_id"], marker["variation_id"], marker["quantity"], marker["order_id"])])
+                report["released"] += 1
+    return report
+
 # ============== ORDER ROUTES ==============
 @api_router.post("/orders", response_model=OrderResponse)
 async def create_order(order_data: OrderCreate, user: Dict = Depends(get_current_user)):
     items = []
     subtotal = 0
-    
-    for cart_item in order_data.items:
-        product = await db.products.find_one({"product_id": cart_item.product_id}, {"_id": 0})
-        if not product:
-            raise HTTPException(status_code=404, detail=f"Product {cart_item.product_id} not found")
-        if product["stock"] < cart_item.quantity:
-            raise HTTPException(status_code=400, detail=f"Insufficient stock for {product['name']}")
+    quantities: Dict[tuple, int] = {}
+    names: Dict[tuple, str] = {}
+    
+    loader = purchase_loader([cart_item.variation_id for cart_item in order_data.items])
+    products = await loader.load_many([cart_item.product_id for cart_item in order_data.items])
+    for cart_item, product in zip(order_data.items, products):
+        if cart_item.quantity < 1:
+            raise HTTPException(status_code=400, detail="Quantity must be at least 1")
+        line = resolve_purchasable(product, cart_item.variation_id)
+        key = (line["product_id"], line["variation_id"])
+        quantities[key] = quantities.get(key, 0) + cart_item.quantity
+        names[key] = line["name"]
+        # Early rejection only; place_order's conditional decrements are what prevent overselling
+        if line["stock"] < quantities[key]:
+            raise HTTPException(status_code=400, detail=f"Insufficient stock for {line['name']}")
         
-        item_total = product["price_usd"] * cart_item.quantity
+        item_total = line["price_usd"] * cart_item.quantity
         subtotal += item_total
         
         items.append(OrderItem(
-            product_id=product["product_id"],
-            product_name=product["name"],
+            product_id=line["product_id"],
+            variation_id=line["variation_id"],
+            product_name=line["name"],
             quantity=cart_item.quantity,
-            price_usd=product["price_usd"]
+            price_usd=line["price_usd"]
         ))
     
     shipping = 5.0 if order_data.shipping_country == "Kenya" else 25.0
@@ -803,6 +3306,7 @@ async def create_order(order_data: OrderCreate, user: Dict = Depends(get_current
         "shipping_usd": shipping,
         "total_usd": round(total, 2),
         "currency": order_data.currency.value,
+        "exchange_rate": exchange_rates.rate(order_data.currency),
         "total_local": convert_currency(total, order_data.currency),
         "status": OrderStatus.PENDING.value,
         "payment_status": PaymentStatus.PENDING.value,
@@ -813,24 +3317,20 @@ async def create_order(order_data: OrderCreate, user: Dict = Depends(get_current
         "phone": order_data.phone,
         "notes": order_data.notes,
         "tracking_number": None,
-        "created_at": datetime.now(timezone.utc).isoformat(),
-        "updated_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc),
+        "updated_at": datetime.now(timezone.utc)
     }
     
-    await db.orders.insert_one(order_doc)
-    
-    # Reserve stock
-    for cart_item in order_data.items:
-        await db.products.update_one(
-            {"product_id": cart_item.product_id},
-            {"$inc": {"stock": -cart_item.quantity}}
-        )
+    try:
+        await place_order(order_doc, quantities)
+    except InsufficientStock:
+        # Another checkout took the stock between our read and the decrement
+        detail = f"Insufficient stock for {next(iter(names.values()))}" if len(names) == 1 else f"Insufficient stock for one of: {', '.join(names.values())}"
+        raise HTTPException(status_code=400, detail=detail)
+    await invalidate_catalog_cache(*{pid for pid, _ in quantities})
     
     # Clear cart
-    await db.carts.delete_one({"user_id": user["user_id"]})
-    
-    order_doc["created_at"] = datetime.fromisoformat(order_doc["created_at"])
-    order_doc["updated_at"] = datetime.fromisoformat(order_doc["updated_at"])
+    await cart_store.clear(user["user_id"])
     
     return OrderResponse(**order_doc)
 
@@ -848,6 +3348,8 @@ async def get_orders(user: Dict = Depends(get_current_user), limit: int = 50):
         if isinstance(o.get("updated_at"), str):
             o["updated_at"] = datetime.fromisoformat(o["updated_at"])
     
+    if TRUSTED_SERIALIZATION:
+        return TrustedJSONResponse([dump_trusted(OrderResponse, o) for o in orders])
     return [OrderResponse(**o) for o in orders]
 
 @api_router.get("/orders/{order_id}", response_model=OrderResponse)
@@ -868,13 +3370,10 @@ async def get_order(order_id: str, user: Dict = Depends(get_current_user)):
     return OrderResponse(**order)
 
 @api_router.put("/orders/{order_id}/status")
-async def update_order_status(order_id: str, status: OrderStatus, user: Dict = Depends(get_current_user)):
-    if user.get("role") not in [UserRole.ADMIN.value, UserRole.MANAGER.value, UserRole.SALES.value, UserRole.WAREHOUSE.value]:
-        raise HTTPException(status_code=403, detail="Insufficient permissions")
-    
+async def update_order_status(order_id: str, status: OrderStatus, user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.MANAGER, UserRole.SALES, UserRole.WAREHOUSE]))):
     result = await db.orders.update_one(
         {"order_id": order_id},
-        {"$set": {"status": status.value, "updated_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {"status": status.value, "updated_at": datetime.now(timezone.utc)}}
     )
     
     if result.matched_count == 0:
@@ -925,7 +3424,7 @@ async def create_stripe_checkout(request: CheckoutSessionRequest, http_request:
         "currency": "USD",
         "payment_method": PaymentMethod.STRIPE.value,
         "payment_status": PaymentStatus.INITIATED.value,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     })
     
     return {"url": session.url, "session_id": session.session_id}
@@ -950,7 +3449,7 @@ async def get_stripe_status(session_id: str, user: Dict = Depends(get_current_us
                 {"$set": {
                     "payment_status": PaymentStatus.COMPLETED.value,
                     "status": OrderStatus.PROCESSING.value,
-                    "updated_at": datetime.now(timezone.utc).isoformat()
+                    "updated_at": datetime.now(timezone.utc)
                 }}
             )
             
@@ -962,6 +3461,7 @@ async def get_stripe_status(session_id: str, user: Dict = Depends(get_current_us
                         {"product_id": item["product_id"]},
                         {"$inc": {"sold_count": item["quantity"]}}
                     )
+                await invalidate_catalog_cache(*(item["product_id"] for item in order["items"]))
                 
                 # Add loyalty points (1 point per $1 spent)
                 points_earned = int(order["total_usd"])
@@ -969,6 +3469,7 @@ async def get_stripe_status(session_id: str, user: Dict = Depends(get_current_us
                     {"user_id": order["user_id"]},
                     {"$inc": {"loyalty_points": points_earned}}
                 )
+                invalidate_user_cache(order["user_id"])
                 await db.loyalty_transactions.insert_one({
                     "transaction_id": f"loyalty_{uuid.uuid4().hex[:12]}",
                     "user_id": order["user_id"],
@@ -976,7 +3477,7 @@ async def get_stripe_status(session_id: str, user: Dict = Depends(get_current_us
                     "points": points_earned,
                     "order_id": order["order_id"],
                     "description": f"Earned {points_earned} points from order {order['order_id']}",
-                    "created_at": datetime.now(timezone.utc).isoformat()
+                    "created_at": datetime.now(timezone.utc)
                 })
     
     return CheckoutStatusResponse(
@@ -1010,7 +3511,7 @@ async def stripe_webhook(request: Request):
                     {"$set": {
                         "payment_status": PaymentStatus.COMPLETED.value,
                         "status": OrderStatus.PROCESSING.value,
-                        "updated_at": datetime.now(timezone.utc).isoformat()
+                        "updated_at": datetime.now(timezone.utc)
                     }}
                 )
         
@@ -1051,7 +3552,7 @@ async def create_review(review: ReviewCreate, user: Dict = Depends(get_current_u
         "user_name": user["name"],
         "rating": review.rating,
         "comment": review.comment,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
     
     await db.reviews.insert_one(review_doc)
@@ -1067,12 +3568,15 @@ async def create_review(review: ReviewCreate, user: Dict = Depends(get_current_u
             {"product_id": review.product_id},
             {"$set": {"rating": round(result[0]["avg_rating"], 1), "review_count": result[0]["count"]}}
         )
+        await invalidate_catalog_cache(review.product_id)
+    if response_cache is not None:
+        await response_cache.invalidate(f"reviews:{review.product_id}")
     
-    review_doc["created_at"] = datetime.fromisoformat(review_doc["created_at"])
     return ReviewResponse(**review_doc)
 
 @api_router.get("/reviews/{product_id}", response_model=List[ReviewResponse])
-async def get_reviews(product_id: str):
+@cached_endpoint(lambda params: [f"reviews:{params['product_id']}"])
+async def get_reviews(request: Request, product_id: str):
     reviews = await db.reviews.find({"product_id": product_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
     for r in reviews:
         if isinstance(r.get("created_at"), str):
@@ -1081,10 +3585,7 @@ async def get_reviews(product_id: str):
 
 # ============== ADMIN DASHBOARD ROUTES ==============
 @api_router.get("/admin/stats", response_model=DashboardStats)
-async def get_dashboard_stats(user: Dict = Depends(get_current_user)):
-    if user.get("role") not in [UserRole.ADMIN.value, UserRole.MANAGER.value, UserRole.ACCOUNTANT.value]:
-        raise HTTPException(status_code=403, detail="Insufficient permissions")
-    
+async def get_dashboard_stats(user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.MANAGER, UserRole.ACCOUNTANT]))):
     today_start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
     
     # Total revenue
@@ -1099,7 +3600,7 @@ async def get_dashboard_stats(user: Dict = Depends(get_current_user)):
     today_pipeline = [
         {"$match": {
             "payment_status": PaymentStatus.COMPLETED.value,
-            "created_at": {"$gte": today_start.isoformat()}
+            **since_filter("created_at", today_start)
         }},
         {"$group": {"_id": None, "total": {"$sum": "$total_usd"}, "count": {"$sum": 1}}}
     ]
@@ -1126,14 +3627,11 @@ async def get_dashboard_stats(user: Dict = Depends(get_current_user)):
 
 @api_router.get("/admin/inventory")
 async def get_inventory(
-    user: Dict = Depends(get_current_user),
+    user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.MANAGER, UserRole.WAREHOUSE])),
     page: int = 1,
     limit: int = 20,
     low_stock_only: bool = False
 ):
-    if user.get("role") not in [UserRole.ADMIN.value, UserRole.MANAGER.value, UserRole.WAREHOUSE.value]:
-        raise HTTPException(status_code=403, detail="Insufficient permissions")
-    
     query = {"stock": {"$lte": 5}} if low_stock_only else {}
     
     skip = (page - 1) * limit
@@ -1148,26 +3646,40 @@ async def get_inventory(
     }
 
 @api_router.put("/admin/inventory/{product_id}/stock")
-async def update_stock(product_id: str, stock: int, user: Dict = Depends(get_current_user)):
-    if user.get("role") not in [UserRole.ADMIN.value, UserRole.MANAGER.value, UserRole.WAREHOUSE.value]:
-        raise HTTPException(status_code=403, detail="Insufficient permissions")
-    
-    result = await db.products.update_one(
-        {"product_id": product_id},
-        {"$set": {"stock": stock}}
-    )
+async def update_stock(product_id: str, stock: int, variation_id: Optional[str] = None, user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.MANAGER, UserRole.WAREHOUSE]))):
+    if variation_id is None:
+        result = await db.products.update_one(
+            {"product_id": product_id, "has_variations": {"$ne": True}},
+            {"$set": {"stock": stock}, "$inc": {"version": 1}}
+        )
+    else:
+        # Set the variation and re-derive the product total in the same atomic update
+        result = await db.products.update_one(
+            {"product_id": product_id, "variations.variation_id": variation_id},
+            [
+                {"$set": {"variations": {"$map": {
+                    "input": "$variations",
+                    "in": {"$cond": [
+                        {"$eq": ["$$this.variation_id", variation_id]},
+                        {"$mergeObjects": ["$$this", {"stock": stock}]},
+                        "$$this"
+                    ]}
+                }}}},
+                {"$set": {"stock": {"$sum": "$variations.stock"}, "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}}}
+            ]
+        )
     
     if result.matched_count == 0:
+        if variation_id is None and await db.products.count_documents({"product_id": product_id}, limit=1):
+            raise HTTPException(status_code=400, detail="Product has variations; set stock per variation_id")
         raise HTTPException(status_code=404, detail="Product not found")
     
+    await invalidate_catalog_cache(product_id)
     return {"message": "Stock updated"}
 
 # ============== EMPLOYEE ROUTES ==============
 @api_router.get("/admin/employees", response_model=List[EmployeeResponse])
-async def get_employees(user: Dict = Depends(get_current_user)):
-    if user.get("role") not in [UserRole.ADMIN.value, UserRole.MANAGER.value]:
-        raise HTTPException(status_code=403, detail="Insufficient permissions")
-    
+async def get_employees(user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.MANAGER]))):
     employees = await db.employees.find({}, {"_id": 0}).to_list(100)
     for e in employees:
         if isinstance(e.get("created_at"), str):
@@ -1189,13 +3701,13 @@ async def create_employee(employee: EmployeeCreate, user: Dict = Depends(get_cur
     user_doc = {
         "user_id": user_id,
         "email": employee.email,
-        "password": hash_password("TempPass123!"),  # Temporary password
+        "password": await hash_password("TempPass123!"),  # Temporary password
         "name": employee.name,
         "phone": employee.phone,
         "role": employee.role.value,
         "picture": None,
         "loyalty_points": 0,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
     await db.users.insert_one(user_doc)
     
@@ -1213,24 +3725,36 @@ async def create_employee(employee: EmployeeCreate, user: Dict = Depends(get_cur
         "commission_rate": employee.commission_rate,
         "total_sales": 0.0,
         "total_commission": 0.0,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
     await db.employees.insert_one(employee_doc)
     
-    employee_doc["created_at"] = datetime.fromisoformat(employee_doc["created_at"])
     return EmployeeResponse(**employee_doc)
 
+@api_router.put("/admin/users/{user_id}/role")
+async def update_user_role(user_id: str, role: UserRole, user: Dict = Depends(require_role([UserRole.ADMIN]))):
+    result = await db.users.update_one(
+        {"user_id": user_id},
+        {"$set": {"role": role.value}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    await db.employees.update_one({"user_id": user_id}, {"$set": {"role": role.value}})
+    
+    # Existing JWTs still carry the old role claim
+    await token_revocations.revoke(user_id)
+    invalidate_user_cache(user_id)
+    return {"message": "User role updated"}
+
 # ============== CRM ROUTES ==============
 @api_router.get("/admin/customers")
 async def get_customers(
-    user: Dict = Depends(get_current_user),
+    user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.MANAGER, UserRole.SALES, UserRole.SUPPORT])),
     page: int = 1,
     limit: int = 20,
     search: Optional[str] = None
 ):
-    if user.get("role") not in [UserRole.ADMIN.value, UserRole.MANAGER.value, UserRole.SALES.value, UserRole.SUPPORT.value]:
-        raise HTTPException(status_code=403, detail="Insufficient permissions")
-    
     query = {"role": UserRole.CUSTOMER.value}
     if search:
         query["$or"] = [
@@ -1262,17 +3786,14 @@ async def get_customers(
     }
 
 @api_router.post("/admin/customers/{user_id}/notes")
-async def add_customer_note(user_id: str, note: CustomerNote, user: Dict = Depends(get_current_user)):
-    if user.get("role") not in [UserRole.ADMIN.value, UserRole.MANAGER.value, UserRole.SALES.value, UserRole.SUPPORT.value]:
-        raise HTTPException(status_code=403, detail="Insufficient permissions")
-    
+async def add_customer_note(user_id: str, note: CustomerNote, user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.MANAGER, UserRole.SALES, UserRole.SUPPORT]))):
     note_doc = {
         "note_id": f"note_{uuid.uuid4().hex[:12]}",
         "customer_id": user_id,
         "added_by": user["user_id"],
         "note": note.note,
         "note_type": note.note_type,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
     
     await db.customer_notes.insert_one(note_doc)
@@ -1280,10 +3801,7 @@ async def add_customer_note(user_id: str, note: CustomerNote, user: Dict = Depen
 
 # ============== PROMO ROUTES ==============
 @api_router.post("/admin/promos", response_model=PromoCodeResponse)
-async def create_promo(promo: PromoCodeCreate, user: Dict = Depends(get_current_user)):
-    if user.get("role") not in [UserRole.ADMIN.value, UserRole.MANAGER.value]:
-        raise HTTPException(status_code=403, detail="Insufficient permissions")
-    
+async def create_promo(promo: PromoCodeCreate, user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.MANAGER]))):
     existing = await db.promo_codes.find_one({"code": promo.code.upper()})
     if existing:
         raise HTTPException(status_code=400, detail="Promo code already exists")
@@ -1295,13 +3813,12 @@ async def create_promo(promo: PromoCodeCreate, user: Dict = Depends(get_current_
         "discount_percent": promo.discount_percent,
         "max_uses": promo.max_uses,
         "uses_count": 0,
-        "valid_until": promo.valid_until.isoformat(),
+        "valid_until": as_datetime(promo.valid_until),
         "min_order_usd": promo.min_order_usd,
         "active": True
     }
     
     await db.promo_codes.insert_one(promo_doc)
-    promo_doc["valid_until"] = datetime.fromisoformat(promo_doc["valid_until"])
     return PromoCodeResponse(**promo_doc)
 
 @api_router.get("/promos/validate/{code}")
@@ -1310,11 +3827,7 @@ async def validate_promo(code: str, user: Dict = Depends(get_current_user)):
     if not promo:
         raise HTTPException(status_code=404, detail="Invalid promo code")
     
-    valid_until = promo["valid_until"]
-    if isinstance(valid_until, str):
-        valid_until = datetime.fromisoformat(valid_until)
-    if valid_until.tzinfo is None:
-        valid_until = valid_until.replace(tzinfo=timezone.utc)
+    valid_until = as_datetime(promo["valid_until"])
     
     if valid_until < datetime.now(timezone.utc):
         raise HTTPException(status_code=400, detail="Promo code expired")
@@ -1330,22 +3843,20 @@ async def validate_promo(code: str, user: Dict = Depends(get_current_user)):
 
 # ============== AI RECOMMENDATIONS ==============
 @api_router.get("/recommendations/{product_id}")
-async def get_recommendations(product_id: str):
-    product = await db.products.find_one({"product_id": product_id}, {"_id": 0})
+@cached_endpoint(lambda params: ["catalog"])
+async def get_recommendations(request: Request, product_id: str, fields: Optional[str] = None, view: Optional[str] = None):
+    selected = select_product_fields(fields, view)
+    product = await db.products.find_one({"product_id": product_id}, {"_id": 0, "category": 1})
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
     # Simple recommendation: same category, different product
     similar = await db.products.find(
         {"category": product["category"], "product_id": {"$ne": product_id}},
-        {"_id": 0}
+        product_projection(selected)
     ).limit(4).to_list(4)
     
-    for p in similar:
-        if isinstance(p.get("created_at"), str):
-            p["created_at"] = datetime.fromisoformat(p["created_at"])
-    
-    return [ProductResponse(**p) for p in similar]
+    return [render_product(p, selected) for p in similar]
 
 @api_router.get("/ai/recommendations")
 async def get_ai_recommendations(user: Dict = Depends(get_current_user)):
@@ -1406,18 +3917,19 @@ Recommend 3 products from the available list that would be most relevant for thi
 
 # ============== WISHLIST ROUTES ==============
 @api_router.get("/wishlist", response_model=WishlistResponse)
-async def get_wishlist(user: Dict = Depends(get_current_user)):
+async def get_wishlist(user: Dict = Depends(get_current_user), fields: Optional[str] = None, view: Optional[str] = None):
+    selected = select_product_fields(fields, view)
     wishlist = await db.wishlists.find_one({"user_id": user["user_id"]}, {"_id": 0})
     if not wishlist or not wishlist.get("items"):
         return WishlistResponse(items=[], count=0)
     
     items_with_details = []
-    for product_id in wishlist["items"]:
-        product = await db.products.find_one({"product_id": product_id}, {"_id": 0})
+    loader = ProductLoader(product_projection(selected, "product_id"))
+    for product in await loader.load_many(wishlist["items"]):
         if product:
             if isinstance(product.get("created_at"), str):
                 product["created_at"] = datetime.fromisoformat(product["created_at"])
-            items_with_details.append(product)
+            items_with_details.append(product if selected is None else render_product(product, selected))
     
     return WishlistResponse(items=items_with_details, count=len(items_with_details))
 
@@ -1510,7 +4022,7 @@ async def get_tickets(user: Dict = Depends(get_current_user)):
 @api_router.post("/tickets", response_model=TicketResponse)
 async def create_ticket(ticket: TicketCreate, user: Dict = Depends(get_current_user)):
     ticket_id = f"ticket_{uuid.uuid4().hex[:12]}"
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     ticket_doc = {
         "ticket_id": ticket_id,
         "user_id": user["user_id"],
@@ -1524,8 +4036,6 @@ async def create_ticket(ticket: TicketCreate, user: Dict = Depends(get_current_u
         "messages": [{"from": "customer", "message": ticket.message, "timestamp": now}]
     }
     await db.tickets.insert_one(ticket_doc)
-    ticket_doc["created_at"] = datetime.fromisoformat(ticket_doc["created_at"])
-    ticket_doc["updated_at"] = datetime.fromisoformat(ticket_doc["updated_at"])
     return TicketResponse(**ticket_doc)
 
 @api_router.post("/tickets/{ticket_id}/reply")
@@ -1539,7 +4049,7 @@ async def reply_to_ticket(ticket_id: str, message: str = Query(...), user: Dict
         raise HTTPException(status_code=403, detail="Access denied")
     
     is_support = user.get("role") in [UserRole.ADMIN.value, UserRole.MANAGER.value, UserRole.SUPPORT.value]
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     await db.tickets.update_one(
         {"ticket_id": ticket_id},
@@ -1551,16 +4061,13 @@ async def reply_to_ticket(ticket_id: str, message: str = Query(...), user: Dict
     return {"message": "Reply added"}
 
 @api_router.put("/tickets/{ticket_id}/status")
-async def update_ticket_status(ticket_id: str, status: str = Query(...), user: Dict = Depends(get_current_user)):
-    if user.get("role") not in [UserRole.ADMIN.value, UserRole.MANAGER.value, UserRole.SUPPORT.value]:
-        raise HTTPException(status_code=403, detail="Insufficient permissions")
-    
+async def update_ticket_status(ticket_id: str, status: str = Query(...), user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.MANAGER, UserRole.SUPPORT]))):
     if status not in ["open", "in_progress", "resolved", "closed"]:
         raise HTTPException(status_code=400, detail="Invalid status")
     
     result = await db.tickets.update_one(
         {"ticket_id": ticket_id},
-        {"$set": {"status": status, "updated_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {"status": status, "updated_at": datetime.now(timezone.utc)}}
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Ticket not found")
@@ -1587,6 +4094,7 @@ async def redeem_loyalty_points(points: int = Query(..., ge=100), user: Dict = D
         {"user_id": user["user_id"]},
         {"$inc": {"loyalty_points": -points}}
     )
+    invalidate_user_cache(user["user_id"])
     
     # Log transaction
     await db.loyalty_transactions.insert_one({
@@ -1595,35 +4103,101 @@ async def redeem_loyalty_points(points: int = Query(..., ge=100), user: Dict = D
         "type": "redeem",
         "points": -points,
         "description": f"Redeemed {points} points for ${points * 0.01:.2f} discount",
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     })
     
     return {"message": f"Redeemed {points} points", "discount_usd": points * 0.01}
 
 # ============== COMPARE PRODUCTS ==============
+# Canonical spec -> (label, base unit, {unit: factor to base}, which end is "best")
+SPEC_UNITS = {
+    "ram": ("RAM", "GB", {"tb": 1024, "gb": 1, "mb": 1 / 1024}, "max"),
+    "storage": ("Storage", "GB", {"tb": 1024, "gb": 1, "mb": 1 / 1024}, "max"),
+    "battery": ("Battery", "mAh", {"mah": 1}, "max"),
+    "display": ("Display", "in", {"in": 1, "inch": 1, "inches": 1, '"': 1, "cm": 1 / 2.54}, None),
+    "refresh_rate": ("Refresh rate", "Hz", {"hz": 1}, "max"),
+    "camera": ("Camera", "MP", {"mp": 1}, "max"),
+    "weight": ("Weight", "g", {"g": 1, "kg": 1000, "oz": 28.3495}, "min"),
+    "warranty": ("Warranty", "months", {"months": 1, "month": 1, "years": 12, "year": 12}, "max"),
+}
+SPEC_ALIASES = {
+    "memory": "ram", "battery_capacity": "battery", "screen": "display", "screen_size": "display",
+    "display_size": "display", "main_camera": "camera", "rear_camera": "camera", "internal_storage": "storage"
+}
+SPEC_VALUE_RE = re.compile(r'^\s*([0-9]+(?:\.[0-9]+)?)\s*([a-zA-Z"]*)')
+
+def canonical_spec_key(key: str) -> str:
+    slug = re.sub(r"[^a-z0-9]+", "_", key.lower()).strip("_")
+    return SPEC_ALIASES.get(slug, slug)
+
+def normalise_spec(key: str, raw: Any) -> Dict[str, Any]:
+    """Typed value of one spec cell: numbers in the spec's base unit, anything else as text"""
+    units = SPEC_UNITS.get(key)
+    if isinstance(raw, bool):
+        return {"type": "boolean", "value": raw}
+    if isinstance(raw, (int, float)):
+        return {"type": "number", "value": float(raw)}
+    match = SPEC_VALUE_RE.match(str(raw)) if units else None
+    if match:
+        number, unit = float(match.group(1)), match.group(2).lower()
+        factor = units[2].get(unit or units[1].lower())
+        if factor is not None:
+            return {"type": "number", "value": round(number * factor, 3)}
+    return {"type": "text", "value": str(raw).strip()}
+
+def build_comparison_matrix(products: List[Dict]) -> List[Dict[str, Any]]:
+    """One row per spec across the products, with difference flags and the best product(s)"""
+    specs = [{canonical_spec_key(k): v for k, v in (p.get("specifications") or {}).items()} for p in products]
+    keys = sorted({key for spec in specs for key in spec}, key=lambda k: (k not in SPEC_UNITS, k))
+    rows = []
+    for key in keys:
+        label, unit, _, best_end = SPEC_UNITS.get(key, (key.replace("_", " ").title(), None, None, None))
+        cells = [
+            {"product_id": p["product_id"], "raw": spec.get(key), **(normalise_spec(key, spec[key]) if key in spec else {"type": None, "value": None})}
+            for p, spec in zip(products, specs)
+        ]
+        present = [c for c in cells if c["value"] is not None]
+        numeric = [c for c in present if c["type"] == "number"]
+        best = []
+        if best_end and len(numeric) == len(present) and len(numeric) > 1:
+            target = (max if best_end == "max" else min)(c["value"] for c in numeric)
+            if any(c["value"] != target for c in numeric):
+                best = [c["product_id"] for c in numeric if c["value"] == target]
+        rows.append({
+            "key": key,
+            "label": label,
+            "unit": unit if numeric else None,
+            "values": cells,
+            "differs": len({(c["type"], c["value"]) for c in cells}) > 1,
+            "best": best
+        })
+    return rows
+
 @api_router.post("/products/compare")
 async def compare_products(product_ids: List[str]):
+    product_ids = sorted(set(product_ids))
     if len(product_ids) < 2 or len(product_ids) > 4:
         raise HTTPException(status_code=400, detail="Compare 2-4 products")
     
-    products = await db.products.find({"product_id": {"$in": product_ids}}, {"_id": 0}).to_list(4)
-    
-    if len(products) < 2:
-        raise HTTPException(status_code=404, detail="Products not found")
-    
-    for p in products:
-        if isinstance(p.get("created_at"), str):
-            p["created_at"] = datetime.fromisoformat(p["created_at"])
-    
-    # Extract all specification keys
-    all_specs = set()
-    for p in products:
-        all_specs.update(p.get("specifications", {}).keys())
+    async def render() -> bytes:
+        # load_many keeps product_ids order, so no re-sort is needed
+        products = [p for p in await ProductLoader().load_many(product_ids) if p]
+        if len(products) < 2:
+            raise HTTPException(status_code=404, detail="Products not found")
+        matrix = build_comparison_matrix(products)
+        return render_json({
+            "products": [render_product(p, None) for p in products],
+            "comparison_fields": [row["key"] for row in matrix],
+            "matrix": matrix
+        })
     
-    return {
-        "products": [ProductResponse(**p) for p in products],
-        "comparison_fields": list(all_specs)
-    }
+    if response_cache is None:
+        body = await render()
+    else:
+        # Keyed by the sorted id set; any write to one of the products bumps its tag
+        key = await response_cache.versioned_key(f"compare:{','.join(product_ids)}", [f"product:{pid}" for pid in product_ids])
+        body = await response_cache.fetch(key, render)
+    return Response(content=body, media_type="application/json")
 
 # ============== PDF INVOICE GENERATION ==============
 @api_router.get("/orders/{order_id}/invoice")
@@ -1658,7 +4232,7 @@ async def get_invoice(order_id: str, user: Dict = Depends(get_current_user)):
     
     # Order Info
     elements.append(Paragraph(f"<b>Order ID:</b> {order['order_id']}", styles['Normal']))
-    elements.append(Paragraph(f"<b>Date:</b> {order['created_at'][:10]}", styles['Normal']))
+    elements.append(Paragraph(f"<b>Date:</b> {as_datetime(order['created_at']).strftime('%Y-%m-%d')}", styles['Normal']))
     elements.append(Paragraph(f"<b>Status:</b> {order['status'].upper()}", styles['Normal']))
     elements.append(Paragraph(f"<b>Payment:</b> {order['payment_status'].upper()}", styles['Normal']))
     elements.append(Spacer(1, 20))
@@ -1712,6 +4286,269 @@ async def get_invoice(order_id: str, user: Dict = Depends(get_current_user)):
         headers={"Content-Disposition": f"attachment; filename=invoice_{order_id}.pdf"}
     )
 
+# ============== METRICS ==============
+@api_router.get("/admin/metrics")
+async def get_metrics(user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.MANAGER]))):
+    return {
+        "password_hashing": password_hasher.stats(),
+        "auth_cache": auth_cache.stats(),
+        "product_search": product_search.stats(),
+        "product_suggest": product_suggest.stats(),
+        "response_cache": response_cache.stats() if response_cache is not None else None,
+        "exchange_rates": exchange_rates.stats(),
+        "image_pipeline": image_pipeline.stats(),
+        "product_loader": ProductLoader.stats(),
+        "stock_snapshots": stock_snapshots.stats(),
+        "cart_store": cart_store.stats()
+    }
+
+# ============== DATABASE INDEXES ==============
+# get_products sorts on (field, product_id) after at most one equality filter; each pair gets
+# its own index so listings never fall back to a blocking in-memory sort
+PRODUCT_LISTING_FILTERS = [None, "category", "brand", "condition"]
+PRODUCT_LISTING_SORTS = [f.value for f in ProductSortField if f != ProductSortField.RELEVANCE]
+
+# collection -> [(keys, options)]
+INDEX_SPECS = {
+    "users": [
+        ([("user_id", ASCENDING)], {"unique": True}),
+        ([("email", ASCENDING)], {"unique": True}),
+        ([("role", ASCENDING)], {}),
+    ],
+    "user_sessions": [
+        ([("session_token", ASCENDING)], {"unique": True}),
+        ([("user_id", ASCENDING)], {"unique": True}),
+        ([("expires_at", ASCENDING)], {"expireAfterSeconds": 0}),
+    ],
+    "token_revocations": [
+        ([("user_id", ASCENDING)], {"unique": True}),
+        ([("revoked_at", ASCENDING)], {}),
+    ],
+    "products": [
+        ([("product_id", ASCENDING)], {"unique": True}),
+        (PRODUCT_VERSION_INDEX, {}),
+        ([("featured", ASCENDING)], {}),
+        ([("variations.variation_id", ASCENDING)], {"unique": True, "partialFilterExpression": {"variations.variation_id": {"$exists": True}}}),
+        ([("stock", ASCENDING)], {"name": "low_stock", "partialFilterExpression": {"stock": {"$lte": 5}}}),
+        # Only products with an in-flight compensating checkout carry markers
+        ([("stock_reservations.reserved_at", ASCENDING)], {"sparse": True}),
+        *(
+            (([(prefix, ASCENDING)] if prefix else []) + [(field, DESCENDING), ("product_id", DESCENDING)], {})
+            for prefix in PRODUCT_LISTING_FILTERS for field in PRODUCT_LISTING_SORTS
+        ),
+    ],
+    "carts": [
+        ([("user_id", ASCENDING)], {"unique": True}),
+        # Write-behind snapshots expire with the cart; documents without the field never do
+        ([("expires_at", ASCENDING)], {"expireAfterSeconds": 0}),
+    ],
+    "orders": [
+        ([("order_id", ASCENDING)], {"unique": True}),
+        ([("user_id", ASCENDING), ("created_at", DESCENDING)], {}),
+        ([("created_at", DESCENDING)], {}),
+        ([("status", ASCENDING)], {}),
+        ([("payment_status", ASCENDING), ("created_at", DESCENDING)], {}),
+    ],
+    "reviews": [
+        ([("review_id", ASCENDING)], {"unique": True}),
+        ([("product_id", ASCENDING), ("created_at", DESCENDING)], {}),
+        ([("product_id", ASCENDING), ("user_id", ASCENDING)], {}),
+    ],
+    "employees": [
+        ([("employee_id", ASCENDING)], {"unique": True}),
+        ([("user_id", ASCENDING)], {}),
+    ],
+    "customer_notes": [
+        ([("customer_id", ASCENDING)], {}),
+    ],
+    "promo_codes": [
+        ([("promo_id", ASCENDING)], {"unique": True}),
+        ([("code", ASCENDING)], {"unique": True}),
+    ],
+    "payment_transactions": [
+        ([("transaction_id", ASCENDING)], {"unique": True}),
+        ([("session_id", ASCENDING)], {"unique": True}),
+        ([("order_id", ASCENDING)], {}),
+    ],
+    "wishlists": [
+        ([("user_id", ASCENDING)], {"unique": True}),
+    ],
+    "addresses": [
+        ([("address_id", ASCENDING)], {"unique": True}),
+        ([("user_id", ASCENDING)], {}),
+    ],
+    "tickets": [
+        ([("ticket_id", ASCENDING)], {"unique": True}),
+        ([("user_id", ASCENDING), ("created_at", DESCENDING)], {}),
+    ],
+    "loyalty_transactions": [
+        ([("user_id", ASCENDING), ("created_at", DESCENDING)], {}),
+    ],
+}
+
+PROBE_DATETIME = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+# Representative hot queries as (collection, filter, sort); verify_indexes() explains each one
+HOT_QUERIES = [
+    ("users", {"user_id": "probe"}, None),
+    ("users", {"email": "probe@example.com"}, None),
+    ("users", {"role": UserRole.CUSTOMER.value}, None),
+    ("user_sessions", {"session_token": "probe"}, None),
+    ("token_revocations", {"revoked_at": {"$gte": PROBE_DATETIME}}, None),
+    ("products", {"product_id": "probe"}, None),
+    ("products", {"product_id": {"$in": ["probe", "probe2"]}}, None),
+    *(
+        ("products", {prefix: probe} if prefix else {}, [(field, direction), ("product_id", direction)])
+        for prefix, probe in zip(PRODUCT_LISTING_FILTERS, [None, ProductCategory.PHONES.value, "probe", ProductCondition.NEW.value])
+        for field in PRODUCT_LISTING_SORTS
+        for direction in (DESCENDING, ASCENDING)
+    ),
+    ("products", {"featured": True}, None),
+    ("products", {"product_id": "probe", "variations.variation_id": "probe"}, None),
+    ("products", {"stock": {"$lte": 5}}, None),
+    ("products", {"stock_reservations.reserved_at": {"$lt": PROBE_DATETIME}}, None),
+    ("carts", {"user_id": "probe"}, None),
+    ("orders", {"order_id": "probe"}, None),
+    ("orders", {"user_id": "probe"}, [("created_at", DESCENDING)]),
+    ("orders", {}, [("created_at", DESCENDING)]),
+    ("orders", {"status": OrderStatus.PENDING.value}, None),
+    ("orders", {"payment_status": PaymentStatus.COMPLETED.value, "created_at": {"$gte": PROBE_DATETIME}}, None),
+    ("reviews", {"product_id": "probe"}, [("created_at", DESCENDING)]),
+    ("reviews", {"product_id": "probe", "user_id": "probe"}, None),
+    ("employees", {"user_id": "probe"}, None),
+    ("promo_codes", {"code": "PROBE", "active": True}, None),
+    ("payment_transactions", {"session_id": "probe"}, None),
+    ("wishlists", {"user_id": "probe"}, None),
+    ("addresses", {"user_id": "probe"}, None),
+    ("tickets", {"ticket_id": "probe"}, None),
+    ("tickets", {"user_id": "probe"}, [("created_at", DESCENDING)]),
+    ("loyalty_transactions", {"user_id": "probe"}, [("created_at", DESCENDING)]),
+]
+
+async def ensure_indexes() -> List[str]:
+    """Create every index in INDEX_SPECS; failures are logged so startup never aborts"""
+    created = []
+    for collection, specs in INDEX_SPECS.items():
+        for keys, options in specs:
+            try:
+                name = await db[collection].create_index(keys, **options)
+                created.append(f"{collection}.{name}")
+            except OperationFailure as e:
+                # e.g. duplicate keys in legacy data blocking a unique index
+                logger.error(f"Index creation failed on {collection} {keys}: {e}")
+    return created
+
+def _plan_stages(plan: Any) -> List[str]:
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(_plan_stages(value))
+    return stages
+
+async def verify_indexes() -> List[Dict[str, Any]]:
+    """Explain each hot query and flag collection scans and in-memory sorts in the winning plan"""
+    report = []
+    for collection, query, sort in HOT_QUERIES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explained = await cursor.explain()
+        stages = _plan_stages(explained.get("queryPlanner", {}).get("winningPlan", {}))
+        report.append({
+            "collection": collection,
+            "query": query,
+            "sort": sort,
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages,
+            # A SORT stage means the index did not provide the order and Mongo sorts in memory
+            "blocking_sort": sort is not None and "SORT" in stages
+        })
+    return report
+
+# ============== DATETIME MIGRATION ==============
+# collection -> top-level timestamp fields that used to be written as ISO strings
+DATETIME_FIELDS = {
+    "users": ["created_at"],
+    "user_sessions": ["created_at", "expires_at"],
+    "token_revocations": ["revoked_at"],
+    "products": ["created_at"],
+    "orders": ["created_at", "updated_at"],
+    "reviews": ["created_at"],
+    "employees": ["created_at"],
+    "customer_notes": ["created_at"],
+    "promo_codes": ["valid_until"],
+    "payment_transactions": ["created_at"],
+    "loyalty_transactions": ["created_at"],
+    "tickets": ["created_at", "updated_at"],
+}
+
+async def migrate_datetimes(batch_size: int = DATETIME_MIGRATION_BATCH_SIZE, dry_run: bool = False) -> Dict[str, Dict[str, int]]:
+    """Rewrite ISO-string timestamps as native datetimes, one _id-ordered batch at a time"""
+    report = {}
+    for collection, fields in DATETIME_FIELDS.items():
+        for field in fields:
+            converted = failed = 0
+            last_id = None
+            while True:
+                query = {field: {"$type": "string"}}
+                if last_id is not None:
+                    query["_id"] = {"$gt": last_id}
+                batch = await db[collection].find(query, {"_id": 1, field: 1}).sort("_id", ASCENDING).limit(batch_size).to_list(batch_size)
+                if not batch:
+                    break
+                last_id = batch[-1]["_id"]
+                
+                operations = []
+                for doc in batch:
+                    try:
+                        value = as_datetime(doc[field])
+                    except ValueError:
+                        logger.warning(f"Unparseable {collection}.{field} on {doc['_id']}: {doc[field]!r}")
+                        failed += 1
+                        continue
+                    # Match on the old value so a concurrent write is never overwritten
+                    operations.append(UpdateOne({"_id": doc["_id"], field: doc[field]}, {"$set": {field: value}}))
+                
+                if operations and not dry_run:
+                    result = await db[collection].bulk_write(operations, ordered=False)
+                    converted += result.modified_count
+                else:
+                    converted += len(operations)
+            report[f"{collection}.{field}"] = {"converted": converted, "failed": failed}
+    return report
+
+async def migrate_variations(dry_run: bool = False) -> Dict[str, int]:
+    """Give legacy free-form variations ids and an attributes map, and re-derive product stock"""
+    migrated = 0
+    cursor = db.products.find(
+        {"variations": {"$elemMatch": {"variation_id": {"$exists": False}}}},
+        {"_id": 0, "product_id": 1, "stock": 1, "variations": 1}
+    )
+    async for product in cursor:
+        variations = [ProductVariation.model_validate(v).model_dump() for v in product["variations"]]
+        doc = apply_variation_totals({"variations": variations})
+        if not dry_run:
+            await db.products.update_one(
+                {"product_id": product["product_id"], "variations": product["variations"]},
+                {"$set": doc, "$inc": {"version": 1}}
+            )
+        migrated += 1
+    return {"products": migrated}
+
+async def backfill_image_derivatives(reprocess: bool = False) -> Dict[str, int]:
+    """Build derivatives for products created before the pipeline existed, or by bulk import"""
+    query = {} if reprocess else {"image_variants": {"$exists": False}}
+    processed = 0
+    async for product in db.products.find(query, {"_id": 0, "product_id": 1, "images": 1}):
+        await image_pipeline.process_product(product["product_id"], list(product.get("images") or []))
+        processed += 1
+    return {"products": processed, **image_pipeline.stats()}
+
 # ============== HEALTH CHECK ==============
 @api_router.get("/")
 async def root():
@@ -1733,6 +4570,144 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def startup_indexes():
+    if ENSURE_INDEXES_ON_STARTUP:
+        created = await ensure_indexes()
+        logger.info(f"Ensured {len(created)} indexes")
+
+@app.on_event("startup")
+async def startup_migrate_variations():
+    # Idempotent, and finishes before the first request so no read sees a legacy variation
+    if MIGRATE_VARIATIONS_ON_STARTUP:
+        report = await migrate_variations()
+        if report["products"]:
+            logger.info(f"Gave variation ids to {report['products']} legacy products")
+            await invalidate_catalog_cache()
+
+background_tasks: List[asyncio.Task] = []
+
+async def refresh_exchange_rates():
+    try:
+        changed = await exchange_rates.refresh()
+    except (OSError, ValueError) as e:
+        exchange_rates.failures += 1
+        logger.error(f"Exchange rate refresh failed, keeping previous rates: {e}")
+        return
+    if changed:
+        logger.info(f"Exchange rates updated: {dict(exchange_rates.rates)}")
+        # Cached listings filtered by a local-currency price range were computed with the old rates
+        await invalidate_catalog_cache()
+
+async def _refresh_exchange_rates_periodically():
+    while True:
+        await asyncio.sleep(EXCHANGE_RATES_REFRESH_SECONDS)
+        await refresh_exchange_rates()
+
+@app.on_event("startup")
+async def startup_exchange_rates():
+    await refresh_exchange_rates()
+    if EXCHANGE_RATES_REFRESH_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(_refresh_exchange_rates_periodically()))
+
+@app.on_event("startup")
+async def startup_catalog_indexes():
+    background_tasks.append(asyncio.create_task(rebuild_catalog_indexes()))
+    if SEARCH_INDEX_REFRESH_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(_refresh_catalog_indexes_periodically()))
+
+async def _maintain_cart_store_periodically():
+    while True:
+        await asyncio.sleep(CART_WRITE_BEHIND_SECONDS or 60)
+        try:
+            await cart_store.maintain()
+        except Exception as e:
+            logger.error(f"Cart store maintenance failed: {e}")
+
+async def _release_stale_reservations_periodically():
+    while True:
+        await asyncio.sleep(ORDER_RESERVATION_SWEEP_SECONDS)
+        try:
+            report = await release_stale_reservations(ORDER_RESERVATION_STALE_SECONDS)
+        except Exception as e:
+            logger.error(f"Stale reservation sweep failed: {e}")
+            continue
+        if report["released"] or report["settled"]:
+            logger.info(f"Stale reservations: {report['released']} released, {report['settled']} settled")
+        if report["released"]:
+            await invalidate_catalog_cache()
+
+@app.on_event("startup")
+async def startup_reservation_sweep():
+    # Releases are conditional on the marker, so every worker can sweep without double-counting
+    if ORDER_RESERVATION_SWEEP_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(_release_stale_reservations_periodically()))
+
+@app.on_event("startup")
+async def startup_cart_store():
+    if isinstance(cart_store, KeyValueCartStore):
+        background_tasks.append(asyncio.create_task(_maintain_cart_store_periodically()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
+    await cart_store.shutdown()
     client.close()
+    await close_oauth_http_client()
+    await image_pipeline.shutdown()
+    password_hasher.shutdown()
+
+async def _run_cli(args) -> int:
+    if args.command == "ensure-indexes":
+        for name in await ensure_indexes():
+            print(name)
+        return 0
+    
+    if args.command == "process-images":
+        report = await backfill_image_derivatives(args.all)
+        await image_pipeline.shutdown()
+        print(f"{report['products']} products: {report['rendered']} images rendered, {report['reused']} reused, {report['failed']} failed")
+        return 1 if report["failed"] else 0
+    
+    if args.command == "migrate-variations":
+        report = await migrate_variations(args.dry_run)
+        print(f"{report['products']} products given variation ids")
+        return 0
+    
+    if args.command == "release-reservations":
+        report = await release_stale_reservations(args.older_than)
+        print(f"{report['released']} stale reservations released, {report['settled']} settled")
+        return 0
+    
+    if args.command == "migrate-datetimes":
+        report = await migrate_datetimes(args.batch_size, args.dry_run)
+        for name, counts in report.items():
+            print(f"{name:<40} converted={counts['converted']} failed={counts['failed']}")
+        return 1 if any(c["failed"] for c in report.values()) else 0
+    
+    report = await verify_indexes()
+    collscans = [r for r in report if r["collscan"]]
+    blocking_sorts = [r for r in report if r["blocking_sort"]]
+    for r in report:
+        status = "COLLSCAN" if r["collscan"] else "SORT" if r["blocking_sort"] else "ok"
+        print(f"{status:<9} {r['collection']:<22} {r['query']} sort={r['sort']} stages={r['stages']}")
+    print(f"{len(collscans)} of {len(report)} hot queries use a collection scan, {len(blocking_sorts)} sort in memory")
+    return 1 if collscans or blocking_sorts else 0
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(prog="python server.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("ensure-indexes", help="create every index in INDEX_SPECS")
+    commands.add_parser("verify-indexes", help="explain hot queries and report collection scans")
+    migrate = commands.add_parser("migrate-datetimes", help="convert ISO-string timestamps to native datetimes")
+    migrate.add_argument("--batch-size", type=int, default=DATETIME_MIGRATION_BATCH_SIZE)
+    migrate.add_argument("--dry-run", action="store_true", help="count convertible values without writing")
+    variations = commands.add_parser("migrate-variations", help="assign ids to legacy product variations")
+    variations.add_argument("--dry-run", action="store_true", help="count products without writing")
+    images = commands.add_parser("process-images", help="build image derivatives for products that have none")
+    images.add_argument("--all", action="store_true", help="re-run for every product")
+    reservations = commands.add_parser("release-reservations", help="return stock held by checkouts that never completed")
+    reservations.add_argument("--older-than", type=int, default=ORDER_RESERVATION_STALE_SECONDS, help="only markers older than this many seconds")
+    sys.exit(asyncio.run(_run_cli(parser.parse_args())))
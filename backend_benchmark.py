@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+TechGalaxy E-commerce Platform - Backend Performance Benchmarks
+Measures API latency under concurrent load against a running server
+"""
+
+import requests
+import asyncio
+import json
+import os
+import sys
+import time
+import statistics
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+class TechGalaxyBenchmark:
+    def __init__(self, base_url="https://techgalaxy.preview.emergentagent.com"):
+        self.base_url = base_url
+        self.api_url = f"{base_url}/api"
+        self.admin_token = None
+        self.results = []
+
+        # Test credentials
+        self.admin_creds = {"email": "admin@techgalaxy.ke", "password": "Admin123!"}
+        self.user_creds = {"email": "test@example.com", "password": "Test123!"}
+
+    def percentile(self, samples: List[float], pct: float) -> float:
+        """Nearest-rank percentile of a list of samples"""
+        if not samples:
+            return 0.0
+        ordered = sorted(samples)
+        index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+        return ordered[index]
+
+    def log_result(self, name: str, samples: List[float], extra: str = ""):
+        """Print and record a latency summary in milliseconds"""
+        summary = {
+            "name": name,
+            "count": len(samples),
+            "p50": self.percentile(samples, 50),
+            "p95": self.percentile(samples, 95),
+            "p99": self.percentile(samples, 99),
+            "mean": statistics.mean(samples) if samples else 0.0
+        }
+        self.results.append(summary)
+        print(f"📈 {name}: n={summary['count']} p50={summary['p50']:.1f}ms "
+              f"p95={summary['p95']:.1f}ms p99={summary['p99']:.1f}ms mean={summary['mean']:.1f}ms")
+        if extra:
+            print(f"    {extra}")
+
+    def timed_request(self, method: str, endpoint: str, data: Optional[Dict] = None,
+                      token: Optional[str] = None) -> tuple[float, int]:
+        """Make HTTP request and return (latency_ms, status_code)"""
+        url = f"{self.api_url}/{endpoint.lstrip('/')}"
+        headers = {'Content-Type': 'application/json'}
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+
+        started = time.perf_counter()
+        try:
+            response = requests.request(method.upper(), url, json=data, headers=headers, timeout=60)
+            status = response.status_code
+        except requests.exceptions.RequestException:
+            status = 0
+        return (time.perf_counter() - started) * 1000, status
+
+    def setup(self) -> bool:
+        """Login as admin so metrics endpoints can be read"""
+        _, status = self.timed_request("GET", "/health")
+        if status != 200:
+            print(f"❌ Server not reachable at {self.api_url}")
+            return False
+        response = requests.post(f"{self.api_url}/auth/login", json=self.admin_creds, timeout=60)
+        if response.status_code == 200:
+            self.admin_token = response.json().get("token")
+        return True
+
+    def sample_endpoint(self, endpoint: str, requests_count: int, stop: Optional[threading.Event] = None) -> List[float]:
+        """Sequentially sample an endpoint, returning latencies of successful calls"""
+        samples = []
+        for _ in range(requests_count):
+            if stop is not None and stop.is_set():
+                break
+            latency, status = self.timed_request("GET", endpoint)
+            if status == 200:
+                samples.append(latency)
+        return samples
+
+    def bench_catalog_under_login_load(self, login_clients: int = 16, catalog_requests: int = 200):
+        """p99 of /api/products while bcrypt-heavy logins run concurrently"""
+        print("\n🔍 Benchmarking /api/products latency under concurrent login load...")
+
+        baseline = self.sample_endpoint("/products?limit=12", catalog_requests)
+        self.log_result("GET /products (idle)", baseline)
+
+        stop = threading.Event()
+        login_latencies = []
+
+        def login_loop():
+            while not stop.is_set():
+                latency, status = self.timed_request("POST", "/auth/login", self.user_creds)
+                if status == 200:
+                    login_latencies.append(latency)
+
+        with ThreadPoolExecutor(max_workers=login_clients) as pool:
+            for _ in range(login_clients):
+                pool.submit(login_loop)
+            time.sleep(1)  # let the login storm ramp up
+            under_load = self.sample_endpoint("/products?limit=12", catalog_requests)
+            stop.set()
+
+        self.log_result("GET /products (during logins)", under_load)
+        self.log_result("POST /auth/login (concurrent)", login_latencies, f"{login_clients} concurrent clients")
+
+        if self.admin_token:
+            response = requests.get(f"{self.api_url}/admin/metrics",
+                                    headers={'Authorization': f'Bearer {self.admin_token}'}, timeout=60)
+            if response.status_code == 200:
+                print(f"    Password hashing: {response.json().get('password_hashing')}")
+
+    def bench_payload_sizes(self):
+        """Response size of the Landing and Products page grids, full documents vs card view"""
+        print("\n🔍 Measuring product grid payload sizes...")
+
+        pages = [
+            ("Landing featured", "/products/featured?limit=8"),
+            ("Products page 1", "/products?limit=12&sort_by=created_at&sort_order=desc"),
+        ]
+        for name, endpoint in pages:
+            separator = "&" if "?" in endpoint else "?"
+            sizes = {}
+            for view in ("full", "card"):
+                response = requests.get(f"{self.api_url}{endpoint}{separator}view={view}", timeout=60)
+                sizes[view] = len(response.content) if response.status_code == 200 else 0
+            saved = (1 - sizes["card"] / sizes["full"]) * 100 if sizes["full"] else 0.0
+            print(f"📦 {name}: full={sizes['full']}B card={sizes['card']}B ({saved:.0f}% smaller)")
+
+    def bench_serialization(self, page_size: int = 50, iterations: int = 200):
+        """In-process throughput of the validated vs trusted response path for products and orders pages"""
+        print(f"\n🔍 Benchmarking response serialization ({page_size}-item pages)...")
+        os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+        os.environ.setdefault("DB_NAME", "techgalaxy_bench")
+        sys.path.insert(0, str(Path(__file__).parent / "backend"))
+        try:
+            import server
+            from fastapi.routing import serialize_response
+            from fastapi.utils import create_response_field
+        except ImportError as e:
+            print(f"⚠️  Skipped, backend dependencies not installed: {e}")
+            return
+
+        now = datetime.now(timezone.utc)
+        products = [{
+            "product_id": f"prod_{i:04d}", "name": f"Galaxy Phone {i}", "brand": "Samsung",
+            "category": "phones", "condition": "new", "description": "Flagship phone " * 20,
+            "price_usd": 799.0 + i, "original_price_usd": 899.0, "stock": 10, "sku": f"SKU{i}",
+            "images": [f"https://img.example.com/{i}/{n}.jpg" for n in range(4)],
+            "specifications": {"ram": "8GB", "storage": "256GB", "display": "6.1 inch"},
+            "tags": ["5g", "android", "flagship"], "featured": True, "rating": 4.5,
+            "review_count": 12, "sold_count": 40, "created_at": now
+        } for i in range(page_size)]
+        orders = [{
+            "order_id": f"ord_{i:04d}", "user_id": "user_bench",
+            "items": [{"product_id": p["product_id"], "product_name": p["name"], "price_usd": p["price_usd"],
+                       "quantity": 1} for p in products[:3]],
+            "subtotal_usd": 2400.0, "shipping_usd": 0.0, "total_usd": 2400.0, "currency": "USD",
+            "total_local": 2400.0, "status": "pending", "payment_status": "pending",
+            "payment_method": "stripe", "shipping_address": "1 Moi Avenue", "shipping_city": "Nairobi",
+            "shipping_country": "Kenya", "phone": "+254700000000", "created_at": now, "updated_at": now
+        } for i in range(page_size)]
+
+        list_field = create_response_field("products", server.ProductListResponse)
+        orders_field = create_response_field("orders", List[server.OrderResponse])
+
+        async def validated_products():
+            content = server.ProductListResponse(products=[server.ProductResponse(**p) for p in products],
+                                                 total=page_size, page=1, limit=page_size, total_pages=1)
+            return server.render_json(await serialize_response(field=list_field, response_content=content))
+
+        async def trusted_products():
+            content = {"products": [server.dump_trusted(server.ProductResponse, p) for p in products],
+                       "total": page_size, "page": 1, "limit": page_size, "total_pages": 1}
+            return server.TrustedJSONResponse(server.dump_trusted(server.ProductListResponse, content)).body
+
+        async def validated_orders():
+            content = [server.OrderResponse(**o) for o in orders]
+            return server.render_json(await serialize_response(field=orders_field, response_content=content))
+
+        async def trusted_orders():
+            return server.TrustedJSONResponse([server.dump_trusted(server.OrderResponse, o) for o in orders]).body
+
+        async def measure(render) -> float:
+            await render()  # warm up lazily built schemas and plans
+            started = time.perf_counter()
+            for _ in range(iterations):
+                await render()
+            return iterations / (time.perf_counter() - started)
+
+        encoder = "orjson" if server.orjson is not None else "json"
+        for name, validated, trusted in (("get_products", validated_products, trusted_products),
+                                         ("get_orders", validated_orders, trusted_orders)):
+            slow = asyncio.run(measure(validated))
+            fast = asyncio.run(measure(trusted))
+            print(f"⚡ {name}: validated={slow:.0f} pages/s trusted+{encoder}={fast:.0f} pages/s ({fast / slow:.1f}x)")
+
+    def bench_product_import(self, rows: int = 100000, dry_run: bool = True):
+        """Stream a generated NDJSON catalog through /admin/products/import"""
+        print(f"\n🔍 Benchmarking streaming import of {rows} NDJSON rows (dry_run={dry_run})...")
+        if not self.admin_token:
+            print("⚠️  Skipped, admin login failed")
+            return
+
+        def body():
+            for i in range(rows):
+                yield (json.dumps({
+                    "product_id": f"bench_{i:06d}", "name": f"Bench Phone {i}", "description": "Benchmark product",
+                    "category": "phones", "brand": "BenchBrand", "price_usd": 100 + i % 900, "stock": 5,
+                    "tags": ["bench"]
+                }) + "\n").encode("utf-8")
+
+        started = time.perf_counter()
+        response = requests.post(f"{self.api_url}/admin/products/import?format=ndjson&dry_run={str(dry_run).lower()}",
+                                 data=body(), headers={'Authorization': f'Bearer {self.admin_token}',
+                                                       'Content-Type': 'application/x-ndjson'}, timeout=600)
+        elapsed = time.perf_counter() - started
+        if response.status_code != 200:
+            print(f"❌ Import failed with status {response.status_code}")
+            return
+        report = response.json()
+        print(f"📥 {report['rows']} rows in {elapsed:.1f}s ({report['rows'] / elapsed:.0f} rows/s), "
+              f"inserted={report['inserted']} updated={report['updated']} failed={report['failed']}")
+
+    def bench_checkout_oversell(self, stock: int = 50, clients: int = 200):
+        """Hammer one SKU with concurrent single-unit checkouts; stock must never go negative"""
+        print(f"\n🔍 Benchmarking {clients} concurrent checkouts against one SKU with stock={stock}...")
+        if not self.admin_token:
+            print("⚠️  Skipped, admin login failed")
+            return
+        admin_headers = {'Authorization': f'Bearer {self.admin_token}'}
+        response = requests.post(f"{self.api_url}/products", headers=admin_headers, timeout=60, json={
+            "name": "Oversell Bench Phone", "description": "Concurrency benchmark product", "category": "phones",
+            "brand": "BenchBrand", "price_usd": 100.0, "stock": stock
+        })
+        if response.status_code != 200:
+            print(f"❌ Could not create benchmark product: {response.status_code}")
+            return
+        product_id = response.json()["product_id"]
+
+        login = requests.post(f"{self.api_url}/auth/login", json=self.user_creds, timeout=60)
+        user_token = login.json().get("token") if login.status_code == 200 else self.admin_token
+        order = {
+            "items": [{"product_id": product_id, "quantity": 1}],
+            "shipping_address": "1 Moi Avenue", "shipping_city": "Nairobi", "shipping_country": "Kenya",
+            "phone": "+254700000000", "currency": "USD", "payment_method": "stripe"
+        }
+
+        start = threading.Barrier(clients)
+
+        def checkout():
+            start.wait()  # release every client at once
+            return self.timed_request("POST", "/orders", order, token=user_token)
+
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            results = list(pool.map(lambda _: checkout(), range(clients)))
+        accepted = [latency for latency, status in results if status == 200]
+        rejected = sum(1 for _, status in results if status == 400)
+        errors = len(results) - len(accepted) - rejected
+
+        final_stock = requests.get(f"{self.api_url}/products/{product_id}", timeout=60).json().get("stock")
+        self.log_result("POST /orders (one SKU, concurrent)", accepted,
+                        f"accepted={len(accepted)} rejected={rejected} errors={errors} final_stock={final_stock}")
+        oversold = final_stock is None or final_stock < 0 or len(accepted) > stock or final_stock != stock - len(accepted)
+        print(f"{'❌ Oversold' if oversold else '✅ No oversell'}: {len(accepted)} orders for {stock} units, {final_stock} left")
+
+        requests.delete(f"{self.api_url}/products/{product_id}", headers=admin_headers, timeout=60)
+
+    def run_all_benchmarks(self) -> bool:
+        """Run all benchmarks"""
+        print("🚀 Starting TechGalaxy Backend Benchmarks")
+        print(f"📍 Testing against: {self.base_url}")
+        print("=" * 60)
+
+        self.bench_serialization()
+
+        if not self.setup():
+            return False
+
+        self.bench_catalog_under_login_load()
+        self.bench_payload_sizes()
+        self.bench_product_import()
+        self.bench_checkout_oversell()
+
+        print("\n" + "=" * 60)
+        print("📊 BENCHMARK SUMMARY")
+        print("=" * 60)
+        for r in self.results:
+            print(f"{r['name']:<45} p99={r['p99']:.1f}ms")
+
+        return True
+
+def main():
+    """Main benchmark execution"""
+    base_url = sys.argv[1] if len(sys.argv) > 1 else "https://techgalaxy.preview.emergentagent.com"
+    bench = TechGalaxyBenchmark(base_url)
+    success = bench.run_all_benchmarks()
+
+    return 0 if success else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
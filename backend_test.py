@@ -5,8 +5,12 @@ Tests all major API endpoints for functionality and integration
 """
 
 import requests
+import os
 import sys
 import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Dict, Any, Optional
 
@@ -172,6 +176,15 @@ class TechGalaxyAPITester:
         else:
             self.log_result("Search Products (Phones)", False, f"Error: {data}")
 
+        # Test every supported sort key, and rejection of unsupported ones
+        for sort_by in ["created_at", "price_usd", "rating", "sold_count", "name"]:
+            success, data = self.make_request("GET", f"/products?sort_by={sort_by}&sort_order=asc&limit=5")
+            self.log_result(f"Sort Products ({sort_by})", success,
+                           f"Found {len(data.get('products', []))} products" if success else f"Error: {data}")
+
+        success, data = self.make_request("GET", "/products?sort_by=description", expected_status=422)
+        self.log_result("Reject Unsupported Sort Key", success, "" if success else f"Error: {data}")
+
     def test_cart_operations(self):
         """Test cart operations"""
         print("\n🔍 Testing Cart Operations...")
@@ -206,6 +219,113 @@ class TechGalaxyAPITester:
         self.log_result("Update Cart Item", success,
                        f"Message: {data.get('message', 'Unknown')}" if success else f"Error: {data}")
 
+        # Test non-positive quantities are rejected
+        zero_ok, _ = self.make_request("POST", "/cart/add", {"product_id": self.test_product_id, "quantity": 0},
+                                       token=self.user_token, expected_status=400)
+        negative_ok, _ = self.make_request("PUT", "/cart/update", {"product_id": self.test_product_id, "quantity": -1},
+                                           token=self.user_token, expected_status=422)
+        self.log_result("Non-Positive Quantity Rejected", zero_ok and negative_ok,
+                       f"Add 0 rejected: {zero_ok}, update -1 rejected: {negative_ok}")
+
+    def test_cart_concurrency(self, clients: int = 10):
+        """Concurrent adds of the same line must all land (no lost updates)"""
+        print("\n🔍 Testing Concurrent Cart Adds...")
+
+        if not self.user_token or not self.test_product_id:
+            self.log_result("Cart Concurrency Tests", False, "Missing user token or test product ID")
+            return
+
+        self.make_request("DELETE", "/cart/clear", token=self.user_token)
+        cart_item = {"product_id": self.test_product_id, "quantity": 1}
+
+        def add_once():
+            started = time.perf_counter()
+            success, _ = self.make_request("POST", "/cart/add", cart_item, token=self.user_token)
+            return success, (time.perf_counter() - started) * 1000
+
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            results = list(pool.map(lambda _: add_once(), range(clients)))
+        accepted = sum(1 for success, _ in results if success)
+        mean_latency = sum(latency for _, latency in results) / len(results)
+
+        success, data = self.make_request("GET", "/cart", token=self.user_token)
+        in_cart = sum(i["quantity"] for i in data.get("items", []) if i["product_id"] == self.test_product_id) if success else -1
+        self.log_result("Concurrent Adds Not Lost", success and in_cart == accepted,
+                       f"{accepted}/{clients} accepted, cart quantity {in_cart}, mean {mean_latency:.0f}ms per add")
+
+        # Beyond stock the guard rejects the add and leaves the line as it was
+        success, product = self.make_request("GET", f"/products/{self.test_product_id}")
+        if success:
+            over = {"product_id": self.test_product_id, "quantity": product.get("stock", 0) + 1}
+            rejected, _ = self.make_request("POST", "/cart/add", over, token=self.user_token, expected_status=400)
+            _, data = self.make_request("GET", "/cart", token=self.user_token)
+            unchanged = sum(i["quantity"] for i in data.get("items", []) if i["product_id"] == self.test_product_id) == in_cart
+            self.log_result("Add Beyond Stock Rejected", rejected and unchanged,
+                           f"Cart quantity unchanged: {unchanged}")
+
+        self.make_request("DELETE", "/cart/clear", token=self.user_token)
+
+    def test_guest_cart(self):
+        """Anonymous carts live in a signed cookie and merge into the user's cart on login"""
+        print("\n🔍 Testing Guest Cart...")
+
+        if not self.test_product_id:
+            self.log_result("Guest Cart Tests", False, "Missing test product ID")
+            return
+
+        guest = requests.Session()
+        response = guest.post(f"{self.api_url}/cart/add", json={"product_id": self.test_product_id, "quantity": 1}, timeout=30)
+        self.log_result("Guest Add to Cart", response.status_code == 200 and "guest_cart" in guest.cookies,
+                       f"Status: {response.status_code}")
+
+        response = guest.get(f"{self.api_url}/cart", timeout=30)
+        guest_items = response.json().get("items", []) if response.status_code == 200 else []
+        self.log_result("Guest Cart Priced Server-Side", len(guest_items) == 1 and guest_items[0].get("price_usd") is not None,
+                       f"Items: {len(guest_items)}")
+
+        # A tampered cookie reads as an empty cart rather than trusting client data
+        tampered = requests.get(f"{self.api_url}/cart", cookies={"guest_cart": guest.cookies.get("guest_cart", "x.y")[:-2] + "AA"}, timeout=30)
+        self.log_result("Tampered Guest Cookie Ignored", tampered.status_code == 200 and not tampered.json().get("items"))
+
+        if self.user_token:
+            self.make_request("DELETE", "/cart/clear", token=self.user_token)
+            response = guest.post(f"{self.api_url}/auth/login", json=self.user_creds, timeout=30)
+            success, data = self.make_request("GET", "/cart", token=self.user_token)
+            merged = any(i["product_id"] == self.test_product_id for i in data.get("items", [])) if success else False
+            self.log_result("Guest Cart Merged on Login", response.status_code == 200 and merged and "guest_cart" not in guest.cookies,
+                           f"Merged: {merged}")
+            self.make_request("DELETE", "/cart/clear", token=self.user_token)
+
+    def test_oauth_session_with_guest_cart(self):
+        """The OAuth session exchange merges a guest cart and clears its cookie"""
+        print("\n🔍 Testing OAuth Session With Guest Cart...")
+
+        if not self.test_product_id:
+            self.log_result("OAuth Guest Cart Tests", False, "Missing test product ID")
+            return
+
+        guest = requests.Session()
+        guest.post(f"{self.api_url}/cart/add", json={"product_id": self.test_product_id, "quantity": 1}, timeout=30)
+
+        response = guest.get(f"{self.api_url}/auth/session", headers={"X-Session-ID": f"invalid_{uuid.uuid4().hex}"}, timeout=30)
+        self.log_result("Invalid OAuth Session With Guest Cookie", response.status_code in (401, 503),
+                       f"Status: {response.status_code}")
+
+        # Session ids are single-use and issued by the OAuth provider, so one has to be supplied
+        session_id = os.environ.get("OAUTH_TEST_SESSION_ID")
+        if not session_id:
+            print("⚠️  Skipped OAuth exchange, set OAUTH_TEST_SESSION_ID to run it")
+            return
+        response = guest.get(f"{self.api_url}/auth/session", headers={"X-Session-ID": session_id}, timeout=30)
+        session_token = response.json().get("session_token") if response.status_code == 200 else None
+        merged = False
+        if session_token:
+            success, data = self.make_request("GET", "/cart", token=session_token)
+            merged = any(i["product_id"] == self.test_product_id for i in data.get("items", [])) if success else False
+            self.make_request("DELETE", "/cart/clear", token=session_token)
+        self.log_result("OAuth Session Merges Guest Cart", response.status_code == 200 and merged and "guest_cart" not in guest.cookies,
+                       f"Status: {response.status_code}, merged: {merged}")
+
     def test_order_operations(self):
         """Test order operations"""
         print("\n🔍 Testing Order Operations...")
@@ -394,6 +514,9 @@ class TechGalaxyAPITester:
         self.test_authentication()
         self.test_products()
         self.test_cart_operations()
+        self.test_cart_concurrency()
+        self.test_guest_cart()
+        self.test_oauth_session_with_guest_cart()
         self.test_order_operations()
         self.test_payment_integration()
         self.test_admin_dashboard()
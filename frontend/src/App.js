@@ -60,7 +60,8 @@ export const AuthProvider = ({ children }) => {
   }, []);
 
   const login = async (email, password) => {
-    const response = await axios.post(`${API}/auth/login`, { email, password });
+    // withCredentials lets the server read and clear the guest cart cookie it merges
+    const response = await axios.post(`${API}/auth/login`, { email, password }, { withCredentials: true });
     localStorage.setItem("token", response.data.token);
     setToken(response.data.token);
     setUser(response.data.user);
@@ -68,7 +69,7 @@ export const AuthProvider = ({ children }) => {
   };
 
   const register = async (email, password, name, phone) => {
-    const response = await axios.post(`${API}/auth/register`, { email, password, name, phone });
+    const response = await axios.post(`${API}/auth/register`, { email, password, name, phone }, { withCredentials: true });
     localStorage.setItem("token", response.data.token);
     setToken(response.data.token);
     setUser(response.data.user);
@@ -83,6 +84,7 @@ export const AuthProvider = ({ children }) => {
 
   const authAxios = axios.create({
     baseURL: API,
+    withCredentials: true,
     headers: token ? { Authorization: `Bearer ${token}` } : {}
   });
 
@@ -136,7 +138,8 @@ const AuthCallback = () => {
       if (sessionId) {
         try {
           const response = await axios.get(`${API}/auth/session`, {
-            headers: { "X-Session-ID": sessionId }
+            headers: { "X-Session-ID": sessionId },
+            withCredentials: true
           });
           
           localStorage.setItem("token", response.data.session_token);
@@ -179,11 +182,7 @@ function AppRouter() {
       <Route path="/register" element={<Register />} />
       
       {/* Protected Customer Routes */}
-      <Route path="/cart" element={
-        <ProtectedRoute>
-          <Cart />
-        </ProtectedRoute>
-      } />
+      <Route path="/cart" element={<Cart />} />
       <Route path="/checkout" element={
         <ProtectedRoute>
           <Checkout />
@@ -1,7 +1,8 @@
 import { Link, useNavigate } from "react-router-dom";
-import { useAuth } from "../../App";
+import axios from "axios";
+import { API, useAuth } from "../../App";
 import { ShoppingCart, User, Menu, X, Search, LogOut, Package, LayoutDashboard, Heart, MapPin, MessageCircle } from "lucide-react";
-import { useState } from "react";
+import { useState, useEffect } from "react";
 import { Button } from "../ui/button";
 import {
   DropdownMenu,
@@ -16,6 +17,23 @@ export const Navbar = () => {
   const navigate = useNavigate();
   const [mobileMenuOpen, setMobileMenuOpen] = useState(false);
   const [searchQuery, setSearchQuery] = useState("");
+  const [suggestions, setSuggestions] = useState(null);
+
+  useEffect(() => {
+    if (!searchQuery.trim()) {
+      setSuggestions(null);
+      return;
+    }
+    const timer = setTimeout(async () => {
+      try {
+        const response = await axios.get(`${API}/products/suggest`, { params: { q: searchQuery, limit: 5 } });
+        setSuggestions(response.data);
+      } catch (error) {
+        setSuggestions(null);
+      }
+    }, 150);
+    return () => clearTimeout(timer);
+  }, [searchQuery]);
 
   const handleSearch = (e) => {
     e.preventDefault();
@@ -25,6 +43,13 @@ export const Navbar = () => {
     }
   };
 
+  const goToSuggestion = (path) => {
+    navigate(path);
+    setSearchQuery("");
+  };
+
+  const hasSuggestions = suggestions && (suggestions.products.length || suggestions.brands.length || suggestions.tags.length);
+
   const handleLogout = () => {
     logout();
     navigate("/");
@@ -56,6 +81,25 @@ export const Navbar = () => {
                 className="input-dark w-full pl-10 pr-4 py-2 text-sm"
                 data-testid="search-input"
               />
+              {hasSuggestions ? (
+                <div className="absolute left-0 right-0 top-full mt-1 bg-card border border-neutral-800 rounded-lg shadow-lg py-1 text-sm" data-testid="search-suggestions">
+                  {suggestions.products.map((p) => (
+                    <button type="button" key={p.product_id} onClick={() => goToSuggestion(`/products/${p.product_id}`)} className="block w-full text-left px-4 py-2 text-white hover:bg-neutral-800">
+                      {p.name}
+                    </button>
+                  ))}
+                  {suggestions.brands.map((b) => (
+                    <button type="button" key={`brand-${b.brand}`} onClick={() => goToSuggestion(`/products?brand=${encodeURIComponent(b.brand)}`)} className="block w-full text-left px-4 py-2 text-neutral-400 hover:bg-neutral-800">
+                      Brand: {b.brand} ({b.count})
+                    </button>
+                  ))}
+                  {suggestions.tags.map((t) => (
+                    <button type="button" key={`tag-${t.tag}`} onClick={() => goToSuggestion(`/products?search=${encodeURIComponent(t.tag)}`)} className="block w-full text-left px-4 py-2 text-neutral-400 hover:bg-neutral-800">
+                      {t.tag}
+                    </button>
+                  ))}
+                </div>
+              ) : null}
             </div>
           </form>
 
@@ -65,12 +109,12 @@ export const Navbar = () => {
               Products
             </Link>
             
+            <Link to="/cart" className="relative text-neutral-400 hover:text-white transition-colors" data-testid="nav-cart">
+              <ShoppingCart className="h-5 w-5" />
+            </Link>
+            
             {user ? (
               <>
-                <Link to="/cart" className="relative text-neutral-400 hover:text-white transition-colors" data-testid="nav-cart">
-                  <ShoppingCart className="h-5 w-5" />
-                </Link>
-                
                 <DropdownMenu>
                   <DropdownMenuTrigger asChild>
                     <Button variant="ghost" className="text-neutral-400 hover:text-white" data-testid="user-menu-trigger">
@@ -172,11 +216,11 @@ export const Navbar = () => {
               <Link to="/products" className="px-4 py-2 text-neutral-400 hover:text-white" onClick={() => setMobileMenuOpen(false)}>
                 Products
               </Link>
+              <Link to="/cart" className="px-4 py-2 text-neutral-400 hover:text-white" onClick={() => setMobileMenuOpen(false)}>
+                Cart
+              </Link>
               {user ? (
                 <>
-                  <Link to="/cart" className="px-4 py-2 text-neutral-400 hover:text-white" onClick={() => setMobileMenuOpen(false)}>
-                    Cart
-                  </Link>
                   <Link to="/orders" className="px-4 py-2 text-neutral-400 hover:text-white" onClick={() => setMobileMenuOpen(false)}>
                     My Orders
                   </Link>
@@ -1,13 +1,16 @@
 import { Link } from "react-router-dom";
 import { Star, ShoppingCart } from "lucide-react";
 import { Button } from "../ui/button";
+import { useExchangeRates } from "../../hooks/use-exchange-rates";
+import { imageSources, mediaUrl } from "../../lib/images";
 
 const ProductCard = ({ product, onAddToCart, currency = "KES" }) => {
-  const exchangeRates = { USD: 1, KES: 129.5, EUR: 0.92 };
+  const exchangeRates = useExchangeRates();
   const rate = exchangeRates[currency] || 1;
   const localPrice = (product.price_usd * rate).toFixed(2);
   const currencySymbols = { USD: "$", KES: "KES ", EUR: "€" };
   const symbol = currencySymbols[currency] || "$";
+  const sources = imageSources(product, "card");
 
   return (
     <div className="product-card" data-testid={`product-card-${product.product_id}`}>
@@ -26,12 +29,16 @@ const ProductCard = ({ product, onAddToCart, currency = "KES" }) => {
       {/* Image */}
       <Link to={`/products/${product.product_id}`}>
         <div className="relative aspect-square rounded-xl overflow-hidden mb-4 bg-neutral-900">
-          <img
-            src={product.images?.[0] || "https://images.unsplash.com/photo-1592750475338-74b7b21085ab?w=400&q=80"}
-            alt={product.name}
-            className="w-full h-full object-cover group-hover:scale-105 transition-transform duration-300"
-            loading="lazy"
-          />
+          <picture>
+            {sources.avif && <source srcSet={mediaUrl(sources.avif)} type="image/avif" />}
+            {sources.webp && <source srcSet={mediaUrl(sources.webp)} type="image/webp" />}
+            <img
+              src={product.images?.[0] || "https://images.unsplash.com/photo-1592750475338-74b7b21085ab?w=400&q=80"}
+              alt={product.name}
+              className="w-full h-full object-cover group-hover:scale-105 transition-transform duration-300"
+              loading="lazy"
+            />
+          </picture>
         </div>
       </Link>
       
@@ -0,0 +1,38 @@
+import { useState, useEffect } from "react";
+import axios from "axios";
+import { API } from "../App";
+
+// Used until the server's rates arrive, and if that request fails
+const FALLBACK_RATES = { USD: 1, KES: 129.5, EUR: 0.92 };
+
+// One request per page load, shared by every component that renders prices
+let ratesPromise = null;
+
+const loadRates = () => {
+  if (!ratesPromise) {
+    ratesPromise = axios
+      .get(`${API}/exchange-rates`)
+      .then((response) => response.data.rates)
+      .catch(() => {
+        ratesPromise = null;
+        return FALLBACK_RATES;
+      });
+  }
+  return ratesPromise;
+};
+
+export function useExchangeRates() {
+  const [rates, setRates] = useState(FALLBACK_RATES);
+
+  useEffect(() => {
+    let active = true;
+    loadRates().then((loaded) => {
+      if (active) setRates(loaded);
+    });
+    return () => {
+      active = false;
+    };
+  }, []);
+
+  return rates;
+}
@@ -0,0 +1,9 @@
+import { API } from "../App";
+
+// Derivative URLs are server-relative ("/api/media/..."), so resolve them against the backend
+const BACKEND_ORIGIN = API.replace(/\/api$/, "");
+
+export const mediaUrl = (url) => (url && url.startsWith("/") ? `${BACKEND_ORIGIN}${url}` : url);
+
+// { avif, webp } URLs of the first image at one derivative size, empty until the pipeline has run
+export const imageSources = (product, size) => product.image_variants?.[0]?.[size] || {};
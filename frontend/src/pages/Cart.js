@@ -5,6 +5,8 @@ import { Navbar, Footer } from "../components/shared/Layout";
 import { Button } from "../components/ui/button";
 import { toast } from "sonner";
 import { Trash2, Minus, Plus, ShoppingBag, ArrowRight } from "lucide-react";
+import { useExchangeRates } from "../hooks/use-exchange-rates";
+import { mediaUrl } from "../lib/images";
 
 const Cart = () => {
   const { authAxios } = useAuth();
@@ -14,7 +16,7 @@ const Cart = () => {
   const [updating, setUpdating] = useState(null);
   const [currency, setCurrency] = useState("KES");
 
-  const exchangeRates = { USD: 1, KES: 129.5, EUR: 0.92 };
+  const exchangeRates = useExchangeRates();
   const rate = exchangeRates[currency] || 1;
   const currencySymbols = { USD: "$", KES: "KES ", EUR: "€" };
   const symbol = currencySymbols[currency] || "$";
@@ -34,11 +36,17 @@ const Cart = () => {
     fetchCart();
   }, [currency]);
 
-  const updateQuantity = async (productId, newQuantity) => {
+  const lineKey = (item) => `${item.product_id}:${item.variation_id || ""}`;
+
+  const updateQuantity = async (item, newQuantity) => {
     if (newQuantity < 0) return;
-    setUpdating(productId);
+    setUpdating(lineKey(item));
     try {
-      await authAxios.put("/cart/update", { product_id: productId, quantity: newQuantity });
+      await authAxios.put("/cart/update", {
+        product_id: item.product_id,
+        variation_id: item.variation_id,
+        quantity: newQuantity,
+      });
       await fetchCart();
       if (newQuantity === 0) {
         toast.success("Item removed from cart");
@@ -114,14 +122,14 @@ const Cart = () => {
               <div className="lg:col-span-2 space-y-4">
                 {cart.items.map((item) => (
                   <div
-                    key={item.product_id}
+                    key={lineKey(item)}
                     className="glass-card p-4 flex gap-4"
                     data-testid={`cart-item-${item.product_id}`}
                   >
                     <Link to={`/products/${item.product_id}`} className="flex-shrink-0">
                       <div className="w-24 h-24 rounded-lg overflow-hidden bg-neutral-900">
                         <img
-                          src={item.image || "https://images.unsplash.com/photo-1592750475338-74b7b21085ab?w=200&q=80"}
+                          src={mediaUrl(item.image) || "https://images.unsplash.com/photo-1592750475338-74b7b21085ab?w=200&q=80"}
                           alt={item.name}
                           className="w-full h-full object-cover"
                         />
@@ -142,8 +150,8 @@ const Cart = () => {
                         <div className="flex items-center border border-neutral-800 rounded-lg">
                           <button
                             className="p-2 hover:bg-neutral-800/50 transition-colors disabled:opacity-50"
-                            onClick={() => updateQuantity(item.product_id, item.quantity - 1)}
-                            disabled={updating === item.product_id}
+                            onClick={() => updateQuantity(item, item.quantity - 1)}
+                            disabled={updating === lineKey(item)}
                             data-testid={`decrease-${item.product_id}`}
                           >
                             <Minus className="h-4 w-4" />
@@ -151,8 +159,8 @@ const Cart = () => {
                           <span className="px-4 py-2 font-medium">{item.quantity}</span>
                           <button
                             className="p-2 hover:bg-neutral-800/50 transition-colors disabled:opacity-50"
-                            onClick={() => updateQuantity(item.product_id, item.quantity + 1)}
-                            disabled={updating === item.product_id || item.quantity >= item.stock}
+                            onClick={() => updateQuantity(item, item.quantity + 1)}
+                            disabled={updating === lineKey(item) || item.quantity >= item.stock}
                             data-testid={`increase-${item.product_id}`}
                           >
                             <Plus className="h-4 w-4" />
@@ -160,9 +168,9 @@ const Cart = () => {
                         </div>
                         
                         <button
-                          onClick={() => updateQuantity(item.product_id, 0)}
+                          onClick={() => updateQuantity(item, 0)}
                           className="p-2 text-red-400 hover:bg-red-400/10 rounded-lg transition-colors"
-                          disabled={updating === item.product_id}
+                          disabled={updating === lineKey(item)}
                           data-testid={`remove-${item.product_id}`}
                         >
                           <Trash2 className="h-5 w-5" />
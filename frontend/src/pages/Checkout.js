@@ -7,6 +7,7 @@ import { Input } from "../components/ui/input";
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from "../components/ui/select";
 import { toast } from "sonner";
 import { CreditCard, Smartphone, Wallet, CheckCircle, Loader2 } from "lucide-react";
+import { useExchangeRates } from "../hooks/use-exchange-rates";
 
 const Checkout = () => {
   const { authAxios, user } = useAuth();
@@ -28,7 +29,7 @@ const Checkout = () => {
     notes: "",
   });
 
-  const exchangeRates = { USD: 1, KES: 129.5, EUR: 0.92 };
+  const exchangeRates = useExchangeRates();
   const rate = exchangeRates[currency] || 1;
   const currencySymbols = { USD: "$", KES: "KES ", EUR: "€" };
   const symbol = currencySymbols[currency] || "$";
@@ -100,6 +101,7 @@ const Checkout = () => {
       const orderResponse = await authAxios.post("/orders", {
         items: cart.items.map((item) => ({
           product_id: item.product_id,
+          variation_id: item.variation_id,
           quantity: item.quantity,
         })),
         shipping_address: formData.shipping_address,
@@ -315,7 +317,7 @@ const Checkout = () => {
                   {/* Items */}
                   <div className="space-y-3 mb-4 max-h-48 overflow-y-auto custom-scrollbar">
                     {cart.items.map((item) => (
-                      <div key={item.product_id} className="flex justify-between text-sm">
+                      <div key={`${item.product_id}:${item.variation_id || ""}`} className="flex justify-between text-sm">
                         <span className="text-neutral-400 line-clamp-1 flex-1 mr-2">
                           {item.name} x {item.quantity}
                         </span>
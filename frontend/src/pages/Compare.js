@@ -6,15 +6,17 @@ import { Navbar, Footer } from "../components/shared/Layout";
 import { Button } from "../components/ui/button";
 import { toast } from "sonner";
 import { ArrowLeft, X, Star, Check } from "lucide-react";
+import { useExchangeRates } from "../hooks/use-exchange-rates";
 
 const Compare = () => {
   const [searchParams] = useSearchParams();
   const [products, setProducts] = useState([]);
-  const [comparisonFields, setComparisonFields] = useState([]);
+  const [matrix, setMatrix] = useState([]);
+  const [onlyDifferences, setOnlyDifferences] = useState(false);
   const [loading, setLoading] = useState(true);
   const [currency, setCurrency] = useState("KES");
 
-  const exchangeRates = { USD: 1, KES: 129.5, EUR: 0.92 };
+  const exchangeRates = useExchangeRates();
   const rate = exchangeRates[currency] || 1;
   const currencySymbols = { USD: "$", KES: "KES ", EUR: "€" };
   const symbol = currencySymbols[currency] || "$";
@@ -31,7 +33,7 @@ const Compare = () => {
       try {
         const response = await axios.post(`${API}/products/compare`, productIds);
         setProducts(response.data.products);
-        setComparisonFields(response.data.comparison_fields);
+        setMatrix(response.data.matrix);
       } catch (error) {
         toast.error("Failed to load comparison");
       } finally {
@@ -94,6 +96,17 @@ const Compare = () => {
               <h1 className="font-heading text-3xl font-bold text-white">Compare Products</h1>
             </div>
             
+            <div className="flex items-center gap-4">
+            <label className="flex items-center gap-2 text-sm text-neutral-400 cursor-pointer">
+              <input
+                type="checkbox"
+                checked={onlyDifferences}
+                onChange={(e) => setOnlyDifferences(e.target.checked)}
+                data-testid="only-differences"
+              />
+              Only differences
+            </label>
+
             {/* Currency Selector */}
             <div className="flex items-center gap-2 bg-card border border-neutral-800 rounded-lg p-1">
               {["KES", "USD", "EUR"].map((c) => (
@@ -108,6 +121,7 @@ const Compare = () => {
                 </button>
               ))}
             </div>
+            </div>
           </div>
           
           {/* Comparison Table */}
@@ -223,15 +237,21 @@ const Compare = () => {
                     ))}
                   </tr>
                   
-                  {/* Specification Rows */}
-                  {comparisonFields.map((field) => (
-                    <tr key={field} className="border-b border-neutral-800/50">
-                      <td className="px-4 py-4 bg-neutral-900/50 sticky left-0 font-medium text-white capitalize">
-                        {field.replace(/_/g, " ")}
+                  {/* Specification Rows (values are in the same order as products) */}
+                  {matrix.filter((row) => !onlyDifferences || row.differs).map((row) => (
+                    <tr key={row.key} className="border-b border-neutral-800/50" data-testid={`spec-row-${row.key}`}>
+                      <td className="px-4 py-4 bg-neutral-900/50 sticky left-0 font-medium text-white">
+                        {row.label}
+                        {row.unit && <span className="text-neutral-500 font-normal"> ({row.unit})</span>}
                       </td>
-                      {products.map((product) => (
-                        <td key={product.product_id} className="px-4 py-4 text-center text-neutral-300">
-                          {product.specifications?.[field] || "-"}
+                      {row.values.map((cell) => (
+                        <td
+                          key={cell.product_id}
+                          className={`px-4 py-4 text-center ${
+                            row.best.includes(cell.product_id) ? "text-emerald-400 font-semibold" : "text-neutral-300"
+                          }`}
+                        >
+                          {cell.value === null ? "-" : row.unit ? cell.value : String(cell.raw)}
                         </td>
                       ))}
                     </tr>
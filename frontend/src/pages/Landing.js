@@ -17,7 +17,7 @@ const Landing = () => {
   useEffect(() => {
     const fetchFeatured = async () => {
       try {
-        const response = await axios.get(`${API}/products/featured?limit=8`);
+        const response = await axios.get(`${API}/products/featured?limit=8&view=card`);
         setFeaturedProducts(response.data);
       } catch (error) {
         console.error("Error fetching featured products:", error);
@@ -29,10 +29,6 @@ const Landing = () => {
   }, []);
 
   const handleAddToCart = async (product) => {
-    if (!user) {
-      toast.error("Please login to add items to cart");
-      return;
-    }
     try {
       await authAxios.post("/cart/add", { product_id: product.product_id, quantity: 1 });
       toast.success("Added to cart!");
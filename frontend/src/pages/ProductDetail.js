@@ -7,6 +7,7 @@ import ProductCard from "../components/shared/ProductCard";
 import { Button } from "../components/ui/button";
 import { toast } from "sonner";
 import { Star, ShoppingCart, Heart, Truck, Shield, RefreshCw, ChevronLeft, ChevronRight, Minus, Plus, Scale, FileText } from "lucide-react";
+import { useExchangeRates } from "../hooks/use-exchange-rates";
 
 const ProductDetail = () => {
   const { productId } = useParams();
@@ -23,8 +24,9 @@ const ProductDetail = () => {
   const [submittingReview, setSubmittingReview] = useState(false);
   const [inWishlist, setInWishlist] = useState(false);
   const [compareList, setCompareList] = useState([]);
+  const [selectedVariation, setSelectedVariation] = useState(null);
 
-  const exchangeRates = { USD: 1, KES: 129.5, EUR: 0.92 };
+  const exchangeRates = useExchangeRates();
   const rate = exchangeRates[currency] || 1;
   const currencySymbols = { USD: "$", KES: "KES ", EUR: "€" };
   const symbol = currencySymbols[currency] || "$";
@@ -44,16 +46,17 @@ const ProductDetail = () => {
         const [productRes, reviewsRes, relatedRes] = await Promise.all([
           axios.get(`${API}/products/${productId}`),
           axios.get(`${API}/reviews/${productId}`),
-          axios.get(`${API}/recommendations/${productId}`),
+          axios.get(`${API}/recommendations/${productId}?view=card`),
         ]);
         setProduct(productRes.data);
+        setSelectedVariation(null);
         setReviews(reviewsRes.data);
         setRelatedProducts(relatedRes.data);
         
         // Check if in wishlist
         if (user) {
           try {
-            const wishlistRes = await authAxios.get("/wishlist");
+            const wishlistRes = await authAxios.get("/wishlist?fields=product_id");
             setInWishlist(wishlistRes.data.items.some(item => item.product_id === productId));
           } catch (e) {}
         }
@@ -68,12 +71,12 @@ const ProductDetail = () => {
   }, [productId]);
 
   const handleAddToCart = async () => {
-    if (!user) {
-      toast.error("Please login to add items to cart");
-      return;
-    }
     try {
-      await authAxios.post("/cart/add", { product_id: product.product_id, quantity });
+      await authAxios.post("/cart/add", {
+        product_id: product.product_id,
+        variation_id: selectedVariation?.variation_id,
+        quantity,
+      });
       toast.success(`Added ${quantity} item(s) to cart!`);
     } catch (error) {
       toast.error(error.response?.data?.detail || "Failed to add to cart");
@@ -175,6 +178,10 @@ const ProductDetail = () => {
     );
   }
 
+  // A selected variation carries its own stock, and its own price when it overrides the product's
+  const price = selectedVariation?.price_usd ?? product.price_usd;
+  const stock = selectedVariation ? selectedVariation.stock : product.stock;
+
   const images = product.images?.length > 0 
     ? product.images 
     : ["https://images.unsplash.com/photo-1592750475338-74b7b21085ab?w=800&q=80"];
@@ -290,7 +297,7 @@ const ProductDetail = () => {
                   ))}
                 </div>
                 <p className="text-4xl font-bold text-white" data-testid="product-price">
-                  {symbol}{(product.price_usd * rate).toFixed(2)}
+                  {symbol}{(price * rate).toFixed(2)}
                 </p>
                 {product.original_price_usd && product.original_price_usd > product.price_usd && (
                   <p className="text-xl text-neutral-500 line-through">
@@ -301,17 +308,40 @@ const ProductDetail = () => {
               
               <p className="text-neutral-400 leading-relaxed">{product.description}</p>
               
+              {/* Variations */}
+              {product.has_variations && (
+                <div className="flex flex-wrap gap-2" data-testid="variation-picker">
+                  {product.variations.map((v) => (
+                    <button
+                      key={v.variation_id}
+                      onClick={() => {
+                        setSelectedVariation(v);
+                        setQuantity(1);
+                      }}
+                      className={`px-3 py-2 rounded-lg border text-sm transition-colors ${
+                        selectedVariation?.variation_id === v.variation_id
+                          ? "border-primary text-white"
+                          : "border-neutral-800 text-neutral-400 hover:text-white"
+                      }`}
+                      data-testid={`variation-${v.variation_id}`}
+                    >
+                      {Object.values(v.attributes).join(" / ") || v.sku || v.variation_id}
+                    </button>
+                  ))}
+                </div>
+              )}
+
               {/* Stock */}
               <div>
-                {product.stock > 10 ? (
+                {stock > 10 ? (
                   <p className="text-emerald-400 flex items-center gap-2">
                     <span className="w-2 h-2 bg-emerald-400 rounded-full"></span>
                     In Stock
                   </p>
-                ) : product.stock > 0 ? (
+                ) : stock > 0 ? (
                   <p className="text-amber-400 flex items-center gap-2">
                     <span className="w-2 h-2 bg-amber-400 rounded-full"></span>
-                    Only {product.stock} left
+                    Only {stock} left
                   </p>
                 ) : (
                   <p className="text-red-400 flex items-center gap-2">
@@ -334,7 +364,7 @@ const ProductDetail = () => {
                   <span className="px-6 py-3 font-medium" data-testid="quantity-display">{quantity}</span>
                   <button
                     className="p-3 hover:bg-neutral-800/50 transition-colors"
-                    onClick={() => setQuantity((q) => Math.min(product.stock, q + 1))}
+                    onClick={() => setQuantity((q) => Math.min(stock, q + 1))}
                     data-testid="qty-increase"
                   >
                     <Plus className="h-4 w-4" />
@@ -343,7 +373,7 @@ const ProductDetail = () => {
                 
                 <Button
                   className="btn-primary flex-1"
-                  disabled={product.stock === 0}
+                  disabled={stock === 0 || (product.has_variations && !selectedVariation)}
                   onClick={handleAddToCart}
                   data-testid="add-to-cart-btn"
                 >
@@ -12,7 +12,7 @@ import { toast } from "sonner";
 import { Search, Filter, X, ChevronLeft, ChevronRight } from "lucide-react";
 
 const Products = () => {
-  const { user, authAxios } = useAuth();
+  const { authAxios } = useAuth();
   const [searchParams, setSearchParams] = useSearchParams();
   const [products, setProducts] = useState([]);
   const [loading, setLoading] = useState(true);
@@ -36,22 +36,6 @@ const Products = () => {
     page: parseInt(searchParams.get("page")) || 1,
   });
 
-  useEffect(() => {
-    const fetchFiltersData = async () => {
-      try {
-        const [catRes, brandRes] = await Promise.all([
-          axios.get(`${API}/products/categories`),
-          axios.get(`${API}/products/brands`),
-        ]);
-        setCategories(catRes.data);
-        setBrands(brandRes.data);
-      } catch (error) {
-        console.error("Error fetching filter data:", error);
-      }
-    };
-    fetchFiltersData();
-  }, []);
-
   useEffect(() => {
     const fetchProducts = async () => {
       setLoading(true);
@@ -63,15 +47,22 @@ const Products = () => {
         if (filters.condition) params.set("condition", filters.condition);
         if (filters.minPrice) params.set("min_price", filters.minPrice);
         if (filters.maxPrice) params.set("max_price", filters.maxPrice);
+        // Price bounds are entered in the currency the grid is shown in
+        if (filters.minPrice || filters.maxPrice) params.set("currency", currency);
         params.set("sort_by", filters.sortBy);
         params.set("sort_order", filters.sortOrder);
         params.set("page", filters.page.toString());
         params.set("limit", "12");
+        params.set("facets", "true");
+        params.set("view", "card");
 
+        // One request returns the page plus filter-aware category/brand counts
         const response = await axios.get(`${API}/products?${params.toString()}`);
         setProducts(response.data.products);
         setTotal(response.data.total);
         setTotalPages(response.data.total_pages);
+        setCategories(response.data.facets.categories);
+        setBrands(response.data.facets.brands);
       } catch (error) {
         console.error("Error fetching products:", error);
         toast.error("Failed to load products");
@@ -90,7 +81,7 @@ const Products = () => {
       }
     });
     setSearchParams(params);
-  }, [filters]);
+  }, [filters, currency]);
 
   const handleFilterChange = (key, value) => {
     setFilters((prev) => ({ ...prev, [key]: value, page: 1 }));
@@ -111,10 +102,6 @@ const Products = () => {
   };
 
   const handleAddToCart = async (product) => {
-    if (!user) {
-      toast.error("Please login to add items to cart");
-      return;
-    }
     try {
       await authAxios.post("/cart/add", { product_id: product.product_id, quantity: 1 });
       toast.success("Added to cart!");
@@ -176,12 +163,14 @@ const Products = () => {
                   <SelectValue placeholder="Sort by" />
                 </SelectTrigger>
                 <SelectContent className="bg-card border-neutral-800">
+                  {filters.search && <SelectItem value="relevance-desc">Best Match</SelectItem>}
                   <SelectItem value="created_at-desc">Newest First</SelectItem>
                   <SelectItem value="created_at-asc">Oldest First</SelectItem>
                   <SelectItem value="price_usd-asc">Price: Low to High</SelectItem>
                   <SelectItem value="price_usd-desc">Price: High to Low</SelectItem>
                   <SelectItem value="rating-desc">Highest Rated</SelectItem>
                   <SelectItem value="sold_count-desc">Best Selling</SelectItem>
+                  <SelectItem value="name-asc">Name: A to Z</SelectItem>
                 </SelectContent>
               </Select>
               
@@ -298,7 +287,7 @@ const Products = () => {
                 
                 {/* Price Range */}
                 <div>
-                  <label className="text-sm text-neutral-400 mb-2 block">Price Range (USD)</label>
+                  <label className="text-sm text-neutral-400 mb-2 block">Price Range ({currency})</label>
                   <div className="flex gap-2">
                     <Input
                       type="number"
@@ -15,7 +15,7 @@ const Wishlist = () => {
 
   const fetchWishlist = async () => {
     try {
-      const response = await authAxios.get("/wishlist");
+      const response = await authAxios.get("/wishlist?view=card");
       setWishlist(response.data);
     } catch (error) {
       console.error("Error fetching wishlist:", error);
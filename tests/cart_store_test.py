@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+TechGalaxy cart store checks
+Runs the backend cart stores in-process against the configured MongoDB, unlike the
+HTTP suites in backend_test.py and new_features_test.py
+"""
+
+import asyncio
+import os
+import sys
+import uuid
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "techgalaxy_test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+async def check_clear_with_write_behind(server) -> bool:
+    """A cleared key-value cart must not be rehydrated from its write-behind snapshot"""
+    store = server.KeyValueCartStore(server.MemoryCartKV(60), 60, write_behind=True)
+    user_id = f"test_{uuid.uuid4().hex[:12]}"
+    try:
+        await store.add(user_id, "prod_test", None, 2, 10)
+        await store.flush()  # the Mongo snapshot now holds the line
+        await store.clear(user_id)
+        after_clear = await store.get_items(user_id)
+        await store.flush()
+        after_flush = await store.get_items(user_id)
+        snapshot = await server.db.carts.find_one({"user_id": user_id})
+    finally:
+        await server.db.carts.delete_one({"user_id": user_id})
+
+    success = after_clear == [] and after_flush == [] and snapshot is None
+    print(f"{'✅ PASS' if success else '❌ FAIL'} - Cleared Cart Stays Empty")
+    print(f"    After clear: {after_clear}, after flush: {after_flush}, snapshot kept: {snapshot is not None}")
+    return success
+
+def main():
+    try:
+        import server
+    except ImportError as e:
+        print(f"⚠️  Skipped, backend dependencies not installed: {e}")
+        return 0
+
+    success = asyncio.run(check_clear_with_write_behind(server))
+    return 0 if success else 1
+
+if __name__ == "__main__":
+    sys.exit(main())